@@ -0,0 +1,459 @@
+"""
+End-to-end benchmark against local OpenAI and Twilio stand-ins (see fake_services.py)
+- Scenarios: POST /schedule, POST /webhook/twilio-reply, a peak minute of reminder sends, and
+  the same peak minute through Redis and a real Celery worker (celery_sends)
+- Needs a reachable Redis; uses a throwaway SQLite database unless --database-url is given
+- Writes a JSON report (throughput, p50/p95/p99 latency, DB commits) to compare across commits:
+  python benchmark.py --output bench.json
+  python benchmark.py --compare bench.json
+"""
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from datetime import datetime
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from fake_services import Behavior, FakeOpenAI, FakeTwilio
+
+SCENARIOS = ("schedule", "webhook", "peak_minute", "celery_sends")
+# celery_sends starts a worker subprocess, so it only runs when asked for
+DEFAULT_SCENARIOS = ("schedule", "webhook", "peak_minute")
+
+SHORT_REPLIES = ["done", "Done!", "thanks", "ok 👍", "skipped today", "did it"]
+LONG_REPLIES = [
+    "I managed a 30 minute run before work but I'm starving now, what should I eat?",
+    "Struggling to stay motivated this week, work has been really stressful",
+    "Had a big lunch with colleagues, not sure it was very healthy honestly",
+]
+
+def percentile(ordered: list, p: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered))) - 1))]
+
+def summarize(latencies: list, errors: int, duration: float, commits: int, services: dict) -> dict:
+    ordered = sorted(latencies)
+    return {
+        "operations": len(latencies),
+        "errors": errors,
+        "duration_seconds": round(duration, 3),
+        "throughput_per_second": round(len(latencies) / duration, 2) if duration else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(ordered, 50) * 1000, 2),
+            "p95": round(percentile(ordered, 95) * 1000, 2),
+            "p99": round(percentile(ordered, 99) * 1000, 2),
+            "max": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+            "mean": round(sum(ordered) / len(ordered) * 1000, 2) if ordered else 0.0
+        },
+        "db_commits": commits,
+        "upstream": services
+    }
+
+class CommitCounter:
+    """Counts transaction commits on the given SQLAlchemy engines"""
+    
+    def __init__(self, *engines):
+        from sqlalchemy import event
+        self.commits = 0
+        self._lock = threading.Lock()
+        for engine in engines:
+            event.listen(engine, "commit", self._on_commit)
+    
+    def _on_commit(self, conn):
+        with self._lock:
+            self.commits += 1
+
+class Bench:
+    def __init__(self, args, openai_server: FakeOpenAI, twilio_server: FakeTwilio):
+        self.args = args
+        self.openai_server = openai_server
+        self.twilio_server = twilio_server
+        
+        # App modules read their settings at import time, so they are imported only now
+        import models
+        import main
+        import scheduler
+        from log_buffer import message_log_buffer
+        self.models = models
+        self.main = main
+        self.scheduler = scheduler
+        self.message_log_buffer = message_log_buffer
+        self.commit_counter = CommitCounter(models.engine, models.async_engine.sync_engine)
+    
+    def _snapshot(self) -> tuple:
+        return self.commit_counter.commits, self.openai_server.stats(), self.twilio_server.stats()
+    
+    def _delta(self, before: tuple) -> tuple:
+        commits, openai_before, twilio_before = before
+        commits_now, openai_now, twilio_now = self._snapshot()
+        services = {
+            "openai_requests": openai_now["requests"] - openai_before["requests"],
+            "openai_errors": openai_now["errors"] - openai_before["errors"],
+            "twilio_requests": twilio_now["requests"] - twilio_before["requests"],
+            "twilio_errors": twilio_now["errors"] - twilio_before["errors"]
+        }
+        return commits_now - commits, services
+    
+    @staticmethod
+    def _phone(i: int) -> str:
+        return f"+1555{i:07d}"
+    
+    async def _drive(self, count: int, request) -> tuple:
+        """Run count requests with bounded concurrency; returns latencies and error count"""
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        latencies = []
+        errors = 0
+        
+        async def one(i: int):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    ok = await request(i)
+                except Exception:
+                    ok = False
+                latencies.append(time.perf_counter() - started)
+                errors += int(not ok)
+        
+        await asyncio.gather(*(one(i) for i in range(count)))
+        return latencies, errors
+    
+    async def _api_scenario(self, request) -> dict:
+        import httpx
+        transport = httpx.ASGITransport(app=self.main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            before = self._snapshot()
+            started = time.perf_counter()
+            latencies, errors = await self._drive(self.args.requests, lambda i: request(client, i))
+            duration = time.perf_counter() - started
+        # Coalesced bursts are answered in the background; let them finish before counting
+        import twilio_webhook
+        if twilio_webhook._pending_bursts:
+            await asyncio.gather(*twilio_webhook._pending_bursts, return_exceptions=True)
+        self.message_log_buffer.flush()
+        commits, services = self._delta(before)
+        return summarize(latencies, errors, duration, commits, services)
+    
+    async def scenario_schedule(self) -> dict:
+        async def request(client, i: int) -> bool:
+            response = await client.post("/schedule", json={
+                "phone": self._phone(i),
+                "message_type": random.choice(["meal", "workout"]),
+                # Most users pick a handful of round minutes
+                "time": random.choice(["07:00", "08:00", "12:00", "18:00", f"{random.randint(0, 23):02d}:{random.randint(0, 59):02d}"]),
+                "mode": "llm"
+            })
+            return response.status_code == 200
+        return await self._api_scenario(request)
+    
+    async def scenario_webhook(self) -> dict:
+        async def request(client, i: int) -> bool:
+            body = random.choice(SHORT_REPLIES) if random.random() < 0.5 else f"{random.choice(LONG_REPLIES)} ({i})"
+            response = await client.post("/webhook/twilio-reply", data={
+                "From": self._phone(i % 1000),
+                "Body": body
+            })
+            return response.status_code == 200
+        return await self._api_scenario(request)
+    
+    def _peak_items(self, first_id: int) -> list:
+        due_at = time.time()
+        return [
+            [self._phone(i), random.choice(["meal", "workout"]), first_id + i, "llm", "08:00", due_at]
+            for i in range(self.args.peak_reminders)
+        ]
+    
+    def _warm_pools(self, items: list) -> float:
+        """Fill the pools for the whole minute first, as steady-state refills would have"""
+        warm_started = time.perf_counter()
+        for message_type, count in Counter(item[1] for item in items).items():
+            self.scheduler.gpt_generator.refill_pool(message_type, minimum=count)
+        return time.perf_counter() - warm_started
+    
+    def scenario_peak_minute(self) -> dict:
+        """Every reminder due in the same minute, sent by a pool of simulated worker processes"""
+        scheduler = self.scheduler
+        items = self._peak_items(10_000_000)
+        
+        before = self._snapshot()
+        started = time.perf_counter()
+        warm_seconds = self._warm_pools(items)
+        
+        if self.args.peak_mode == "batch":
+            chunk = scheduler.DISPATCH_SEND_CHUNK
+            units = [items[i:i + chunk] for i in range(0, len(items), chunk)]
+            run = scheduler.send_scheduled_batch
+        else:
+            units = items
+            run = lambda item: scheduler.send_scheduled_message(*item)
+        
+        def timed(unit):
+            unit_started = time.perf_counter()
+            result = run(unit)
+            return time.perf_counter() - unit_started, result
+        
+        with ThreadPoolExecutor(max_workers=self.args.workers) as pool:
+            outcomes = list(pool.map(timed, units))
+        self.message_log_buffer.flush()
+        duration = time.perf_counter() - started
+        
+        latencies = [latency for latency, _ in outcomes]
+        if self.args.peak_mode == "batch":
+            errors = sum(result.get("failed", 0) for _, result in outcomes)
+        else:
+            errors = sum(1 for _, result in outcomes if not result.get("success"))
+        
+        commits, services = self._delta(before)
+        report = summarize(latencies, errors, duration, commits, services)
+        report["reminders"] = len(items)
+        report["reminders_per_second"] = round(len(items) / duration, 2) if duration else 0.0
+        report["pool_warm_seconds"] = round(warm_seconds, 3)
+        report["mode"] = self.args.peak_mode
+        return report
+    
+    def _start_worker(self) -> subprocess.Popen:
+        """A real worker process on the queue the current profile routes sends to"""
+        scheduler = self.scheduler
+        throughput = scheduler.CELERY_PROFILE == "throughput"
+        pool = self.args.celery_pool or ("threads" if throughput else "prefork")
+        worker = subprocess.Popen(
+            [
+                sys.executable, "-m", "celery", "-A", "scheduler.celery_app", "worker",
+                "-Q", scheduler.SEND_QUEUE if throughput else "celery",
+                "--pool", pool, "--concurrency", str(self.args.celery_concurrency or self.args.workers),
+                "--without-heartbeat", "--without-mingle", "--without-gossip", "--loglevel", "warning"
+            ],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, WORKER_METRICS_PORT="0")
+        )
+        deadline = time.monotonic() + 60
+        while not scheduler.celery_app.control.ping(timeout=0.5):
+            if worker.poll() is not None or time.monotonic() > deadline:
+                worker.kill()
+                raise RuntimeError("Celery worker did not come up")
+        return worker
+    
+    def _redis_usage(self) -> dict:
+        from redis_utils import redis_client
+        result_keys = list(redis_client.scan_iter(match="celery-task-meta-*", count=1000))
+        return {
+            "used_memory_bytes": redis_client.info("memory")["used_memory"],
+            "result_keys": len(result_keys),
+            "result_key_ttl_seconds": redis_client.ttl(result_keys[0]) if result_keys else None
+        }
+    
+    def scenario_celery_sends(self) -> dict:
+        """
+        The peak minute published to Redis and consumed by a Celery worker subprocess
+        - Latency is time from the start of publishing to each send reaching fake Twilio
+        - Run once per CELERY_PROFILE (--celery-profile) and --compare the reports
+        - DB commits happen in the worker process and are not counted here
+        """
+        scheduler = self.scheduler
+        items = self._peak_items(20_000_000)
+        warm_seconds = self._warm_pools(items)
+        redis_before = self._redis_usage()
+        worker = self._start_worker()
+        
+        try:
+            before = self._snapshot()
+            sent_before = len(self.twilio_server.arrivals)
+            started = time.perf_counter()
+            if self.args.peak_mode == "batch":
+                chunk = scheduler.DISPATCH_SEND_CHUNK
+                for i in range(0, len(items), chunk):
+                    scheduler.send_scheduled_batch.delay(items[i:i + chunk])
+            else:
+                for item in items:
+                    scheduler.send_scheduled_message.apply_async(args=item)
+            publish_seconds = time.perf_counter() - started
+            
+            deadline = time.monotonic() + self.args.celery_timeout
+            while self.twilio_server.stats()["requests"] - before[2]["requests"] < len(items):
+                if time.monotonic() > deadline or worker.poll() is not None:
+                    break
+                time.sleep(0.05)
+            duration = time.perf_counter() - started
+        finally:
+            worker.terminate()
+            try:
+                worker.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                worker.kill()
+        
+        latencies = [arrival - started for arrival in self.twilio_server.arrivals[sent_before:]]
+        commits, services = self._delta(before)
+        redis_after = self._redis_usage()
+        report = summarize(latencies, len(items) - len(latencies), duration, commits, services)
+        report["reminders"] = len(items)
+        report["reminders_per_second"] = round(len(latencies) / duration, 2) if duration else 0.0
+        report["publish_seconds"] = round(publish_seconds, 3)
+        report["pool_warm_seconds"] = round(warm_seconds, 3)
+        report["mode"] = self.args.peak_mode
+        report["profile"] = scheduler.CELERY_PROFILE
+        report["redis"] = {
+            "used_memory_delta_bytes": redis_after["used_memory_bytes"] - redis_before["used_memory_bytes"],
+            "result_keys_added": redis_after["result_keys"] - redis_before["result_keys"],
+            "result_key_ttl_seconds": redis_after["result_key_ttl_seconds"]
+        }
+        return report
+    
+    async def run(self, scenarios: list) -> dict:
+        await self.models.acreate_tables()
+        results = {}
+        for name in scenarios:
+            if name in ("peak_minute", "celery_sends"):
+                results[name] = await asyncio.get_running_loop().run_in_executor(None, getattr(self, f"scenario_{name}"))
+            else:
+                results[name] = await getattr(self, f"scenario_{name}")()
+        return results
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+def _configure_environment(args, openai_server: FakeOpenAI, twilio_server: FakeTwilio):
+    os.environ["OPENAI_BASE_URL"] = openai_server.api_base
+    os.environ["TWILIO_API_BASE_URL"] = twilio_server.base_url
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["REDIS_URL"] = args.redis_url
+    os.environ["TWILIO_SEND_RATE"] = str(args.twilio_send_rate)
+    os.environ["TWILIO_SEND_BURST"] = str(max(1, int(args.twilio_send_rate)))
+    os.environ["INBOUND_COALESCE_SECONDS"] = str(args.inbound_coalesce_seconds)
+    os.environ["CELERY_PROFILE"] = args.celery_profile
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACbench00000000000000000000000000")
+    os.environ.setdefault("TWILIO_AUTH_TOKEN", "bench-token")
+    os.environ.setdefault("TWILIO_PHONE_NUMBER", "+15550000000")
+
+def _check_isolation(args, openai_server: FakeOpenAI, twilio_server: FakeTwilio):
+    """Modules load .env with override=True; refuse to run if it redirected us at real services"""
+    import models
+    import redis_utils
+    import gpt_utils
+    import twilio_utils
+    import scheduler
+    expected = {
+        "DATABASE_URL": (models.DATABASE_URL, args.database_url),
+        "REDIS_URL": (redis_utils.REDIS_URL, args.redis_url),
+        "OPENAI_BASE_URL": (gpt_utils.OPENAI_BASE_URL, openai_server.api_base),
+        "TWILIO_API_BASE_URL": (twilio_utils.TWILIO_API_BASE_URL, twilio_server.base_url),
+        "CELERY_PROFILE": (scheduler.CELERY_PROFILE, args.celery_profile),
+    }
+    for name, (actual, wanted) in expected.items():
+        if actual != wanted:
+            sys.exit(f"{name} is overridden by .env ({actual}); unset it there to benchmark")
+
+def _compare(current: dict, baseline: dict) -> dict:
+    """Percent change per scenario for throughput and p95 latency"""
+    def change(new, old):
+        return round((new - old) / old * 100, 1) if old else None
+    
+    comparison = {}
+    for name, result in current["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        comparison[name] = {
+            "throughput_change_pct": change(result["throughput_per_second"], previous["throughput_per_second"]),
+            "p95_change_pct": change(result["latency_ms"]["p95"], previous["latency_ms"]["p95"]),
+            "db_commits_change": result["db_commits"] - previous["db_commits"]
+        }
+        if "redis" in result and "redis" in previous:
+            comparison[name]["redis_memory_change_pct"] = change(
+                result["redis"]["used_memory_delta_bytes"], previous["redis"]["used_memory_delta_bytes"]
+            )
+    return {"baseline_commit": baseline.get("commit"), "scenarios": comparison}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the API and send path against fake upstreams")
+    parser.add_argument("--scenarios", default=",".join(DEFAULT_SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=500, help="Requests per API scenario")
+    parser.add_argument("--concurrency", type=int, default=50, help="Concurrent API requests")
+    parser.add_argument("--peak-reminders", type=int, default=2000, help="Reminders due in the simulated peak minute")
+    parser.add_argument("--peak-mode", choices=["single", "batch"], default="single",
+                        help="send_scheduled_message per reminder, or dispatcher-sized send_scheduled_batch chunks")
+    parser.add_argument("--workers", type=int, default=8, help="Simulated worker processes for the peak minute")
+    parser.add_argument("--openai-latency-ms", type=float, default=300)
+    parser.add_argument("--openai-jitter-ms", type=float, default=100)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--openai-error-status", type=int, default=500)
+    parser.add_argument("--twilio-latency-ms", type=float, default=100)
+    parser.add_argument("--twilio-jitter-ms", type=float, default=30)
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0)
+    parser.add_argument("--twilio-error-status", type=int, default=429)
+    parser.add_argument("--twilio-send-rate", type=float, default=500, help="Token-bucket sends/sec for the benchmark process")
+    parser.add_argument("--inbound-coalesce-seconds", type=float, default=0,
+                        help="Webhook burst window; 0 measures the synchronous reply path")
+    parser.add_argument("--celery-profile", choices=["default", "throughput"], default="default",
+                        help="CELERY_PROFILE for celery_sends (producer and worker)")
+    parser.add_argument("--celery-pool", choices=["prefork", "threads"], default=None,
+                        help="Worker pool for celery_sends; defaults to threads for throughput, prefork otherwise")
+    parser.add_argument("--celery-concurrency", type=int, default=None, help="Worker concurrency; defaults to --workers")
+    parser.add_argument("--celery-timeout", type=float, default=300, help="Seconds to wait for celery_sends to drain")
+    parser.add_argument("--database-url", default=None, help="Defaults to a temporary SQLite file")
+    parser.add_argument("--redis-url", default=os.getenv("BENCH_REDIS_URL", "redis://localhost:6379/15"))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--compare", help="Previous JSON report to diff against")
+    args = parser.parse_args()
+    
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.database_url is None:
+        args.database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='sms-bench-'), 'bench.db')}"
+    random.seed(args.seed)
+    
+    openai_server = FakeOpenAI(Behavior(
+        args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate, args.openai_error_status
+    )).start()
+    twilio_server = FakeTwilio(Behavior(
+        args.twilio_latency_ms, args.twilio_jitter_ms, args.twilio_error_rate, args.twilio_error_status
+    )).start()
+    
+    try:
+        _configure_environment(args, openai_server, twilio_server)
+        _check_isolation(args, openai_server, twilio_server)
+        bench = Bench(args, openai_server, twilio_server)
+        results = asyncio.run(bench.run(scenarios))
+    finally:
+        openai_server.stop()
+        twilio_server.stop()
+    
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "scenarios": results
+    }
+    if args.compare:
+        with open(args.compare) as baseline:
+            report["comparison"] = _compare(report, json.load(baseline))
+    
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
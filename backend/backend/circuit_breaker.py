@@ -0,0 +1,102 @@
+from collections import deque
+from typing import Dict, Any, Optional
+import time
+import threading
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a call while the breaker is open"""
+
+class CircuitBreaker:
+    """
+    Trips after consecutive errors or over-threshold latencies
+    - closed: calls go through
+    - open: calls fail fast for cooldown_seconds
+    - half-open: a single trial call decides whether to close again
+    """
+    
+    def __init__(self, name: str, failure_threshold: int, slow_call_seconds: float, cooldown_seconds: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown_seconds = cooldown_seconds
+        
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self._lock = threading.Lock()
+        
+        self.calls = 0
+        self.failures = 0
+        self.slow_calls = 0
+        self.short_circuits = 0
+        self.trips = 0
+    
+    def allow(self) -> bool:
+        """Whether a call may proceed; every allowed call must be followed by record()"""
+        with self._lock:
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown_seconds:
+                self.state = "half_open"
+                self.trial_in_flight = False
+            
+            if self.state == "closed":
+                return True
+            if self.state == "half_open" and not self.trial_in_flight:
+                self.trial_in_flight = True
+                return True
+            
+            self.short_circuits += 1
+            return False
+    
+    def record(self, duration: float, error: bool):
+        with self._lock:
+            self.calls += 1
+            slow = duration > self.slow_call_seconds
+            self.slow_calls += int(slow)
+            self.failures += int(error)
+            
+            if error or slow:
+                self.consecutive_failures += 1
+                if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                    self._trip()
+            else:
+                self.consecutive_failures = 0
+                self.state = "closed"
+            self.trial_in_flight = False
+    
+    def _trip(self):
+        if self.state != "open":
+            self.trips += 1
+        self.state = "open"
+        self.opened_at = time.monotonic()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "state": self.state,
+                "calls": self.calls,
+                "failures": self.failures,
+                "slow_calls": self.slow_calls,
+                "short_circuits": self.short_circuits,
+                "trips": self.trips
+            }
+
+class LatencyTracker:
+    """Rolling window of recent call durations for percentile estimates"""
+    
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.samples = deque(maxlen=size)
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+    
+    def add(self, duration: float):
+        with self._lock:
+            self.samples.append(duration)
+    
+    def percentile(self, p: float) -> Optional[float]:
+        """p-th percentile of the window, or None until enough samples exist"""
+        with self._lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
@@ -0,0 +1,199 @@
+from sqlalchemy import update, or_
+from typing import Callable, Dict, List
+import os
+import time
+import atexit
+import threading
+import logging
+from models import SessionLocal, MessageLog
+from rollups import apply_delivery_failures, FAILED_STATUSES
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Buffer settings
+DELIVERY_STATUS_FLUSH_SIDS = int(os.getenv("DELIVERY_STATUS_FLUSH_SIDS", "1000"))
+DELIVERY_STATUS_FLUSH_INTERVAL_MS = int(os.getenv("DELIVERY_STATUS_FLUSH_INTERVAL_MS", "2000"))
+DELIVERY_STATUS_MAX_PENDING = int(os.getenv("DELIVERY_STATUS_MAX_PENDING", "50000"))
+# Callbacks can beat their MessageLog row to the database; unmatched SIDs are retried this long
+DELIVERY_STATUS_RETRY_SECONDS = float(os.getenv("DELIVERY_STATUS_RETRY_SECONDS", "120"))
+DELIVERY_STATUS_UPDATE_CHUNK = 500
+
+# Twilio message lifecycle order. A status never replaces one of equal or higher rank, so
+# out-of-order callbacks cannot move a message backwards.
+STATUS_RANK = {
+    "accepted": 0,
+    "scheduled": 0,
+    "queued": 1,
+    "sending": 2,
+    "sent": 3,
+    "delivered": 4,
+    "undelivered": 4,
+    "failed": 4,
+    "canceled": 4,
+    "read": 5,
+}
+# Rows are written as "sent" once Twilio accepts them; earlier statuses cannot change them
+MIN_USEFUL_RANK = STATUS_RANK["sent"] + 1
+
+messages = MessageLog.__table__
+
+class DeliveryStatusBuffer:
+    """
+    Per-process buffer of Twilio status callbacks, applied as bulk UPDATEs
+    - Keeps only the highest-ranked status per SID, so a SID's queued/sent/delivered
+      callbacks within one flush cost at most one row update
+    - Flushes when N SIDs are pending or every T ms; one UPDATE per status per chunk of SIDs
+    - Callbacks at or below "sent" are counted and dropped without touching the database
+    - Failed/undelivered reports move the send from sent to failed in the daily rollups
+    """
+    
+    def __init__(self, session_factory: Callable, flush_sids: int, flush_interval_ms: int,
+                 max_pending: int, retry_seconds: float):
+        self.session_factory = session_factory
+        self.flush_sids = flush_sids
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_pending = max(max_pending, flush_sids)
+        self.retry_seconds = retry_seconds
+        
+        self._pending: Dict[str, tuple] = {}  # sid -> (status, first_seen)
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        
+        self.flushes = 0
+        self.rows_updated = 0
+    
+    def _ensure_flusher(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Forked API workers inherit the object but not the thread or the parent's SIDs
+            self._pending = {}
+            self._pid = pid
+            self._thread = None
+        
+        if self._thread is None or not self._thread.is_alive():
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="delivery-status-flusher", daemon=True)
+            self._thread.start()
+    
+    def _merge(self, sid: str, status: str, first_seen: float):
+        current = self._pending.get(sid)
+        if current is None:
+            self._pending[sid] = (status, first_seen)
+        elif STATUS_RANK[status] >= STATUS_RANK[current[0]]:
+            self._pending[sid] = (status, min(first_seen, current[1]))
+    
+    def add(self, sid: str, status: str) -> bool:
+        """Queue a callback; returns False if it was dropped"""
+        status = (status or "").lower()
+        metrics.DELIVERY_STATUS_CALLBACKS.labels(status if status in STATUS_RANK else "unknown").inc()
+        if STATUS_RANK.get(status, -1) < MIN_USEFUL_RANK:
+            return False
+        
+        with self._cond:
+            self._ensure_flusher()
+            if sid not in self._pending and len(self._pending) >= self.max_pending:
+                self._cond.notify_all()
+                logger.error(f"Delivery status buffer full, dropping {status} for {sid}")
+                return False
+            self._merge(sid, status, time.monotonic())
+            if len(self._pending) >= self.flush_sids:
+                self._cond.notify_all()
+        return True
+    
+    def _take(self) -> Dict[str, tuple]:
+        pending, self._pending = self._pending, {}
+        return pending
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.flush_sids and not self._closed:
+                    self._cond.wait(timeout=self.flush_interval)
+                if self._closed:
+                    return
+                pending = self._take()
+            if pending and not self._write(pending):
+                time.sleep(self.flush_interval)  # Back off while the database is failing
+    
+    def _write(self, pending: Dict[str, tuple]) -> bool:
+        by_status: Dict[str, List[str]] = {}
+        for sid, (status, _) in pending.items():
+            by_status.setdefault(status, []).append(sid)
+        
+        with self._write_lock:
+            db = self.session_factory()
+            try:
+                matched = set()
+                failures = []
+                for status, sids in by_status.items():
+                    not_below = [name for name, rank in STATUS_RANK.items() if rank >= STATUS_RANK[status]]
+                    for i in range(0, len(sids), DELIVERY_STATUS_UPDATE_CHUNK):
+                        rows = db.execute(
+                            update(messages).where(
+                                messages.c.message_sid.in_(sids[i:i + DELIVERY_STATUS_UPDATE_CHUNK]),
+                                or_(messages.c.status == None, messages.c.status.notin_(not_below))
+                            ).values(status=status).returning(
+                                messages.c.message_sid, messages.c.phone, messages.c.sent_at, messages.c.message_type
+                            )
+                        ).all()
+                        matched.update(row.message_sid for row in rows)
+                        if status in FAILED_STATUSES:
+                            failures.extend(dict(row._mapping) for row in rows)
+                
+                # Rollups move in the same transaction as the statuses they count
+                apply_delivery_failures(db, failures)
+                with metrics.timed(metrics.DB_COMMIT_SECONDS, "delivery_status_flush"):
+                    db.commit()
+                self.flushes += 1
+                self.rows_updated += len(matched)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error applying {len(pending)} delivery statuses: {str(e)}")
+                self._requeue(pending)
+                return False
+            finally:
+                db.close()
+        
+        # SIDs whose log row is still in a worker's buffer get another try on a later flush
+        cutoff = time.monotonic() - self.retry_seconds
+        self._requeue({
+            sid: entry for sid, entry in pending.items()
+            if sid not in matched and entry[1] > cutoff
+        })
+        return True
+    
+    def _requeue(self, pending: Dict[str, tuple]):
+        with self._cond:
+            for sid, (status, first_seen) in pending.items():
+                if sid in self._pending or len(self._pending) < self.max_pending:
+                    self._merge(sid, status, first_seen)
+    
+    def flush(self):
+        """Apply everything queued so far on the calling thread"""
+        with self._cond:
+            pending = self._take()
+        if pending:
+            self._write(pending)
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 2)
+        self.flush()
+
+# Global instance
+delivery_status_buffer = DeliveryStatusBuffer(
+    SessionLocal,
+    flush_sids=DELIVERY_STATUS_FLUSH_SIDS,
+    flush_interval_ms=DELIVERY_STATUS_FLUSH_INTERVAL_MS,
+    max_pending=DELIVERY_STATUS_MAX_PENDING,
+    retry_seconds=DELIVERY_STATUS_RETRY_SECONDS
+)
+
+atexit.register(delivery_status_buffer.close)
@@ -0,0 +1,74 @@
+"""
+Sharded schedule dispatcher
+- Run one or more instances: python dispatcher.py
+- Each instance holds Redis leases on a share of the DISPATCH_SHARDS shards and only
+  dispatches schedules in those shards; instances joining or leaving rebalance within
+  a few renewals, and a crashed instance's shards are taken over once its leases expire
+- Leases are renewed from a background thread, so a slow scan cannot let them lapse
+"""
+import logging
+import os
+import signal
+import socket
+import time
+import uuid
+from dotenv import load_dotenv
+from redis_utils import redis_client
+from sharding import ShardCoordinator, RedisLeaseStore, DISPATCH_SHARDS, DISPATCH_LEASE_SECONDS, DISPATCH_RENEW_SECONDS
+from models import create_tables
+from scheduler import dispatch_due
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Seconds between due-row scans
+DISPATCH_TICK_SECONDS = float(os.getenv("DISPATCH_TICK_SECONDS", "5"))
+
+class Dispatcher:
+    """Dispatches the shards whose leases the coordinator currently holds on every tick"""
+    
+    def __init__(self, coordinator: ShardCoordinator, tick_seconds: float, renew_seconds: float):
+        self.coordinator = coordinator
+        self.tick_seconds = tick_seconds
+        self.renew_seconds = renew_seconds
+        self.running = True
+    
+    def tick(self) -> dict:
+        shards = self.coordinator.held()
+        if not shards:
+            return {"success": True, "dispatched": 0, "skipped": 0}
+        return dispatch_due(shards, holds=self.coordinator.holds)
+    
+    def run(self):
+        logger.info("Dispatcher %s started", self.coordinator.node_id)
+        self.coordinator.start(self.renew_seconds)
+        while self.running:
+            started = time.monotonic()
+            result = self.tick()
+            if result.get("dispatched"):
+                logger.info("Dispatched %s reminders from %s shards", result["dispatched"], len(self.coordinator.owned))
+            time.sleep(max(0.0, self.tick_seconds - (time.monotonic() - started)))
+        self.coordinator.stop()
+        logger.info("Dispatcher %s stopped", self.coordinator.node_id)
+    
+    def stop(self, *args):
+        self.running = False
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        # The dispatcher can start before the API has upgraded an older schema
+        create_tables()
+    except Exception as e:
+        logger.warning("Schema upgrade failed, assuming another process ran it: %s", e)
+    node_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+    dispatcher = Dispatcher(
+        ShardCoordinator(RedisLeaseStore(redis_client), node_id, DISPATCH_SHARDS, DISPATCH_LEASE_SECONDS),
+        DISPATCH_TICK_SECONDS,
+        DISPATCH_RENEW_SECONDS
+    )
+    # Hand shards over immediately on shutdown instead of waiting for the leases to expire
+    signal.signal(signal.SIGTERM, dispatcher.stop)
+    signal.signal(signal.SIGINT, dispatcher.stop)
+    dispatcher.run()
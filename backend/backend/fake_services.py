@@ -0,0 +1,217 @@
+"""
+Local stand-ins for the OpenAI chat-completions and Twilio Messages APIs, for benchmarks
+- Latency is base ± uniform jitter per request; errors are injected at a fixed rate
+- Run standalone to point a full stack at them:
+  python fake_services.py --openai-port 8101 --twilio-port 8102
+  OPENAI_BASE_URL=http://127.0.0.1:8101/v1 TWILIO_API_BASE_URL=http://127.0.0.1:8102
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+import argparse
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+class Behavior:
+    """Latency and error injection settings shared by a fake server's handlers"""
+    
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0.0,
+                 error_status: int = 500):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+    
+    def wait(self):
+        delay = self.latency_ms + random.uniform(-self.jitter_ms, self.jitter_ms)
+        if delay > 0:
+            time.sleep(delay / 1000)
+    
+    def fails(self) -> bool:
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+class FakeServer:
+    """Threaded HTTP server with request and error counters"""
+    
+    handler_class = None
+    
+    def __init__(self, behavior: Behavior, port: int = 0, host: str = "127.0.0.1"):
+        self.behavior = behavior
+        self.requests = 0
+        self.errors = 0
+        self.arrivals = []  # perf_counter() of each successful request
+        self._lock = threading.Lock()
+        
+        handler = type("Handler", (self.handler_class,), {"server_state": self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+    
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{'127.0.0.1' if host == '0.0.0.0' else host}:{port}"
+    
+    def count(self, error: bool):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.arrivals.append(time.perf_counter())
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+    
+    def start(self) -> "FakeServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+    
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real APIs
+    server_state: FakeServer = None
+    
+    def log_message(self, format, *args):
+        pass
+    
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+    
+    def _reply(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class _OpenAIHandler(_JSONHandler):
+    _counter = itertools.count(1)
+    
+    def do_POST(self):
+        request = json.loads(self._body() or b"{}")
+        state = self.server_state
+        state.behavior.wait()
+        
+        if not self.path.endswith("/chat/completions"):
+            state.count(True)
+            return self._reply(404, {"error": {"message": "Unknown path", "type": "invalid_request_error"}})
+        if state.behavior.fails():
+            state.count(True)
+            return self._reply(state.behavior.error_status, {
+                "error": {"message": "Injected failure", "type": "server_error"}
+            })
+        
+        number = next(self._counter)
+        if (request.get("response_format") or {}).get("type") == "json_object":
+            # Batch generation: honor the requested count
+            prompt = request["messages"][-1]["content"]
+            match = re.search(r"Write (\d+) distinct", prompt)
+            count = int(match.group(1)) if match else 5
+            content = json.dumps({"messages": [f"Stay on track today, step {number}-{i}! 💪" for i in range(count)]})
+        else:
+            content = f"Keep going, you're doing great! ({number})"
+        
+        state.count(False)
+        self._reply(200, {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": 40,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": 40 + len(content) // 4
+            }
+        })
+
+class _TwilioHandler(_JSONHandler):
+    
+    def do_POST(self):
+        form = {key: values[0] for key, values in parse_qs(self._body().decode("utf-8")).items()}
+        state = self.server_state
+        state.behavior.wait()
+        
+        if not re.match(r"^/2010-04-01/Accounts/[^/]+/Messages\.json$", self.path):
+            state.count(True)
+            return self._reply(404, {"code": 20404, "message": "Not found", "status": 404})
+        if state.behavior.fails():
+            state.count(True)
+            status = state.behavior.error_status
+            return self._reply(status, {
+                "code": 20429 if status == 429 else 20500,
+                "message": "Injected failure",
+                "more_info": "https://www.twilio.com/docs/errors",
+                "status": status
+            })
+        
+        state.count(False)
+        self._reply(201, {
+            "sid": f"SM{uuid.uuid4().hex}",
+            "status": "queued",
+            "to": form.get("To"),
+            "from": form.get("From"),
+            "messaging_service_sid": form.get("MessagingServiceSid"),
+            "body": form.get("Body"),
+            "num_segments": "1",
+            "direction": "outbound-api",
+            "date_created": time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())
+        })
+
+class FakeOpenAI(FakeServer):
+    handler_class = _OpenAIHandler
+    
+    @property
+    def api_base(self) -> str:
+        return f"{self.base_url}/v1"
+
+class FakeTwilio(FakeServer):
+    handler_class = _TwilioHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run fake OpenAI and Twilio APIs")
+    parser.add_argument("--host", default="127.0.0.1", help="0.0.0.0 to reach them from containers")
+    parser.add_argument("--openai-port", type=int, default=8101)
+    parser.add_argument("--twilio-port", type=int, default=8102)
+    parser.add_argument("--openai-latency-ms", type=float, default=300)
+    parser.add_argument("--openai-jitter-ms", type=float, default=100)
+    parser.add_argument("--openai-error-rate", type=float, default=0.0)
+    parser.add_argument("--twilio-latency-ms", type=float, default=100)
+    parser.add_argument("--twilio-jitter-ms", type=float, default=30)
+    parser.add_argument("--twilio-error-rate", type=float, default=0.0)
+    parser.add_argument("--twilio-error-status", type=int, default=429)
+    args = parser.parse_args()
+    
+    openai_server = FakeOpenAI(
+        Behavior(args.openai_latency_ms, args.openai_jitter_ms, args.openai_error_rate),
+        port=args.openai_port,
+        host=args.host
+    ).start()
+    twilio_server = FakeTwilio(
+        Behavior(args.twilio_latency_ms, args.twilio_jitter_ms, args.twilio_error_rate, args.twilio_error_status),
+        port=args.twilio_port,
+        host=args.host
+    ).start()
+    print(f"OPENAI_BASE_URL={openai_server.api_base}")
+    print(f"TWILIO_API_BASE_URL={twilio_server.base_url}")
+    
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        openai_server.stop()
+        twilio_server.stop()
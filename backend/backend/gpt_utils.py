@@ -1,9 +1,28 @@
 import openai
+import httpx
 import os
+import json
+import time
+import hashlib
+import random
+import bisect
+import itertools
+import string
+import threading
+import unicodedata
+from contextlib import contextmanager, asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
 from pathlib import Path
 import logging
+import asyncio
+from collections import OrderedDict, deque
+from sqlalchemy import select
+from redis_utils import redis_client
+from circuit_breaker import CircuitBreaker, CircuitOpenError, LatencyTracker
+import metrics
+from models import SessionLocal, AsyncSessionLocal, UserReply
 
 # Basic logging setup just for errors
 logging.basicConfig(level=logging.ERROR)
@@ -29,90 +48,978 @@ if not api_key:
 # Set up OpenAI client
 openai.api_key = api_key
 
+# Shared client settings
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "16"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "1"))
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None  # e.g. a local stand-in for benchmarks
+
+# Latency budgets per call type (seconds)
+LLM_CALL_TIMEOUTS = {
+    "message": float(os.getenv("OPENAI_MESSAGE_TIMEOUT", "10")),
+    "batch": float(os.getenv("OPENAI_BATCH_TIMEOUT", "45")),
+    "reply": float(os.getenv("OPENAI_REPLY_TIMEOUT", "6")),
+}
+
+# Circuit breaker and hedging settings
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_SLOW_CALL_RATIO = float(os.getenv("CIRCUIT_SLOW_CALL_RATIO", "0.5"))  # of the call's timeout
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv("CIRCUIT_COOLDOWN_SECONDS", "30"))
+OPENAI_HEDGE_ENABLED = os.getenv("OPENAI_HEDGE_ENABLED", "false").lower() == "true"
+OPENAI_HEDGE_PERCENTILE = float(os.getenv("OPENAI_HEDGE_PERCENTILE", "95"))
+
+# Message pool settings
+MESSAGE_POOL_TARGET_SIZE = int(os.getenv("MESSAGE_POOL_TARGET_SIZE", "200"))
+MESSAGE_POOL_LOW_WATER = int(os.getenv("MESSAGE_POOL_LOW_WATER", "50"))
+MESSAGE_POOL_TTL_SECONDS = int(os.getenv("MESSAGE_POOL_TTL_SECONDS", str(24 * 3600)))
+MESSAGE_POOL_SEEN_TTL_SECONDS = int(os.getenv("MESSAGE_POOL_SEEN_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# Conversation context settings
+CONVERSATION_CONTEXT_EXCHANGES = int(os.getenv("CONVERSATION_CONTEXT_EXCHANGES", "5"))
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv("CONVERSATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+# History is re-read from UserReply this long after it was loaded, so exchanges stored by other
+# API processes show up within the TTL
+CONVERSATION_CACHE_TTL_SECONDS = float(os.getenv("CONVERSATION_CACHE_TTL_SECONDS", "60"))
+
+# Reply cache settings
+REPLY_CACHE_MAX_KEYS = int(os.getenv("REPLY_CACHE_MAX_KEYS", "5000"))
+REPLY_CACHE_TTL_SECONDS = int(os.getenv("REPLY_CACHE_TTL_SECONDS", str(6 * 3600)))
+REPLY_CACHE_VARIANTS = int(os.getenv("REPLY_CACHE_VARIANTS", "3"))
+REPLY_CACHE_INTENTS = os.getenv("REPLY_CACHE_INTENTS", "true").lower() == "true"
+
+# Batch generation settings
+SMS_MAX_LENGTH = 160
+# Generated messages shorter than this are fragments, not reminders
+SMS_MIN_LENGTH = 10
+SMS_MIN_WORDS = 2
+GENERATION_BATCH_SIZE = int(os.getenv("GENERATION_BATCH_SIZE", "25"))
+
 class MessageTemplates:
     """
     Pre-defined message templates
     - Different styles
     - Different tones
     - Different languages
+    - Slots: {name}, {streak}, {time_of_day}; rendered length is checked against
+      SMS_MAX_LENGTH when templates are loaded
+    - Weighted random selection in O(log n) per message
+    """
+    
+    # Longest value each slot may render to, used for the load-time length check
+    SLOT_MAX_LENGTHS = {"name": 20, "streak": 5, "time_of_day": 9}
+    
+    TEMPLATES = [
+        # (message_type, tone, language, weight, text); a template is eligible only when all its slots are supplied
+        ("meal", "energetic", "en", 3, "🍎 Time to fuel up with something nutritious. Your body will thank you!"),
+        ("meal", "energetic", "en", 2, "🍎 Hey {name}! Time to fuel up with something nutritious. Your body will thank you!"),
+        ("meal", "energetic", "en", 2, "🥗 A balanced meal this {time_of_day} keeps your energy high. Let's eat well!"),
+        ("meal", "energetic", "en", 2, "🔥 {streak} days of healthy meals in a row! Keep that streak alive!"),
+        ("meal", "gentle", "en", 3, "🍽️ A gentle reminder to sit down for a nourishing meal. You deserve it."),
+        ("meal", "gentle", "en", 2, "🍽️ Hi {name}, a gentle reminder to sit down for a nourishing meal. You deserve it."),
+        ("meal", "gentle", "en", 1, "🌱 Take a moment this {time_of_day} to enjoy a wholesome meal. Small steps add up."),
+        ("meal", "energetic", "es", 2, "🍎 ¡Hora de una comida nutritiva! Tu cuerpo te lo agradecerá."),
+        ("meal", "energetic", "es", 2, "🍎 ¡Hola {name}! Hora de una comida nutritiva. ¡Tu cuerpo te lo agradecerá!"),
+        ("meal", "gentle", "es", 2, "🍽️ Un recordatorio amable: date un momento para una comida saludable."),
+        ("workout", "energetic", "en", 3, "💪 Time to move! Every rep brings you closer to your goals!"),
+        ("workout", "energetic", "en", 2, "💪 Let's go, {name}! Time to move. Every rep brings you closer to your goals!"),
+        ("workout", "energetic", "en", 2, "🏃 This {time_of_day} is yours. Lace up and show up for yourself!"),
+        ("workout", "energetic", "en", 2, "🔥 {streak}-day workout streak! Don't break the chain today!"),
+        ("workout", "gentle", "en", 3, "🧘 Even a short session counts. Move your body in a way that feels good."),
+        ("workout", "gentle", "en", 2, "🧘 Hi {name}, even a short session counts. Move your body in a way that feels good."),
+        ("workout", "gentle", "en", 1, "🌤️ A little movement this {time_of_day} goes a long way. You've got this."),
+        ("workout", "energetic", "es", 2, "💪 ¡Vamos! Hora de entrenar. ¡Cada repetición cuenta!"),
+        ("workout", "energetic", "es", 2, "💪 ¡Vamos, {name}! Hora de entrenar. ¡Cada repetición cuenta!"),
+        ("workout", "gentle", "es", 2, "🧘 Incluso una sesión corta cuenta. Mueve tu cuerpo a tu ritmo."),
+    ]
+    
+    def __init__(self, templates: Optional[List[tuple]] = None):
+        self._tables: Dict[tuple, Dict[frozenset, tuple]] = {}
+        self.tones: set = set()
+        self.languages: set = set()
+        self.load(templates if templates is not None else self.TEMPLATES)
+    
+    @classmethod
+    def _compile(cls, text: str) -> frozenset:
+        """Validate a template's slots and worst-case length; returns the slot names it uses"""
+        slots = {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+        unknown = slots - set(cls.SLOT_MAX_LENGTHS)
+        if unknown:
+            raise ValueError(f"Unknown template slots {sorted(unknown)} in: {text}")
+        
+        longest = text.format(**{slot: "x" * cls.SLOT_MAX_LENGTHS[slot] for slot in slots})
+        if len(longest) > SMS_MAX_LENGTH:
+            raise ValueError(f"Template can render to {len(longest)} characters (max {SMS_MAX_LENGTH}): {text}")
+        return frozenset(slots)
+    
+    def load(self, templates: List[tuple]):
+        """Compile templates into cumulative-weight tables keyed by (message_type, tone, language)"""
+        grouped: Dict[tuple, list] = {}
+        self.tones = {tone for _, tone, _, _, _ in templates}
+        self.languages = {language for _, _, language, _, _ in templates}
+        for message_type, tone, language, weight, text in templates:
+            slots = self._compile(text)
+            for key in ((message_type, tone, language), (message_type, None, language)):
+                grouped.setdefault(key, []).append((weight, text, slots))
+        
+        # One table per combination of supplied slots, so render() never filters at send time
+        slot_sets = [
+            frozenset(combo)
+            for size in range(len(self.SLOT_MAX_LENGTHS) + 1)
+            for combo in itertools.combinations(sorted(self.SLOT_MAX_LENGTHS), size)
+        ]
+        self._tables = {
+            key: {
+                supplied: self._cumulative([entry for entry in entries if entry[2] <= supplied])
+                for supplied in slot_sets
+            }
+            for key, entries in grouped.items()
+        }
+    
+    @staticmethod
+    def _cumulative(entries: list) -> tuple:
+        totals, texts, running = [], [], 0
+        for weight, text, _ in entries:
+            running += weight
+            totals.append(running)
+            texts.append(text)
+        return totals, texts
+    
+    @staticmethod
+    def time_of_day(hour: int) -> str:
+        if 5 <= hour < 12:
+            return "morning"
+        if 12 <= hour < 17:
+            return "afternoon"
+        if 17 <= hour < 22:
+            return "evening"
+        return "night"
+    
+    def render(self, message_type: str, tone: Optional[str] = None, language: str = "en", **slots) -> Optional[str]:
+        """Pick a weighted random template and fill its slots; None if nothing matches"""
+        table = (
+            self._tables.get((message_type, tone, language))
+            or self._tables.get((message_type, None, language))
+            or self._tables.get((message_type, None, "en"))
+        )
+        if not table:
+            return None
+        
+        values = {slot: value for slot, value in slots.items() if value is not None and slot in self.SLOT_MAX_LENGTHS}
+        totals, texts = table[frozenset(values)]
+        if not totals:
+            return None
+        
+        text = texts[bisect.bisect_right(totals, random.random() * totals[-1])]
+        return text.format(**values)
+
+class OpenAIClientManager:
+    """
+    Process-wide OpenAI clients over keep-alive connection pools
+    - One sync client (Celery worker) and one async client (FastAPI) per process
+    - Semaphores cap the number of in-flight LLM calls
+    - Counters show how often pooled connections are reused
+    """
+    
+    def __init__(self, max_connections: int, max_keepalive_connections: int,
+                 keepalive_expiry: float, max_in_flight: int):
+        limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.client = openai.OpenAI(
+            api_key=api_key,
+            base_url=OPENAI_BASE_URL,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=httpx.Client(limits=limits, event_hooks={"request": [self._on_request]})
+        )
+        self.async_client = openai.AsyncOpenAI(
+            api_key=api_key,
+            base_url=OPENAI_BASE_URL,
+            max_retries=OPENAI_MAX_RETRIES,
+            http_client=httpx.AsyncClient(limits=limits, event_hooks={"request": [self._on_async_request]})
+        )
+        self.max_in_flight = max_in_flight
+        self._sync_slots = threading.BoundedSemaphore(max_in_flight)
+        self._async_slots = asyncio.Semaphore(max_in_flight)
+        
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+    
+    # httpcore reports "connection.connect_tcp.complete" only when it opens a new connection
+    def _trace(self, event_name: str, info: dict):
+        if event_name == "connection.connect_tcp.complete":
+            with self._stats_lock:
+                self.connections_opened += 1
+    
+    async def _atrace(self, event_name: str, info: dict):
+        self._trace(event_name, info)
+    
+    def _on_request(self, request: httpx.Request):
+        request.extensions["trace"] = self._trace
+        with self._stats_lock:
+            self.requests += 1
+    
+    async def _on_async_request(self, request: httpx.Request):
+        request.extensions["trace"] = self._atrace
+        with self._stats_lock:
+            self.requests += 1
+    
+    def _enter(self):
+        with self._stats_lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+    
+    def _exit(self):
+        with self._stats_lock:
+            self.in_flight -= 1
+    
+    @contextmanager
+    def limit(self):
+        """Borrow the sync client once an in-flight slot is free"""
+        with self._sync_slots:
+            self._enter()
+            try:
+                yield self.client
+            finally:
+                self._exit()
+    
+    @asynccontextmanager
+    async def alimit(self):
+        """Borrow the async client once an in-flight slot is free"""
+        async with self._async_slots:
+            self._enter()
+            try:
+                yield self.async_client
+            finally:
+                self._exit()
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            reused = max(0, self.requests - self.connections_opened)
+            return {
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": reused,
+                "reuse_ratio": round(reused / self.requests, 4) if self.requests else 0.0,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "max_in_flight": self.max_in_flight
+            }
+
+# One pooled client manager per process, shared by every generator
+openai_clients = OpenAIClientManager(
+    max_connections=OPENAI_MAX_CONNECTIONS,
+    max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    max_in_flight=OPENAI_MAX_IN_FLIGHT
+)
+
+class MessagePool:
+    """
+    Redis-backed pool of pre-generated motivational messages
+    - One list per message_type, popped in O(1) on the send path
+    - Entries older than the TTL are discarded when popped
+    - Recently sent texts are remembered per phone to avoid repeats
     """
-    # Implementation needed
+    
+    def __init__(self, client, target_size: int, low_water: int, ttl_seconds: int,
+                 seen_ttl_seconds: int, max_pop_attempts: int = 5):
+        self.redis = client
+        self.target_size = target_size
+        self.low_water = low_water
+        self.ttl_seconds = ttl_seconds
+        self.seen_ttl_seconds = seen_ttl_seconds
+        self.max_pop_attempts = max_pop_attempts
+    
+    def _key(self, message_type: str) -> str:
+        return f"message_pool:{message_type}"
+    
+    def _seen_key(self, phone: str) -> str:
+        return f"message_pool:seen:{phone}"
+    
+    @staticmethod
+    def _digest(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+    
+    def size(self, message_type: str) -> int:
+        return self.redis.llen(self._key(message_type))
+    
+    def needs_refill(self, message_type: str) -> bool:
+        return self.size(message_type) < self.low_water
+    
+    def refill_count(self, message_type: str) -> int:
+        return max(0, self.target_size - self.size(message_type))
+    
+    def acquire_refill_lock(self, message_type: str, timeout: int = 120) -> bool:
+        """Ensure only one refill per message_type is in flight"""
+        return bool(self.redis.set(f"{self._key(message_type)}:refilling", "1", nx=True, ex=timeout))
+    
+    def release_refill_lock(self, message_type: str):
+        self.redis.delete(f"{self._key(message_type)}:refilling")
+    
+    def add(self, message_type: str, messages: List[str]) -> int:
+        """Append freshly generated messages to the pool"""
+        if not messages:
+            return 0
+        now = time.time()
+        entries = [json.dumps({"text": text, "created_at": now}) for text in messages]
+        self.redis.rpush(self._key(message_type), *entries)
+        return len(entries)
+    
+    def pop(self, message_type: str, phone: Optional[str] = None) -> Optional[str]:
+        """Pop a fresh message this phone has not recently received, or None"""
+        key = self._key(message_type)
+        seen_key = self._seen_key(phone) if phone else None
+        skipped = []
+        message = None
+        
+        for _ in range(self.max_pop_attempts):
+            raw = self.redis.lpop(key)
+            if raw is None:
+                break
+            
+            entry = json.loads(raw)
+            if time.time() - entry["created_at"] > self.ttl_seconds:
+                continue  # Expired, drop it
+            
+            if seen_key:
+                digest = self._digest(entry["text"])
+                if self.redis.sismember(seen_key, digest):
+                    skipped.append(raw)
+                    continue
+                self.redis.sadd(seen_key, digest)
+                self.redis.expire(seen_key, self.seen_ttl_seconds)
+            
+            message = entry["text"]
+            break
+        
+        # Messages this phone already saw go back for other recipients
+        if skipped:
+            self.redis.rpush(key, *skipped)
+        
+        return message
+
+class ConversationCache:
+    """
+    In-memory ring buffer of the last K exchanges per phone
+    - LRU eviction once the approximate total size exceeds max_bytes
+    - Warmed from UserReply on a miss, appended to whenever this process stores a reply
+    - Entries expire ttl_seconds after they were loaded, bounding how stale a phone's
+      history can be when other processes store its replies
+    """
+    
+    ENTRY_OVERHEAD_BYTES = 64
+    
+    def __init__(self, max_exchanges: int, max_bytes: int, ttl_seconds: float):
+        self.max_exchanges = max_exchanges
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, deque]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def _size(self, exchanges: deque) -> int:
+        return sum(
+            len(incoming.encode("utf-8")) + len(response.encode("utf-8")) + self.ENTRY_OVERHEAD_BYTES
+            for incoming, response in exchanges
+        )
+    
+    def _store(self, phone: str, exchanges: deque):
+        self.total_bytes -= self._sizes.get(phone, 0)
+        self._entries[phone] = exchanges
+        self._entries.move_to_end(phone)
+        self._sizes[phone] = self._size(exchanges)
+        self.total_bytes += self._sizes[phone]
+        
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            evicted, _ = self._entries.popitem(last=False)
+            self.total_bytes -= self._sizes.pop(evicted)
+            self._loaded_at.pop(evicted, None)
+    
+    def _drop(self, phone: str):
+        del self._entries[phone]
+        self.total_bytes -= self._sizes.pop(phone)
+        self._loaded_at.pop(phone, None)
+    
+    def get(self, phone: str) -> Optional[List[tuple]]:
+        with self._lock:
+            exchanges = self._entries.get(phone)
+            if exchanges is not None and time.monotonic() - self._loaded_at[phone] > self.ttl_seconds:
+                self._drop(phone)
+                exchanges = None
+            if exchanges is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(phone)
+            self.hits += 1
+            return list(exchanges)
+    
+    def put(self, phone: str, exchanges: List[tuple]):
+        """Replace the cached history for phone (oldest first)"""
+        with self._lock:
+            self._store(phone, deque(exchanges, maxlen=self.max_exchanges))
+            self._loaded_at[phone] = time.monotonic()
+    
+    def append(self, phone: str, incoming_message: str, bot_response: str):
+        """Record a new exchange; phones not cached yet are warmed from the DB on next read"""
+        with self._lock:
+            exchanges = self._entries.get(phone)
+            if exchanges is None:
+                return
+            exchanges.append((incoming_message, bot_response))
+            self._store(phone, exchanges)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "phones": len(self._entries),
+                "total_bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+class ReplyCache:
+    """
+    Cache of replies to short, common texts ("done", "thanks!", "ok 👍")
+    - Only known intent phrases and texts made of whitelisted ack emoji are cacheable;
+      anything else may be personal and goes to the model with the user's history
+    - Any other emoji ("😭", "🤕") or a question mark makes a text uncacheable, so a
+      distressed or confused user never gets the canned ack
+    - Serves only once a key holds several variants, rotating between them
+    - TTL per key, LRU eviction beyond max_keys, hit/miss counters
+    """
+    
+    INTENTS = {
+        "done": {"done", "did it", "finished", "completed", "all done", "just did it", "crushed it"},
+        "thanks": {"thanks", "thank you", "thx", "ty", "thank u", "thanks so much"},
+        "ack": {"ok", "okay", "k", "kk", "got it", "sure", "will do", "yes", "yep", "cool"},
+        "skipped": {"skipped", "skipped today", "skip", "not today", "missed it", "didnt"}
+    }
+    ACK_EMOJI = {"👍", "👌", "✅", "☑", "✔", "💪", "🙌", "👏", "🔥", "💯", "🎉", "🥳", "🙂", "😊", "😀", "😃", "😄", "😁"}
+    
+    def __init__(self, max_keys: int, ttl_seconds: int, variants: int, use_intents: bool):
+        self.max_keys = max_keys
+        self.ttl_seconds = ttl_seconds
+        self.variants = variants
+        self.use_intents = use_intents
+        self._phrase_intents = {phrase: intent for intent, phrases in self.INTENTS.items() for phrase in phrases}
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Case-fold and keep only letters, digits and single spaces (drops punctuation and emoji)"""
+        text = unicodedata.normalize("NFKC", text).casefold().replace("'", "")
+        kept = "".join(c if unicodedata.category(c)[0] in ("L", "N") else " " for c in text)
+        return " ".join(kept.split())
+    
+    def _ack_emoji_only(self, text: str) -> Optional[bool]:
+        """None if text has no emoji, else whether every emoji is a whitelisted ack"""
+        # Skin tones (Sk) and variation selectors/joiners (M, C) only modify the emoji they follow
+        emoji = [c for c in unicodedata.normalize("NFKC", text) if unicodedata.category(c) in ("So", "Sm")]
+        if not emoji:
+            return None
+        return all(c in self.ACK_EMOJI for c in emoji)
+    
+    def key_for(self, text: str) -> Optional[str]:
+        """Cache key for text, or None if it is not one of the common generic replies"""
+        if "?" in text:
+            return None
+        acks = self._ack_emoji_only(text)
+        if acks is False:
+            return None
+        normalized = self.normalize(text)
+        if not normalized:
+            # Ack emoji only; bare punctuation ("...", "!") is not an ack
+            return "intent:ack" if acks else None
+        if self.use_intents and normalized in self._phrase_intents:
+            return f"intent:{self._phrase_intents[normalized]}"
+        return None
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry["created_at"] > self.ttl_seconds:
+                del self._entries[key]
+                entry = None
+            
+            if not entry or len(entry["variants"]) < self.variants:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            
+            # Never repeat the variant served last time, unless it is the only one
+            choices = [i for i in range(len(entry["variants"])) if i != entry["last"]]
+            entry["last"] = random.choice(choices) if choices else 0
+            return entry["variants"][entry["last"]]
+    
+    def add(self, key: str, reply: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = {"variants": [], "last": -1, "created_at": time.monotonic()}
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            
+            if reply not in entry["variants"] and len(entry["variants"]) < self.variants:
+                entry["variants"].append(reply)
+            
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+    
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "keys": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+def _history_query(phone: str, limit: int):
+    return select(UserReply.incoming_message, UserReply.bot_response).where(
+        UserReply.phone == phone
+    ).order_by(UserReply.id.desc()).limit(limit)
 
 class GPTMessageGenerator:
+    PROMPTS = {
+        "meal": """
+        Generate a short, encouraging SMS message (max 160 characters) to remind someone 
+        about eating a healthy meal. Make it motivational, friendly, and actionable.
+        Examples: "🍎 Time to fuel your body with nutritious food! Your health goals are within reach!"
+        """,
+        "workout": """
+        Generate a short, encouraging SMS message (max 160 characters) to motivate someone 
+        to work out. Make it energetic, inspiring, and actionable.
+        Examples: "💪 Your body is capable of amazing things! Time to show it some love with a great workout!"
+        """
+    }
+    
+    REPLY_SYSTEM_PROMPT = """You are a supportive health and fitness coach. Respond to user messages 
+    with encouragement, practical advice, or motivation. Keep responses under 160 characters 
+    for SMS. Be empathetic and helpful."""
+    
+    FALLBACK_MESSAGES = {
+        "meal": "🍎 Time for a healthy meal! Fuel your body with good nutrition today!",
+        "workout": "💪 Time to move your body! Every workout brings you closer to your goals!"
+    }
+    
+    # Per-schedule generation modes
+    GENERATION_MODES = ("llm", "template", "hybrid")
+    
+    REPLY_FALLBACK = "I hear you! Remember, every small step counts. You've got this! 💪"
+    
     def __init__(self):
-        self.client = openai.OpenAI(api_key=api_key)
+        self.openai = openai_clients
+        self.templates = MessageTemplates()
+        self.pool = MessagePool(
+            redis_client,
+            target_size=MESSAGE_POOL_TARGET_SIZE,
+            low_water=MESSAGE_POOL_LOW_WATER,
+            ttl_seconds=MESSAGE_POOL_TTL_SECONDS,
+            seen_ttl_seconds=MESSAGE_POOL_SEEN_TTL_SECONDS
+        )
+        self.reply_cache = ReplyCache(
+            max_keys=REPLY_CACHE_MAX_KEYS,
+            ttl_seconds=REPLY_CACHE_TTL_SECONDS,
+            variants=REPLY_CACHE_VARIANTS,
+            use_intents=REPLY_CACHE_INTENTS
+        )
+        self.conversations = ConversationCache(
+            max_exchanges=CONVERSATION_CONTEXT_EXCHANGES,
+            max_bytes=CONVERSATION_CACHE_MAX_BYTES,
+            ttl_seconds=CONVERSATION_CACHE_TTL_SECONDS
+        )
+        
+        # One breaker and latency window per call type
+        self.breakers = {
+            call_type: CircuitBreaker(
+                call_type,
+                failure_threshold=CIRCUIT_FAILURE_THRESHOLD,
+                slow_call_seconds=timeout * CIRCUIT_SLOW_CALL_RATIO,
+                cooldown_seconds=CIRCUIT_COOLDOWN_SECONDS
+            )
+            for call_type, timeout in LLM_CALL_TIMEOUTS.items()
+        }
+        self.latency = {call_type: LatencyTracker() for call_type in LLM_CALL_TIMEOUTS}
+        self.fallbacks = {call_type: 0 for call_type in LLM_CALL_TIMEOUTS}
+        self._hedge_executor = ThreadPoolExecutor(max_workers=OPENAI_MAX_IN_FLIGHT, thread_name_prefix="llm-hedge")
+    
+    def _call(self, timeout: float, kwargs: dict):
+        with self.openai.limit() as client:
+            return client.chat.completions.create(timeout=timeout, **kwargs)
+    
+    async def _acall(self, timeout: float, kwargs: dict):
+        async with self.openai.alimit() as client:
+            return await client.chat.completions.create(timeout=timeout, **kwargs)
+    
+    def _hedge_delay(self, call_type: str) -> Optional[float]:
+        if not OPENAI_HEDGE_ENABLED:
+            return None
+        return self.latency[call_type].percentile(OPENAI_HEDGE_PERCENTILE)
+    
+    def _hedged_call(self, timeout: float, hedge_after: float, kwargs: dict):
+        """Fire a second request if the first is still running after hedge_after; first success wins"""
+        deadline = time.monotonic() + timeout
+        pending = {self._hedge_executor.submit(self._call, timeout, kwargs)}
+        done, _ = wait(pending, timeout=hedge_after)
+        if not done:
+            pending.add(self._hedge_executor.submit(self._call, max(0.1, timeout - hedge_after), kwargs))
+        
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError("LLM call exceeded its deadline")
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+    
+    async def _ahedged_call(self, timeout: float, hedge_after: float, kwargs: dict):
+        """Async variant of _hedged_call; the losing request is cancelled"""
+        first = asyncio.ensure_future(self._acall(timeout, kwargs))
+        done, _ = await asyncio.wait({first}, timeout=hedge_after)
+        if done:
+            return first.result()
+        
+        pending = {first, asyncio.ensure_future(self._acall(max(0.1, timeout - hedge_after), kwargs))}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise TimeoutError("LLM call exceeded its deadline")
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    def _complete(self, call_type: str, **kwargs):
+        """Chat completion under the call type's deadline and circuit breaker; raises on failure"""
+        breaker = self.breakers[call_type]
+        if not breaker.allow():
+            raise CircuitOpenError(f"{call_type} circuit is open")
+        
+        timeout = LLM_CALL_TIMEOUTS[call_type]
+        hedge_after = self._hedge_delay(call_type)
+        started = time.monotonic()
+        error = True
+        try:
+            if hedge_after is not None:
+                response = self._hedged_call(timeout, hedge_after, kwargs)
+            else:
+                response = self._call(timeout, kwargs)
+            error = False
+            return response
+        finally:
+            duration = time.monotonic() - started
+            breaker.record(duration, error)
+            metrics.LLM_CALL_SECONDS.labels(call_type, "error" if error else "ok").observe(duration)
+            if not error:
+                self.latency[call_type].add(duration)
+                metrics.record_tokens(call_type, response)
+    
+    async def _acomplete(self, call_type: str, **kwargs):
+        """Async variant of _complete"""
+        breaker = self.breakers[call_type]
+        if not breaker.allow():
+            raise CircuitOpenError(f"{call_type} circuit is open")
+        
+        timeout = LLM_CALL_TIMEOUTS[call_type]
+        hedge_after = self._hedge_delay(call_type)
+        started = time.monotonic()
+        error = True
+        try:
+            if hedge_after is not None:
+                response = await self._ahedged_call(timeout, hedge_after, kwargs)
+            else:
+                response = await self._acall(timeout, kwargs)
+            error = False
+            return response
+        finally:
+            duration = time.monotonic() - started
+            breaker.record(duration, error)
+            metrics.LLM_CALL_SECONDS.labels(call_type, "error" if error else "ok").observe(duration)
+            if not error:
+                self.latency[call_type].add(duration)
+                metrics.record_tokens(call_type, response)
+    
+    def _fallback(self, call_type: str):
+        self.fallbacks[call_type] += 1
+        metrics.LLM_FALLBACKS.labels(call_type).inc()
+    
+    def health(self) -> Dict[str, Any]:
+        """Breaker state, p95 latency and fallback rate per call type"""
+        report = {}
+        for call_type, breaker in self.breakers.items():
+            stats = breaker.stats()
+            attempts = stats["calls"] + stats["short_circuits"]
+            stats["p95_seconds"] = self.latency[call_type].percentile(95)
+            stats["fallbacks"] = self.fallbacks[call_type]
+            stats["fallback_rate"] = round(self.fallbacks[call_type] / attempts, 4) if attempts else 0.0
+            report[call_type] = stats
+        return report
+    
+    def _request_motivational_message(self, message_type: str) -> str:
+        """Make a single LLM call; raises on failure"""
+        response = self._complete(
+            "message",
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a supportive health and fitness coach."},
+                {"role": "user", "content": self.PROMPTS.get(message_type, self.PROMPTS["workout"])}
+            ],
+            max_tokens=50,
+            temperature=0.7
+        )
+        
+        return response.choices[0].message.content.strip()
+    
+    def _request_motivational_messages(self, message_type: str, n: int) -> List[str]:
+        """Ask for n distinct messages in one JSON completion; raises on failure"""
+        response = self._complete(
+            "batch",
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "You are a supportive health and fitness coach."},
+                {"role": "user", "content": self.PROMPTS.get(message_type, self.PROMPTS["workout"])},
+                {
+                    "role": "user",
+                    "content": f"""Write {n} distinct messages like this, each under {SMS_MAX_LENGTH} characters 
+                    and varied in wording. Reply with a JSON object of the form {{"messages": ["...", "..."]}}."""
+                }
+            ],
+            response_format={"type": "json_object"},
+            max_tokens=60 * n,
+            temperature=0.9
+        )
+        
+        payload = json.loads(response.choices[0].message.content)
+        messages = payload.get("messages") if isinstance(payload, dict) else payload
+        # A bare string would otherwise be iterated character by character
+        if not isinstance(messages, list):
+            return []
+        return [m for m in messages if isinstance(m, str)]
+    
+    def generate_motivational_messages(self, message_type: str, n: int) -> List[str]:
+        """
+        Generate up to n distinct motivational messages using one completion per batch
+        - Messages over the SMS limit, or under SMS_MIN_LENGTH / SMS_MIN_WORDS, are dropped
+        - Duplicates (case-insensitive) are removed
+        - May return fewer than n if the model under-delivers or a request fails
+        """
+        results = []
+        seen = set()
+        attempts = 0
+        max_attempts = (n // GENERATION_BATCH_SIZE) + 2
+        
+        while len(results) < n and attempts < max_attempts:
+            attempts += 1
+            batch_size = min(GENERATION_BATCH_SIZE, n - len(results))
+            try:
+                candidates = self._request_motivational_messages(message_type, batch_size)
+            except Exception as e:
+                logger.error(f"Error generating {message_type} message batch: {str(e)}")
+                self._fallback("batch")
+                break
+            
+            for text in candidates:
+                text = text.strip()
+                key = text.casefold()
+                if not SMS_MIN_LENGTH <= len(text) <= SMS_MAX_LENGTH or len(text.split()) < SMS_MIN_WORDS or key in seen:
+                    continue
+                seen.add(key)
+                results.append(text)
+                if len(results) >= n:
+                    break
+        
+        return results
+    
+    def get_message(self, message_type: str, phone: Optional[str] = None, mode: str = "llm", **slots) -> str:
+        """
+        Produce a reminder according to the schedule's generation mode
+        - llm: pre-generated pool, then a live LLM call when the pool is empty
+        - template: local templates only, no external calls
+        - hybrid: pre-generated pool, then a template (never waits on the LLM)
+        """
+        if mode == "template":
+            return self.render_template(message_type, **slots)
+        
+        try:
+            message = self.pool.pop(message_type, phone)
+            if message:
+                return message
+        except Exception as e:
+            logger.error(f"Error reading {message_type} message pool: {str(e)}")
+        
+        if mode == "hybrid":
+            return self.render_template(message_type, **slots)
+        return self.generate_motivational_message(message_type)
+    
+    def render_template(self, message_type: str, **slots) -> str:
+        """Fill a local template; falls back to the canned message if none matches"""
+        message = self.templates.render(message_type, **slots)
+        return message or self.FALLBACK_MESSAGES.get(message_type, self.FALLBACK_MESSAGES["workout"])
+    
+    def refill_pool(self, message_type: str, minimum: int = 0) -> int:
+        """Top the pool for message_type back up to its target size (or `minimum`, if larger)"""
+        count = max(self.pool.refill_count(message_type), minimum - self.pool.size(message_type))
+        if count <= 0:
+            return 0
+        
+        messages = self.generate_motivational_messages(message_type, count)
+        return self.pool.add(message_type, messages)
     
     def generate_motivational_message(self, message_type: str) -> str:
         """Generate a motivational message based on the type (meal or workout)"""
         
-        prompts = {
-            "meal": """
-            Generate a short, encouraging SMS message (max 160 characters) to remind someone 
-            about eating a healthy meal. Make it motivational, friendly, and actionable.
-            Examples: "🍎 Time to fuel your body with nutritious food! Your health goals are within reach!"
-            """,
-            "workout": """
-            Generate a short, encouraging SMS message (max 160 characters) to motivate someone 
-            to work out. Make it energetic, inspiring, and actionable.
-            Examples: "💪 Your body is capable of amazing things! Time to show it some love with a great workout!"
-            """
-        }
+        try:
+            return self._request_motivational_message(message_type)
+        except Exception as e:
+            logger.error(f"Error generating {message_type} message: {str(e)}")
+            self._fallback("message")
+            # Fallback messages if GPT fails
+            return self.FALLBACK_MESSAGES.get(message_type, self.FALLBACK_MESSAGES["workout"])
+    
+    def _reply_messages(self, user_message: str, history: Optional[List[tuple]] = None) -> List[Dict[str, str]]:
+        messages = [{"role": "system", "content": self.REPLY_SYSTEM_PROMPT}]
+        for incoming, response in history or []:
+            messages.append({"role": "user", "content": incoming})
+            # Earlier texts of a coalesced burst have no reply of their own
+            if response:
+                messages.append({"role": "assistant", "content": response})
+        messages.append({"role": "user", "content": f"User said: '{user_message}'. Respond supportively."})
+        return messages
+    
+    def generate_reply_to_user(self, user_message: str, phone: Optional[str] = None) -> str:
+        """Generate a supportive reply to user's message"""
+        
+        # Common short texts are answered from the reply cache without an LLM call
+        cache_key = self.reply_cache.key_for(user_message)
+        if cache_key:
+            cached = self.reply_cache.get(cache_key)
+            if cached:
+                return cached
+        
+        # Cacheable replies are generated without history so variants can be shared
+        history = None
+        if phone and not cache_key:
+            try:
+                history = self.get_user_message_history(phone)
+            except Exception as e:
+                logger.error(f"Error loading history for {phone}: {str(e)}")
         
         try:
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
+            response = self._complete(
+                "reply",
                 model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a supportive health and fitness coach."},
-                    {"role": "user", "content": prompts.get(message_type, prompts["workout"])}
-                ],
+                messages=self._reply_messages(user_message, history),
                 max_tokens=50,
                 temperature=0.7
             )
             
-            return response.choices[0].message.content.strip()
+            reply = response.choices[0].message.content.strip()
+            if cache_key:
+                self.reply_cache.add(cache_key, reply)
+            return reply
         except Exception as e:
-            logger.error(f"Error generating {message_type} message: {str(e)}")
-            # Fallback messages if GPT fails
-            fallback_messages = {
-                "meal": "🍎 Time for a healthy meal! Fuel your body with good nutrition today!",
-                "workout": "💪 Time to move your body! Every workout brings you closer to your goals!"
-            }
-            return fallback_messages.get(message_type, fallback_messages["workout"])
+            logger.error(f"Error generating reply: {str(e)}")
+            self._fallback("reply")
+            return self.REPLY_FALLBACK
     
-    def generate_reply_to_user(self, user_message: str) -> str:
-        """Generate a supportive reply to user's message"""
+    async def agenerate_reply_to_user(self, user_message: str, phone: Optional[str] = None) -> str:
+        """Async variant of generate_reply_to_user for the webhook event loop"""
+        
+        # Common short texts are answered from the reply cache without an LLM call
+        cache_key = self.reply_cache.key_for(user_message)
+        if cache_key:
+            cached = self.reply_cache.get(cache_key)
+            if cached:
+                return cached
+        
+        # Cacheable replies are generated without history so variants can be shared
+        history = None
+        if phone and not cache_key:
+            try:
+                history = await self.aget_user_message_history(phone)
+            except Exception as e:
+                logger.error(f"Error loading history for {phone}: {str(e)}")
         
         try:
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
+            response = await self._acomplete(
+                "reply",
                 model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system", 
-                        "content": """You are a supportive health and fitness coach. Respond to user messages 
-                        with encouragement, practical advice, or motivation. Keep responses under 160 characters 
-                        for SMS. Be empathetic and helpful."""
-                    },
-                    {
-                        "role": "user", 
-                        "content": f"User said: '{user_message}'. Respond supportively."
-                    }
-                ],
+                messages=self._reply_messages(user_message, history),
                 max_tokens=50,
                 temperature=0.7
             )
             
-            return response.choices[0].message.content.strip()
+            reply = response.choices[0].message.content.strip()
+            if cache_key:
+                self.reply_cache.add(cache_key, reply)
+            return reply
         except Exception as e:
             logger.error(f"Error generating reply: {str(e)}")
-            return "I hear you! Remember, every small step counts. You've got this! 💪"
-        
+            self._fallback("reply")
+            return self.REPLY_FALLBACK
+    
     def get_user_message_history(self, phone: str) -> list:
         """
         Retrieve user's message history for context
+        - Last K (incoming, response) exchanges, oldest first
+        - Served from the conversation cache; the DB is only read on a miss
         """
-        # Implementation needed
+        history = self.conversations.get(phone)
+        if history is not None:
+            return history
+        
+        db = SessionLocal()
+        try:
+            rows = db.execute(_history_query(phone, self.conversations.max_exchanges)).all()
+        finally:
+            db.close()
+        
+        history = [(row.incoming_message, row.bot_response) for row in reversed(rows)]
+        self.conversations.put(phone, history)
+        return history
+    
+    async def aget_user_message_history(self, phone: str) -> list:
+        """Async variant of get_user_message_history"""
+        history = self.conversations.get(phone)
+        if history is not None:
+            return history
+        
+        async with AsyncSessionLocal() as db:
+            rows = (await db.execute(_history_query(phone, self.conversations.max_exchanges))).all()
+        
+        history = [(row.incoming_message, row.bot_response) for row in reversed(rows)]
+        self.conversations.put(phone, history)
+        return history
+    
+    def record_exchange(self, phone: str, incoming_message: str, bot_response: str):
+        """Keep the conversation cache current after a UserReply is stored"""
+        self.conversations.append(phone, incoming_message, bot_response)
 
 # Global instance
 gpt_generator = GPTMessageGenerator()
\ No newline at end of file
@@ -0,0 +1,110 @@
+from typing import Dict, List
+import os
+import zlib
+from dotenv import load_dotenv
+from redis_utils import redis_client
+
+load_dotenv()
+
+# Load leveling settings
+LOAD_LEVEL_WINDOW_MINUTES = int(os.getenv("LOAD_LEVEL_WINDOW_MINUTES", "5"))
+# Matches the send engine's per-sender limit; read from env so importing this module
+# does not construct the Twilio client
+TWILIO_SEND_RATE = float(os.getenv("TWILIO_SEND_RATE", "1"))
+# Senders (numbers or messaging services) with their own rate limit sharing the load
+TWILIO_SENDER_COUNT = int(os.getenv("TWILIO_SENDER_COUNT", "1"))
+# The providers cannot drain more than this, so a larger setting is clamped to it
+SEND_CAPACITY_PER_MINUTE = int(TWILIO_SEND_RATE * 60 * TWILIO_SENDER_COUNT)
+LOAD_LEVEL_CAPACITY_PER_MINUTE = min(
+    int(os.getenv("LOAD_LEVEL_CAPACITY_PER_MINUTE", str(SEND_CAPACITY_PER_MINUTE))),
+    SEND_CAPACITY_PER_MINUTE
+)
+
+MINUTES_PER_DAY = 24 * 60
+
+def _to_minute(time_str: str) -> int:
+    hour, minute = map(int, time_str.split(':'))
+    return hour * 60 + minute
+
+def _to_time_str(minute_of_day: int) -> str:
+    minute_of_day %= MINUTES_PER_DAY
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+class LoadLeveler:
+    """
+    Spreads reminders that share a popular minute across a ±N minute window
+    - The window for each requested minute is sized from how many schedules
+      want it and how many sends per minute the providers can absorb
+    - Widths are cached in Redis by a periodic rebalance
+    - Offsets are deterministic per phone, so a reminder keeps its slot day to day
+    """
+    
+    def __init__(self, client, window_minutes: int, capacity_per_minute: int, key: str = "load_level:widths"):
+        self.redis = client
+        self.window_minutes = window_minutes
+        self.capacity_per_minute = capacity_per_minute
+        self.key = key
+    
+    def width_for_load(self, load: int) -> int:
+        """Smallest half-width w such that 2w+1 minutes can carry the load, capped at the window"""
+        if self.capacity_per_minute <= 0 or load <= self.capacity_per_minute:
+            return 0
+        minutes_needed = -(-load // self.capacity_per_minute)
+        return min(self.window_minutes, minutes_needed // 2)
+    
+    def refresh(self, counts: Dict[str, int]) -> Dict[str, int]:
+        """Recompute widths from active schedule counts per requested HH:MM"""
+        widths = {time_str: self.width_for_load(count) for time_str, count in counts.items()}
+        widths = {time_str: width for time_str, width in widths.items() if width}
+        
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key)
+        if widths:
+            pipe.hset(self.key, mapping=widths)
+        pipe.execute()
+        return widths
+    
+    def widths(self) -> Dict[str, int]:
+        return {time_str: int(width) for time_str, width in self.redis.hgetall(self.key).items()}
+    
+    def width(self, time_str: str) -> int:
+        width = self.redis.hget(self.key, time_str)
+        return int(width) if width else 0
+    
+    @staticmethod
+    def offset_minutes(phone: str, time_str: str, width: int) -> int:
+        """Stable offset in [-width, width] for this phone's reminder at time_str"""
+        if width <= 0:
+            return 0
+        digest = zlib.crc32(f"{phone}:{time_str}".encode("utf-8"))
+        return digest % (2 * width + 1) - width
+    
+    def projected_histogram(self, counts: Dict[str, int]) -> List[dict]:
+        """Expected sends per minute before and after leveling, for minutes with any load"""
+        requested = [0] * MINUTES_PER_DAY
+        projected = [0.0] * MINUTES_PER_DAY
+        
+        for time_str, count in counts.items():
+            minute = _to_minute(time_str)
+            requested[minute] += count
+            width = self.width_for_load(count)
+            share = count / (2 * width + 1)
+            for offset in range(-width, width + 1):
+                projected[(minute + offset) % MINUTES_PER_DAY] += share
+        
+        return [
+            {
+                "minute": _to_time_str(minute),
+                "requested": requested[minute],
+                "projected": round(projected[minute], 1)
+            }
+            for minute in range(MINUTES_PER_DAY)
+            if requested[minute] or projected[minute]
+        ]
+
+# Global instance
+load_leveler = LoadLeveler(
+    redis_client,
+    window_minutes=LOAD_LEVEL_WINDOW_MINUTES,
+    capacity_per_minute=LOAD_LEVEL_CAPACITY_PER_MINUTE
+)
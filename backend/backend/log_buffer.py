@@ -0,0 +1,146 @@
+from sqlalchemy import insert
+from datetime import datetime
+from typing import List, Callable
+import os
+import time
+import atexit
+import threading
+import logging
+from models import SessionLocal, MessageLog
+from rollups import apply_message_logs
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Buffer settings
+MESSAGE_LOG_FLUSH_ROWS = int(os.getenv("MESSAGE_LOG_FLUSH_ROWS", "500"))
+MESSAGE_LOG_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_LOG_FLUSH_INTERVAL_MS", "1000"))
+MESSAGE_LOG_MAX_BUFFERED = int(os.getenv("MESSAGE_LOG_MAX_BUFFERED", "10000"))
+
+class MessageLogBuffer:
+    """
+    Per-process buffer that writes MessageLog rows in bulk
+    - Flushes when N rows are queued or every T ms, whichever comes first
+    - add() blocks once max_buffered rows are pending (backpressure)
+    - close() flushes whatever is left; call it on worker shutdown
+    """
+    
+    def __init__(self, session_factory: Callable, flush_rows: int, flush_interval_ms: int,
+                 max_buffered: int):
+        self.session_factory = session_factory
+        self.flush_rows = flush_rows
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_buffered = max(max_buffered, flush_rows)
+        
+        self._rows: List[dict] = []
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._closed = False
+        
+        self.flushes = 0
+        self.rows_written = 0
+    
+    def _ensure_flusher(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            # Celery prefork children inherit the object but not the thread or the parent's rows
+            self._rows = []
+            self._pid = pid
+            self._thread = None
+        
+        if self._thread is None or not self._thread.is_alive():
+            self._closed = False
+            self._thread = threading.Thread(target=self._run, name="message-log-flusher", daemon=True)
+            self._thread.start()
+    
+    def add_many(self, rows: List[dict]):
+        """Queue MessageLog column dicts; sent_at is stamped now if missing"""
+        now = datetime.utcnow()
+        with self._cond:
+            self._ensure_flusher()
+            for row in rows:
+                while len(self._rows) >= self.max_buffered:
+                    self._cond.notify_all()
+                    self._cond.wait(timeout=self.flush_interval)
+                row.setdefault("sent_at", now)
+                self._rows.append(row)
+            
+            if len(self._rows) >= self.flush_rows:
+                self._cond.notify_all()
+    
+    def add(self, row: dict):
+        self.add_many([row])
+    
+    def _take(self) -> List[dict]:
+        rows, self._rows = self._rows, []
+        self._cond.notify_all()  # Wake producers blocked on backpressure
+        return rows
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                if len(self._rows) < self.flush_rows and not self._closed:
+                    self._cond.wait(timeout=self.flush_interval)
+                if self._closed:
+                    return
+                rows = self._take()
+            if rows and not self._write(rows):
+                time.sleep(self.flush_interval)  # Back off while the database is failing
+    
+    def _write(self, rows: List[dict]) -> bool:
+        with self._write_lock:
+            db = self.session_factory()
+            try:
+                db.execute(insert(MessageLog), rows)
+                # Daily rollups move in the same transaction as the logs they count
+                apply_message_logs(db, rows)
+                with metrics.timed(metrics.DB_COMMIT_SECONDS, "message_log_flush"):
+                    db.commit()
+                self.flushes += 1
+                self.rows_written += len(rows)
+                return True
+            except Exception as e:
+                db.rollback()
+                logger.error(f"Error flushing {len(rows)} message logs: {str(e)}")
+                self._requeue(rows)
+                return False
+            finally:
+                db.close()
+    
+    def _requeue(self, rows: List[dict]):
+        """Put a failed batch back in front, dropping the oldest rows beyond the cap"""
+        with self._cond:
+            merged = rows + self._rows
+            dropped = len(merged) - self.max_buffered
+            if dropped > 0:
+                logger.error(f"Message log buffer full, dropping {dropped} rows")
+                merged = merged[dropped:]
+            self._rows = merged
+    
+    def flush(self):
+        """Write everything queued so far on the calling thread"""
+        with self._cond:
+            rows = self._take()
+        if rows:
+            self._write(rows)
+    
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=self.flush_interval * 2)
+        self.flush()
+
+# Global instance
+message_log_buffer = MessageLogBuffer(
+    SessionLocal,
+    flush_rows=MESSAGE_LOG_FLUSH_ROWS,
+    flush_interval_ms=MESSAGE_LOG_FLUSH_INTERVAL_MS,
+    max_buffered=MESSAGE_LOG_MAX_BUFFERED
+)
+
+# Prefork children exit via os._exit; scheduler also flushes on worker_process_shutdown
+atexit.register(message_log_buffer.close)
@@ -1,19 +1,31 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response
+from fastapi.responses import ORJSONResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from datetime import datetime
+from pydantic import BaseModel, ValidationError
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, date
+from itertools import islice
+from typing import AsyncIterator, Optional
 import uvicorn
 import os
+import csv
+import json
 from dotenv import load_dotenv
 
 load_dotenv(override=True, dotenv_path="/Volumes/T7/projects/uplift/backend/backend/.env")
 
 # Import our modules
-from models import create_tables, get_db, ScheduledMessage
-from scheduler import create_schedule, cancel_schedule
-from twilio_webhook import router as webhook_router
+from models import acreate_tables, get_async_db, async_engine, ScheduledMessage
+from scheduler import acreate_schedule, acreate_schedules_bulk, acancel_schedule, schedule_versions, aload_report
+from twilio_webhook import router as webhook_router, drain_pending_replies, INBOUND_DRAIN_SECONDS
 from twilio_utils import twilio_service
+from gpt_utils import gpt_generator
+import metrics
+from rollups import aphone_stats
+from retention import log_archiver, ARCHIVED_TABLES
+from delivery_status import delivery_status_buffer
 
 
 
@@ -36,11 +48,32 @@ app.add_middleware(
 # Include webhook router
 app.include_router(webhook_router, prefix="/webhook", tags=["webhooks"])
 
+# Schedule listing settings
+SCHEDULES_PAGE_SIZE = int(os.getenv("SCHEDULES_PAGE_SIZE", "100"))
+SCHEDULES_MAX_PAGE_SIZE = int(os.getenv("SCHEDULES_MAX_PAGE_SIZE", "500"))
+
+# Bulk import settings
+BULK_INSERT_BATCH_SIZE = int(os.getenv("BULK_INSERT_BATCH_SIZE", "1000"))
+BULK_MAX_REPORTED_ERRORS = int(os.getenv("BULK_MAX_REPORTED_ERRORS", "1000"))
+BULK_MAX_LINE_BYTES = 64 * 1024
+
+# Progress stats settings
+STATS_DEFAULT_DAYS = int(os.getenv("STATS_DEFAULT_DAYS", "30"))
+STATS_MAX_DAYS = int(os.getenv("STATS_MAX_DAYS", "365"))
+
+# Archive lookup settings
+ARCHIVE_QUERY_MAX_ROWS = int(os.getenv("ARCHIVE_QUERY_MAX_ROWS", "5000"))
+
 # Pydantic models for request/response
 class ScheduleRequest(BaseModel):
     phone: str
     message_type: str  # "meal" or "workout"
     time: str  # "HH:MM" format
+    mode: str = "llm"  # "llm", "template" or "hybrid"
+    # Template personalization; empty values use the defaults
+    name: Optional[str] = None
+    tone: Optional[str] = None  # "energetic" or "gentle"
+    language: Optional[str] = None  # e.g. "en", "es"
 
 class ScheduleResponse(BaseModel):
     success: bool
@@ -57,10 +90,80 @@ class TestSMSRequest(BaseModel):
     phone: str
     message: str
 
+def validate_schedule_fields(phone: str, message_type: str, time_str: str, mode: str = "llm",
+                             name: Optional[str] = None, tone: Optional[str] = None,
+                             language: Optional[str] = None) -> Optional[str]:
+    """Return an error message if the schedule fields are invalid, else None"""
+    
+    # Validate message type
+    if message_type not in ["meal", "workout"]:
+        return "message_type must be either 'meal' or 'workout'"
+    
+    # Validate generation mode
+    if mode not in gpt_generator.GENERATION_MODES:
+        return "mode must be one of 'llm', 'template' or 'hybrid'"
+    
+    # Validate time format
+    try:
+        time_parts = time_str.split(":")
+        if len(time_parts) != 2:
+            raise ValueError("Invalid format")
+        
+        hour = int(time_parts[0])
+        minute = int(time_parts[1])
+        
+        if not (0 <= hour <= 23) or not (0 <= minute <= 59):
+            raise ValueError("Invalid time range")
+    
+    except ValueError:
+        return "time must be in HH:MM format (24-hour)"
+    
+    # Validate phone number
+    if not twilio_service.validate_phone_number(phone):
+        return "Invalid phone number format"
+    
+    # Validate template personalization
+    templates = gpt_generator.templates
+    if name and len(name) > templates.SLOT_MAX_LENGTHS["name"]:
+        return f"name must be at most {templates.SLOT_MAX_LENGTHS['name']} characters"
+    if tone and tone not in templates.tones:
+        return f"tone must be one of {', '.join(sorted(templates.tones))}"
+    if language and language not in templates.languages:
+        return f"language must be one of {', '.join(sorted(templates.languages))}"
+    
+    return None
+
+async def _iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Split a streamed request body into raw lines, holding at most one partial line"""
+    buffer = b""
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        if len(buffer) > BULK_MAX_LINE_BYTES:
+            raise HTTPException(status_code=400, detail="Line too long in bulk import body")
+        for line in lines:
+            yield line.rstrip(b"\r")
+    if buffer.strip():
+        yield buffer.rstrip(b"\r")
+
+def _parse_csv_line(line: str, header: list) -> dict:
+    values = next(csv.reader([line]))
+    if len(values) != len(header):
+        raise ValueError(f"expected {len(header)} columns, got {len(values)}")
+    return dict(zip(header, values))
+
 # Initialize database tables
 @app.on_event("startup")
 async def startup_event():
-    create_tables()
+    await acreate_tables()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Answer coalesced bursts and late replies before the process exits
+    await drain_pending_replies(INBOUND_DRAIN_SECONDS)
+    # Apply buffered delivery statuses before the process exits
+    await run_in_threadpool(delivery_status_buffer.close)
+    await async_engine.dispose()
 
 # Health check endpoint
 @app.get("/health", response_model=HealthCheck)
@@ -71,53 +174,47 @@ async def health_check():
         version="1.0.0"
     )
 
+# Prometheus scrape endpoint
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type=metrics.CONTENT_TYPE_LATEST)
+
+# LLM health: circuit breaker state, latency and fallback rate per call type
+@app.get("/health/llm")
+async def llm_health():
+    return {
+        "calls": gpt_generator.health(),
+        "client": gpt_generator.openai.stats(),
+        "reply_cache": gpt_generator.reply_cache.stats()
+    }
+
 # Main scheduling endpoint
 @app.post("/schedule", response_model=ScheduleResponse)
 async def schedule_reminder(
     request: ScheduleRequest,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Schedule a new SMS reminder"""
     
-    # Validate message type
-    if request.message_type not in ["meal", "workout"]:
-        raise HTTPException(
-            status_code=400,
-            detail="message_type must be either 'meal' or 'workout'"
-        )
-    
-    # Validate time format
-    try:
-        time_parts = request.time.split(":")
-        if len(time_parts) != 2:
-            raise ValueError("Invalid format")
-        
-        hour = int(time_parts[0])
-        minute = int(time_parts[1])
-        
-        if not (0 <= hour <= 23) or not (0 <= minute <= 59):
-            raise ValueError("Invalid time range")
-            
-    except ValueError:
-        raise HTTPException(
-            status_code=400,
-            detail="time must be in HH:MM format (24-hour)"
-        )
-    
-    # Validate and format phone number
-    if not twilio_service.validate_phone_number(request.phone):
-        raise HTTPException(
-            status_code=400,
-            detail="Invalid phone number format"
-        )
+    error = validate_schedule_fields(
+        request.phone, request.message_type, request.time, request.mode,
+        request.name, request.tone, request.language
+    )
+    if error:
+        raise HTTPException(status_code=400, detail=error)
     
     formatted_phone = twilio_service.format_phone_number(request.phone)
     
     # Create the schedule
-    result = create_schedule(
+    result = await acreate_schedule(
+        db,
         phone=formatted_phone,
         message_type=request.message_type,
-        time_str=request.time
+        time_str=request.time,
+        mode=request.mode,
+        name=request.name or None,
+        tone=request.tone or None,
+        language=request.language or None
     )
     
     if result["success"]:
@@ -129,12 +226,117 @@ async def schedule_reminder(
     else:
         raise HTTPException(status_code=500, detail=result["error"])
 
+# Bulk import endpoint
+@app.post("/schedules/bulk")
+async def bulk_schedule_reminders(
+    request: Request,
+    body_format: Optional[str] = Query(None, alias="format"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Import many reminders from a streamed CSV or NDJSON body
+    - CSV needs a header row with phone, message_type and time columns
+    - Rows are validated like POST /schedule and inserted in multi-row batches
+    - Returns a per-row error report (row numbers are 1-based data rows)
+    """
+    
+    content_type = request.headers.get("content-type", "")
+    body_format = body_format or ("csv" if "csv" in content_type else "ndjson")
+    if body_format not in ("csv", "ndjson"):
+        raise HTTPException(status_code=400, detail="format must be either 'csv' or 'ndjson'")
+    
+    header = None
+    batch = []
+    errors = []
+    total_rows = 0
+    failed = 0
+    created = 0
+    
+    def record_error(row_number: int, message: str):
+        nonlocal failed
+        failed += 1
+        if len(errors) < BULK_MAX_REPORTED_ERRORS:
+            errors.append({"row": row_number, "error": message})
+    
+    async def flush(rows: list):
+        nonlocal created
+        result = await acreate_schedules_bulk(db, rows)
+        if result["success"]:
+            created += result["created"]
+        else:
+            for row in rows:
+                record_error(row["row"], result["error"])
+    
+    async for raw_line in _iter_lines(request.stream()):
+        if not raw_line.strip():
+            continue
+        
+        try:
+            line = raw_line.decode("utf-8")
+        except UnicodeDecodeError:
+            if body_format == "csv" and header is None:
+                raise HTTPException(status_code=400, detail="CSV header is not valid UTF-8")
+            total_rows += 1
+            record_error(total_rows, "row is not valid UTF-8")
+            continue
+        
+        if body_format == "csv" and header is None:
+            header = [column.strip() for column in next(csv.reader([line.lstrip("\ufeff")]))]
+            missing = {"phone", "message_type", "time"} - set(header)
+            if missing:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"CSV header is missing columns: {', '.join(sorted(missing))}"
+                )
+            continue
+        
+        total_rows += 1
+        try:
+            raw = _parse_csv_line(line, header) if body_format == "csv" else json.loads(line)
+            row = ScheduleRequest.model_validate(raw)
+        except (ValueError, ValidationError) as e:
+            record_error(total_rows, str(e))
+            continue
+        
+        error = validate_schedule_fields(
+            row.phone, row.message_type, row.time, row.mode, row.name, row.tone, row.language
+        )
+        if error:
+            record_error(total_rows, error)
+            continue
+        
+        batch.append({
+            "row": total_rows,
+            "phone": twilio_service.format_phone_number(row.phone),
+            "message_type": row.message_type,
+            "time": row.time,
+            "mode": row.mode,
+            "name": row.name or None,
+            "tone": row.tone or None,
+            "language": row.language or None
+        })
+        if len(batch) >= BULK_INSERT_BATCH_SIZE:
+            await flush(batch)
+            batch = []
+    
+    if batch:
+        await flush(batch)
+    
+    return {
+        "success": failed == 0,
+        "total_rows": total_rows,
+        "created": created,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors)
+    }
+
 # Cancel schedule endpoint
 @app.delete("/schedule/{schedule_id}")
-async def cancel_reminder(schedule_id: int, db: Session = Depends(get_db)):
+async def cancel_reminder(schedule_id: int, db: AsyncSession = Depends(get_async_db)):
     """Cancel a scheduled reminder"""
     
-    result = cancel_schedule(schedule_id)
+    result = await acancel_schedule(db, schedule_id)
     
     if result["success"]:
         return {"message": result["message"]}
@@ -143,28 +345,128 @@ async def cancel_reminder(schedule_id: int, db: Session = Depends(get_db)):
 
 # List user's schedules
 @app.get("/schedules/{phone}")
-async def get_user_schedules(phone: str, db: Session = Depends(get_db)):
-    """Get all active schedules for a phone number"""
+async def get_user_schedules(
+    phone: str,
+    request: Request,
+    cursor: Optional[str] = None,
+    limit: int = Query(SCHEDULES_PAGE_SIZE, ge=1, le=SCHEDULES_MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Get active schedules for a phone number, one keyset page at a time
+    - Pass the returned next_cursor back as ?cursor= for the following page
+    - Honors If-None-Match against a per-phone version ETag
+    """
     
     formatted_phone = twilio_service.format_phone_number(phone)
     
-    schedules = db.query(ScheduledMessage).filter(
+    try:
+        after_id = int(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    
+    # Unchanged lists are answered from the version counter without touching the DB
+    etag = None
+    try:
+        version = await run_in_threadpool(schedule_versions.get, formatted_phone)
+        etag = f'W/"{version}-{after_id}-{limit}"'
+        if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+            return Response(status_code=304, headers={"ETag": etag})
+    except Exception:
+        pass
+    
+    # Served by the (phone, is_active, id) index
+    schedules = (await db.execute(select(
+        ScheduledMessage.id,
+        ScheduledMessage.message_type,
+        ScheduledMessage.scheduled_time,
+        ScheduledMessage.generation_mode,
+        ScheduledMessage.created_at
+    ).where(
         ScheduledMessage.phone == formatted_phone,
-        ScheduledMessage.is_active == True
-    ).all()
+        ScheduledMessage.is_active == True,
+        ScheduledMessage.id > after_id
+    ).order_by(ScheduledMessage.id).limit(limit + 1))).all()
     
-    return {
+    has_more = len(schedules) > limit
+    schedules = schedules[:limit]
+    
+    return ORJSONResponse(
+        {
+            "phone": formatted_phone,
+            "schedules": [
+                {
+                    "id": schedule.id,
+                    "message_type": schedule.message_type,
+                    "scheduled_time": schedule.scheduled_time,
+                    "mode": schedule.generation_mode or "llm",
+                    "created_at": schedule.created_at.isoformat()
+                }
+                for schedule in schedules
+            ],
+            "next_cursor": str(schedules[-1].id) if has_more else None
+        },
+        headers={"ETag": etag} if etag else None
+    )
+
+# Progress dashboard: daily rollups per message type
+@app.get("/stats/{phone}")
+async def get_user_stats(
+    phone: str,
+    days: int = Query(STATS_DEFAULT_DAYS, ge=1, le=STATS_MAX_DAYS),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Sent, failed and replied counts plus reply streaks for the last N days
+    - Reads one rollup row per day and message type, never the raw logs
+    """
+    
+    formatted_phone = twilio_service.format_phone_number(phone)
+    return ORJSONResponse(await aphone_stats(db, formatted_phone, days))
+
+# Archived message logs and replies, read from the compressed files
+@app.get("/archive/{phone}")
+async def get_archived_logs(
+    phone: str,
+    table: str = "message_logs",
+    since: Optional[date] = None,
+    until: Optional[date] = None,
+    limit: int = Query(1000, ge=1, le=ARCHIVE_QUERY_MAX_ROWS)
+):
+    """
+    Rows that aged out of the database for a phone, oldest first
+    - table is "message_logs" or "user_replies"
+    - since/until (YYYY-MM-DD, inclusive) prune which day partitions are opened
+    """
+    
+    if table not in ARCHIVED_TABLES:
+        raise HTTPException(status_code=400, detail="table must be 'message_logs' or 'user_replies'")
+    
+    formatted_phone = twilio_service.format_phone_number(phone)
+    
+    def read():
+        rows = list(islice(log_archiver.query(table, formatted_phone, since, until), limit + 1))
+        return rows[:limit], len(rows) > limit
+    
+    rows, truncated = await run_in_threadpool(read)
+    return ORJSONResponse({
         "phone": formatted_phone,
-        "schedules": [
-            {
-                "id": schedule.id,
-                "message_type": schedule.message_type,
-                "scheduled_time": schedule.scheduled_time,
-                "created_at": schedule.created_at.isoformat()
-            }
-            for schedule in schedules
-        ]
-    }
+        "table": table,
+        "rows": rows,
+        "truncated": truncated
+    })
+
+# Send load before and after leveling popular minutes
+@app.get("/admin/load-report")
+async def send_load_report(db: AsyncSession = Depends(get_async_db)):
+    """Requested vs projected sends per minute across active schedules"""
+    
+    result = await aload_report(db)
+    
+    if result["success"]:
+        return ORJSONResponse(result)
+    else:
+        raise HTTPException(status_code=500, detail=result["error"])
 
 # Test SMS endpoint (for development)
 @app.post("/test-sms")
@@ -175,7 +477,7 @@ async def test_sms(request: TestSMSRequest):
         raise HTTPException(status_code=400, detail="Invalid phone number")
     
     formatted_phone = twilio_service.format_phone_number(request.phone)
-    result = twilio_service.send_sms(formatted_phone, request.message)
+    result = await run_in_threadpool(twilio_service.send_sms, formatted_phone, request.message)
     
     if result["success"]:
         return {"message": "SMS sent successfully", "details": result}
@@ -0,0 +1,94 @@
+from prometheus_client import (
+    Counter, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST,
+    generate_latest, start_http_server, multiprocess
+)
+from contextlib import contextmanager
+from datetime import datetime
+import os
+import time
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Exporter settings
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", "9100"))
+# Set for prefork workers and multi-process uvicorn so every process's samples are merged
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+LLM_BUCKETS = (0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+SEND_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+DB_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 900)
+
+LLM_CALL_SECONDS = Histogram(
+    "llm_call_seconds", "OpenAI completion latency", ["call_type", "outcome"], buckets=LLM_BUCKETS
+)
+LLM_FALLBACKS = Counter(
+    "llm_fallbacks_total", "Canned fallbacks served instead of an LLM result", ["call_type"]
+)
+LLM_TOKENS = Counter(
+    "llm_tokens_total", "Tokens reported by OpenAI usage", ["call_type", "kind"]
+)
+TWILIO_SEND_SECONDS = Histogram(
+    "twilio_send_seconds", "Twilio send latency including rate-limit waits and retries",
+    ["outcome"], buckets=SEND_BUCKETS
+)
+TWILIO_RETRIES = Counter(
+    "twilio_send_retries_total", "Twilio sends retried after a 429/5xx", ["status"]
+)
+DB_COMMIT_SECONDS = Histogram(
+    "db_commit_seconds", "Database commit time", ["operation"], buckets=DB_BUCKETS
+)
+SCHEDULE_SEND_LAG_SECONDS = Histogram(
+    "schedule_send_lag_seconds", "Delay between a reminder's due minute and its send",
+    ["message_type"], buckets=LAG_BUCKETS
+)
+WEBHOOK_SECONDS = Histogram(
+    "webhook_reply_seconds", "Inbound SMS webhook end-to-end time", ["outcome"], buckets=SEND_BUCKETS
+)
+DELIVERY_STATUS_CALLBACKS = Counter(
+    "delivery_status_callbacks_total", "Twilio message status callbacks received", ["status"]
+)
+
+@contextmanager
+def timed(histogram: Histogram, *labels: str):
+    """Observe the wall time of the block; cheap enough for every call"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.labels(*labels).observe(time.perf_counter() - started)
+
+def record_tokens(call_type: str, response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return
+    LLM_TOKENS.labels(call_type, "prompt").inc(usage.prompt_tokens or 0)
+    LLM_TOKENS.labels(call_type, "completion").inc(usage.completion_tokens or 0)
+
+def epoch_seconds(moment: datetime) -> float:
+    """Naive UTC datetime to a Unix timestamp"""
+    return (moment - datetime(1970, 1, 1)).total_seconds()
+
+def observe_send_lag(message_type: str, due_at: float):
+    if due_at:
+        SCHEDULE_SEND_LAG_SECONDS.labels(message_type).observe(max(0.0, time.time() - due_at))
+
+def _registry():
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+def render() -> bytes:
+    """Exposition text for /metrics"""
+    return generate_latest(_registry())
+
+def start_worker_exporter():
+    """Serve /metrics for a Celery worker; in multiprocess mode this aggregates all pool children"""
+    start_http_server(WORKER_METRICS_PORT, registry=_registry())
+
+def mark_process_dead(pid: int):
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
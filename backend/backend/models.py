@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, create_engine
+from sqlalchemy import Column, Integer, String, DateTime, Date, Boolean, Index, UniqueConstraint, create_engine, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from datetime import datetime
 import os
 from dotenv import load_dotenv
@@ -9,8 +10,42 @@ load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./sms_reminders.db")
 
-engine = create_engine(DATABASE_URL)
+def _async_database_url(url: str) -> str:
+    """Map a sync DATABASE_URL onto its async driver (aiosqlite / asyncpg)"""
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    for prefix in ("postgresql+psycopg2://", "postgresql://", "postgres://"):
+        if url.startswith(prefix):
+            return url.replace(prefix, "postgresql+asyncpg://", 1)
+    return url
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", _async_database_url(DATABASE_URL))
+
+# Connection pool settings (per engine, per process)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+
+def _pool_options(url: str) -> dict:
+    """Queue pool sizing for server databases; SQLite keeps SQLAlchemy's default pool"""
+    if url.startswith("sqlite"):
+        return {}
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": True
+    }
+
+# Sync engine for Celery tasks and scripts
+engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Async engine for the API and anything else running on the event loop
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_pool_options(ASYNC_DATABASE_URL))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 
 class ScheduledMessage(Base):
@@ -23,6 +58,20 @@ class ScheduledMessage(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
     task_id = Column(String, nullable=True)  # Celery task ID
+    next_fire_at = Column(DateTime, nullable=True, index=True)  # Next UTC fire minute, scanned by the dispatcher
+    generation_mode = Column(String, default="llm")  # "llm", "template" or "hybrid"
+    shard = Column(Integer, nullable=True)  # Dispatch shard, crc32(phone) % DISPATCH_SHARDS
+    # Template personalization; None uses the defaults
+    name = Column(String, nullable=True)
+    tone = Column(String, nullable=True)  # "energetic" or "gentle"
+    language = Column(String, nullable=True)  # e.g. "en", "es"
+    
+    __table_args__ = (
+        # Keyset pagination of a phone's active schedules
+        Index("ix_scheduled_messages_phone_active_id", "phone", "is_active", "id"),
+        # Each dispatcher range-scans only the shards it holds leases for
+        Index("ix_scheduled_messages_shard_next_fire_at", "shard", "next_fire_at"),
+    )
 
 class MessageLog(Base):
     __tablename__ = "message_logs"
@@ -32,7 +81,14 @@ class MessageLog(Base):
     message_type = Column(String, nullable=False)
     message_content = Column(String, nullable=False)
     sent_at = Column(DateTime, default=datetime.utcnow)
-    status = Column(String, default="sent")  # sent, failed, delivered
+    status = Column(String, default="sent")  # sent/failed at send time, then Twilio delivery statuses
+    message_sid = Column(String, nullable=True, index=True)  # Twilio SID, matched by status callbacks
+    
+    __table_args__ = (
+        # Per-phone history in time order, and the retention cutoff scan
+        Index("ix_message_logs_phone_sent_at", "phone", "sent_at"),
+        Index("ix_message_logs_sent_at", "sent_at"),
+    )
 
 class UserReply(Base):
     __tablename__ = "user_replies"
@@ -42,13 +98,86 @@ class UserReply(Base):
     incoming_message = Column(String, nullable=False)
     bot_response = Column(String, nullable=False)
     received_at = Column(DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        Index("ix_user_replies_phone_received_at", "phone", "received_at"),
+        Index("ix_user_replies_received_at", "received_at"),
+    )
+
+class OutboxEvent(Base):
+    __tablename__ = "outbox_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    event_type = Column(String, nullable=False)  # "schedule.created", "schedule.cancelled", ...
+    payload = Column(String, nullable=False)  # JSON
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class DailyRollup(Base):
+    __tablename__ = "daily_rollups"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    phone = Column(String, nullable=False)
+    day = Column(Date, nullable=False)  # UTC day
+    message_type = Column(String, nullable=False)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    replied = Column(Integer, nullable=False, default=0)
+    streak = Column(Integer, nullable=False, default=0)  # Consecutive replied days ending here
+    last_sent_at = Column(DateTime, nullable=True)  # Latest send, used to attribute replies
+    
+    __table_args__ = (
+        # Upsert target and the per-phone day range scan behind /stats
+        UniqueConstraint("phone", "day", "message_type", name="uq_daily_rollups_phone_day_type"),
+    )
+
+def upgrade_schema(conn):
+    """
+    Bring tables created by an older release up to the current models
+    - create_all only creates missing tables; this adds missing columns and indexes
+    - New columns are nullable; rows that predate them get the column's Python default
+    - Idempotent, so it runs on every startup
+    """
+    inspector = inspect(conn)
+    tables = set(inspector.get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            conn.execute(text(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}"
+            ))
+            if column.default is not None and column.default.is_scalar:
+                conn.execute(table.update().where(column == None).values({column.name: column.default.arg}))
+        
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(conn)
+
+def _create_and_upgrade(conn):
+    Base.metadata.create_all(conn)
+    upgrade_schema(conn)
 
 def create_tables():
-    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        _create_and_upgrade(conn)
+
+async def acreate_tables():
+    async with async_engine.begin() as conn:
+        await conn.run_sync(_create_and_upgrade)
 
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+async def get_async_db():
+    """One AsyncSession per request"""
+    async with AsyncSessionLocal() as db:
+        yield db
\ No newline at end of file
@@ -0,0 +1,10 @@
+import redis
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Shared client; connections are opened lazily from its internal pool
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
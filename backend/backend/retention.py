@@ -0,0 +1,153 @@
+from sqlalchemy import select, delete
+from sqlalchemy.orm import Session
+from datetime import datetime, date, timedelta
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional
+import os
+import gzip
+import json
+import zlib
+from dotenv import load_dotenv
+from models import MessageLog, UserReply
+
+load_dotenv()
+
+# Retention settings
+LOG_RETENTION_HOT_DAYS = int(os.getenv("LOG_RETENTION_HOT_DAYS", "90"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "./archive")
+ARCHIVE_CHUNK_ROWS = int(os.getenv("ARCHIVE_CHUNK_ROWS", "5000"))
+ARCHIVE_PHONE_SHARDS = int(os.getenv("ARCHIVE_PHONE_SHARDS", "16"))
+
+# Archived tables and the timestamp each one is partitioned by
+ARCHIVED_TABLES = {
+    "message_logs": (MessageLog, "sent_at"),
+    "user_replies": (UserReply, "received_at"),
+}
+
+def _phone_shard(phone: str, shards: int) -> int:
+    return zlib.crc32(phone.encode("utf-8")) % shards
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+class LogArchiver:
+    """
+    Moves log rows older than the hot window out of the database into gzipped JSONL
+    - Files are partitioned by table, UTC day and phone shard:
+      {root}/{table}/{YYYY}/{MM}/{DD}/{shard}.jsonl.gz
+    - Each chunk is written and fsynced before its rows are deleted, so a crash can
+      only duplicate rows in the archive (readers drop duplicates by id), never lose them
+    - A phone lookup opens one shard file per day instead of the whole archive
+    """
+    
+    def __init__(self, root: str, hot_days: int, chunk_rows: int, shards: int):
+        self.root = root
+        self.hot_days = hot_days
+        self.chunk_rows = chunk_rows
+        self.shards = shards
+    
+    def cutoff(self, now: Optional[datetime] = None) -> datetime:
+        """Rows stamped before this (midnight UTC) are archived"""
+        today = (now or datetime.utcnow()).date()
+        return datetime.combine(today - timedelta(days=self.hot_days), datetime.min.time())
+    
+    def _path(self, table: str, day: date, shard: int) -> str:
+        return os.path.join(
+            self.root, table, f"{day.year:04d}", f"{day.month:02d}", f"{day.day:02d}",
+            f"{shard:02d}.jsonl.gz"
+        )
+    
+    def _write(self, table: str, rows: List[dict], timestamp: str):
+        """Append rows to their partition files; appending adds a gzip member, which readers handle"""
+        partitions: Dict[str, List[dict]] = defaultdict(list)
+        for row in rows:
+            partitions[self._path(table, row[timestamp].date(), _phone_shard(row["phone"], self.shards))].append(row)
+        
+        for path, partition in partitions.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            payload = "".join(
+                json.dumps({key: _encode(value) for key, value in row.items()}) + "\n"
+                for row in partition
+            ).encode("utf-8")
+            with open(path, "ab") as raw:
+                with gzip.GzipFile(fileobj=raw, mode="ab") as archive:
+                    archive.write(payload)
+                raw.flush()
+                os.fsync(raw.fileno())
+    
+    def archive_table(self, db: Session, table: str, cutoff: datetime) -> int:
+        """Stream rows older than cutoff out in id order, deleting each chunk once it is on disk"""
+        model, timestamp = ARCHIVED_TABLES[table]
+        columns = model.__table__.c
+        archived = 0
+        
+        while True:
+            rows = [
+                dict(row._mapping)
+                for row in db.execute(
+                    select(model.__table__).where(
+                        columns[timestamp] < cutoff
+                    ).order_by(columns.id).limit(self.chunk_rows)
+                )
+            ]
+            if not rows:
+                break
+            
+            self._write(table, rows, timestamp)
+            db.execute(delete(model.__table__).where(columns.id.in_([row["id"] for row in rows])))
+            db.commit()
+            archived += len(rows)
+            
+            if len(rows) < self.chunk_rows:
+                break
+        
+        return archived
+    
+    def _days(self, table: str, since: Optional[date], until: Optional[date]) -> Iterator[date]:
+        """Archived days for a table in ascending order, pruned to [since, until] by directory name"""
+        base = os.path.join(self.root, table)
+        if not os.path.isdir(base):
+            return
+        for year in sorted(os.listdir(base)):
+            for month in sorted(os.listdir(os.path.join(base, year))):
+                for day in sorted(os.listdir(os.path.join(base, year, month))):
+                    current = date(int(year), int(month), int(day))
+                    if since and current < since:
+                        continue
+                    if until and current > until:
+                        return
+                    yield current
+    
+    def last_archived_day(self) -> Optional[date]:
+        """Latest day with archived rows in any table; days up to it are no longer complete in the database"""
+        last = None
+        for table in ARCHIVED_TABLES:
+            for day in self._days(table, None, None):
+                if last is None or day > last:
+                    last = day
+        return last
+    
+    def query(self, table: str, phone: str, since: Optional[date] = None,
+              until: Optional[date] = None) -> Iterator[dict]:
+        """Archived rows for a phone in day order, read straight from the compressed files"""
+        shard = _phone_shard(phone, self.shards)
+        seen = set()
+        for day in self._days(table, since, until):
+            path = self._path(table, day, shard)
+            if not os.path.exists(path):
+                continue
+            with gzip.open(path, "rt", encoding="utf-8") as archive:
+                for line in archive:
+                    row = json.loads(line)
+                    if row["phone"] != phone or row["id"] in seen:
+                        continue
+                    seen.add(row["id"])
+                    yield row
+
+# Global instance
+log_archiver = LogArchiver(
+    ARCHIVE_DIR,
+    hot_days=LOG_RETENTION_HOT_DAYS,
+    chunk_rows=ARCHIVE_CHUNK_ROWS,
+    shards=ARCHIVE_PHONE_SHARDS
+)
@@ -0,0 +1,301 @@
+from sqlalchemy import select, update, delete, func, case
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime, date, timedelta
+from collections import defaultdict
+from typing import List, Dict, Optional
+from models import engine, DailyRollup, MessageLog, UserReply
+
+# Dialect-specific INSERT ... ON CONFLICT; SQLite and PostgreSQL share the same API
+if engine.dialect.name == "postgresql":
+    from sqlalchemy.dialects.postgresql import insert as _dialect_insert
+else:
+    from sqlalchemy.dialects.sqlite import insert as _dialect_insert
+
+rollups = DailyRollup.__table__
+
+# MessageLog statuses counted as failed; Twilio reports carrier rejections as "undelivered"
+FAILED_STATUSES = ("failed", "undelivered")
+
+def _upsert_statement():
+    """Insert rollup rows, adding their counters onto any existing (phone, day, message_type) row"""
+    stmt = _dialect_insert(rollups)
+    excluded = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=["phone", "day", "message_type"],
+        set_={
+            "sent": rollups.c.sent + excluded.sent,
+            "failed": rollups.c.failed + excluded.failed,
+            "replied": rollups.c.replied + excluded.replied,
+            "last_sent_at": func.coalesce(
+                case(
+                    (excluded.last_sent_at > rollups.c.last_sent_at, excluded.last_sent_at),
+                    else_=rollups.c.last_sent_at
+                ),
+                excluded.last_sent_at
+            )
+        }
+    )
+
+def _rollup_row(phone: str, day: date, message_type: str) -> dict:
+    return {
+        "phone": phone,
+        "day": day,
+        "message_type": message_type,
+        "sent": 0,
+        "failed": 0,
+        "replied": 0,
+        "streak": 0,
+        "last_sent_at": None
+    }
+
+def _as_date(value) -> date:
+    # func.date() comes back as a string on SQLite and a date on PostgreSQL
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def tally_message_logs(rows: List[dict]) -> List[dict]:
+    """Collapse MessageLog column dicts into one rollup increment per (phone, day, message_type)"""
+    tally: Dict[tuple, dict] = {}
+    for row in rows:
+        sent_at = row["sent_at"]
+        key = (row["phone"], sent_at.date(), row["message_type"])
+        if key not in tally:
+            tally[key] = _rollup_row(*key)
+        
+        entry = tally[key]
+        if row.get("status") in FAILED_STATUSES:
+            entry["failed"] += 1
+        else:
+            entry["sent"] += 1
+        if entry["last_sent_at"] is None or sent_at > entry["last_sent_at"]:
+            entry["last_sent_at"] = sent_at
+    return list(tally.values())
+
+def apply_message_logs(db: Session, rows: List[dict]):
+    """Fold a batch of MessageLog rows into the rollups, in the caller's transaction"""
+    increments = tally_message_logs(rows)
+    if increments:
+        db.execute(_upsert_statement(), increments)
+
+def apply_delivery_failures(db: Session, rows: List[dict]):
+    """Move sends that Twilio later reported as failed from sent to failed, in the caller's transaction"""
+    tally: Dict[tuple, dict] = {}
+    for row in rows:
+        key = (row["phone"], row["sent_at"].date(), row["message_type"])
+        if key not in tally:
+            tally[key] = _rollup_row(*key)
+        tally[key]["sent"] -= 1
+        tally[key]["failed"] += 1
+    if tally:
+        db.execute(_upsert_statement(), list(tally.values()))
+
+def _latest_type_query(phone: str, day: date):
+    """Message type of the most recent reminder sent to phone on or before day"""
+    return select(DailyRollup.message_type).where(
+        DailyRollup.phone == phone,
+        DailyRollup.day <= day,
+        DailyRollup.last_sent_at != None
+    ).order_by(DailyRollup.day.desc(), DailyRollup.last_sent_at.desc()).limit(1)
+
+def _previous_streak_query(phone: str, message_type: str, day: date):
+    return select(DailyRollup.streak).where(
+        DailyRollup.phone == phone,
+        DailyRollup.message_type == message_type,
+        DailyRollup.day == day - timedelta(days=1)
+    )
+
+async def arecord_reply(db: AsyncSession, phone: str, received_at: datetime):
+    """
+    Count an inbound reply against the reminder it most likely answers
+    - Attributed to the latest message type sent to the phone, today or earlier
+    - The first reply of the day extends the previous day's streak
+    """
+    day = received_at.date()
+    message_type = (await db.execute(_latest_type_query(phone, day))).scalar()
+    if message_type is None:
+        return  # Nothing has been sent to this phone yet
+    
+    row = _rollup_row(phone, day, message_type)
+    row["replied"] = 1
+    await db.execute(_upsert_statement(), [row])
+    
+    previous = (await db.execute(_previous_streak_query(phone, message_type, day))).scalar() or 0
+    await db.execute(update(DailyRollup).where(
+        DailyRollup.phone == phone,
+        DailyRollup.message_type == message_type,
+        DailyRollup.day == day,
+        DailyRollup.streak == 0
+    ).values(streak=previous + 1))
+
+def _stats_query(phone: str, first_day: date):
+    # Served by the (phone, day, message_type) unique index: O(days x types) rows
+    return select(DailyRollup).where(
+        DailyRollup.phone == phone,
+        DailyRollup.day >= first_day
+    ).order_by(DailyRollup.day, DailyRollup.message_type)
+
+def summarize(phone: str, days: int, first_day: date, today: date, rows: List[DailyRollup]) -> dict:
+    """Shape rollup rows into the /stats response"""
+    totals: Dict[str, dict] = {}
+    for row in rows:
+        entry = totals.setdefault(row.message_type, {
+            "sent": 0, "failed": 0, "replied": 0, "current_streak": 0, "best_streak": 0
+        })
+        entry["sent"] += row.sent
+        entry["failed"] += row.failed
+        entry["replied"] += row.replied
+        entry["best_streak"] = max(entry["best_streak"], row.streak)
+        # A streak is still current if it reached today or yesterday (today's reply may be pending)
+        if row.day >= today - timedelta(days=1):
+            entry["current_streak"] = max(entry["current_streak"], row.streak)
+    
+    return {
+        "phone": phone,
+        "days": days,
+        "from": first_day.isoformat(),
+        "to": today.isoformat(),
+        "totals": totals,
+        "daily": [
+            {
+                "day": row.day.isoformat(),
+                "message_type": row.message_type,
+                "sent": row.sent,
+                "failed": row.failed,
+                "replied": row.replied,
+                "streak": row.streak
+            }
+            for row in rows
+        ]
+    }
+
+async def aphone_stats(db: AsyncSession, phone: str, days: int, today: Optional[date] = None) -> dict:
+    today = today or datetime.utcnow().date()
+    first_day = today - timedelta(days=days - 1)
+    rows = (await db.execute(_stats_query(phone, first_day))).scalars().all()
+    return summarize(phone, days, first_day, today, rows)
+
+def current_streaks(db: Session, keys: List[tuple], today: date) -> Dict[tuple, int]:
+    """Current reply streak per (phone, message_type): the streak of a row from today or yesterday"""
+    wanted = set(keys)
+    phones = sorted({phone for phone, _ in wanted})
+    streaks: Dict[tuple, int] = {}
+    for phone, message_type, streak in db.query(
+        DailyRollup.phone, DailyRollup.message_type, DailyRollup.streak
+    ).filter(
+        DailyRollup.phone.in_(phones),
+        DailyRollup.day >= today - timedelta(days=1),
+        DailyRollup.streak > 0
+    ):
+        if (phone, message_type) in wanted:
+            streaks[(phone, message_type)] = max(streaks.get((phone, message_type), 0), streak)
+    return streaks
+
+def rebuild_days(db: Session, start: date, end: date) -> int:
+    """
+    Recompute rollups for [start, end) from MessageLog and UserReply
+    - Existing rollups in the range are replaced, not added to
+    - Run ranges in ascending order: streaks continue from the day before start
+    - Does not commit; the caller commits each chunk
+    """
+    start_at = datetime.combine(start, datetime.min.time())
+    end_at = datetime.combine(end, datetime.min.time())
+    
+    rows: Dict[tuple, dict] = {}
+    sends_by_phone_day = defaultdict(list)  # (phone, day) -> [(last_sent_at, message_type)]
+    
+    send_counts = db.query(
+        MessageLog.phone,
+        MessageLog.message_type,
+        func.date(MessageLog.sent_at),
+        MessageLog.status,
+        func.count(MessageLog.id),
+        func.max(MessageLog.sent_at)
+    ).filter(
+        MessageLog.sent_at >= start_at,
+        MessageLog.sent_at < end_at
+    ).group_by(
+        MessageLog.phone,
+        MessageLog.message_type,
+        func.date(MessageLog.sent_at),
+        MessageLog.status
+    ).all()
+    
+    for phone, message_type, day, status, count, last_sent_at in send_counts:
+        key = (phone, _as_date(day), message_type)
+        if key not in rows:
+            rows[key] = _rollup_row(*key)
+        entry = rows[key]
+        if status in FAILED_STATUSES:
+            entry["failed"] += count
+        else:
+            entry["sent"] += count
+        if entry["last_sent_at"] is None or last_sent_at > entry["last_sent_at"]:
+            entry["last_sent_at"] = last_sent_at
+    
+    for (phone, day, message_type), entry in rows.items():
+        sends_by_phone_day[(phone, day)].append((entry["last_sent_at"], message_type))
+    
+    # Replies go to the latest type sent at or before them, falling back to earlier days
+    fallback_types: Dict[str, Optional[str]] = {}
+    
+    def attribute(phone: str, received_at: datetime) -> Optional[str]:
+        day = received_at.date()
+        candidates = [sent for sent in sends_by_phone_day.get((phone, day), []) if sent[0] <= received_at]
+        if candidates:
+            return max(candidates)[1]
+        
+        earlier = day - timedelta(days=1)
+        while earlier >= start:
+            if (phone, earlier) in sends_by_phone_day:
+                return max(sends_by_phone_day[(phone, earlier)])[1]
+            earlier -= timedelta(days=1)
+        
+        if phone not in fallback_types:
+            fallback_types[phone] = db.execute(
+                _latest_type_query(phone, start - timedelta(days=1))
+            ).scalar()
+        return fallback_types[phone]
+    
+    replies = db.query(UserReply.phone, UserReply.received_at).filter(
+        UserReply.received_at >= start_at,
+        UserReply.received_at < end_at
+    ).order_by(UserReply.received_at).yield_per(1000)
+    
+    for phone, received_at in replies:
+        message_type = attribute(phone, received_at)
+        if message_type is None:
+            continue
+        key = (phone, received_at.date(), message_type)
+        if key not in rows:
+            rows[key] = _rollup_row(*key)
+        rows[key]["replied"] += 1
+    
+    # Streaks, continuing from whatever the day before the range already holds
+    previous_streaks = {
+        (phone, message_type): streak
+        for phone, message_type, streak in db.query(
+            DailyRollup.phone, DailyRollup.message_type, DailyRollup.streak
+        ).filter(
+            DailyRollup.day == start - timedelta(days=1),
+            DailyRollup.streak > 0
+        )
+    }
+    streak_days = {}  # (phone, message_type) -> (day, streak) of the last replied day seen
+    for phone, day, message_type in sorted(rows):
+        entry = rows[(phone, day, message_type)]
+        if not entry["replied"]:
+            continue
+        last_day, last_streak = streak_days.get(
+            (phone, message_type),
+            (start - timedelta(days=1), previous_streaks.get((phone, message_type), 0))
+        )
+        entry["streak"] = last_streak + 1 if last_day == day - timedelta(days=1) else 1
+        streak_days[(phone, message_type)] = (day, entry["streak"])
+    
+    db.execute(delete(DailyRollup).where(
+        DailyRollup.day >= start,
+        DailyRollup.day < end
+    ))
+    if rows:
+        db.execute(_dialect_insert(rollups), list(rows.values()))
+    return len(rows)
@@ -1,12 +1,27 @@
-from celery import Celery
+from celery import Celery, group
 from celery.schedules import crontab
-from datetime import datetime, timedelta
+from celery.signals import worker_init, worker_process_shutdown
+from datetime import datetime, date, timedelta
+from collections import Counter
 import os
+import json
+import time
 from dotenv import load_dotenv
+from sqlalchemy import insert, select, func, or_
 from sqlalchemy.orm import Session
-from models import get_db, ScheduledMessage, MessageLog
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from typing import Callable, List, Optional
+from models import get_db, ScheduledMessage, OutboxEvent, MessageLog
 from gpt_utils import gpt_generator
 from twilio_utils import twilio_service
+from redis_utils import redis_client
+from log_buffer import message_log_buffer
+from load_leveling import load_leveler, LoadLeveler
+from rollups import rebuild_days, current_streaks
+from retention import log_archiver, ARCHIVED_TABLES
+from sharding import shard_for
+import metrics
 
 load_dotenv()
 
@@ -25,33 +40,733 @@ celery_app.conf.update(
     enable_utc=True,
 )
 
+# Worker profile: "default" keeps Celery's stock settings, "throughput" tunes the send path.
+# Producers (API, dispatcher, beat) and workers must run the same profile.
+CELERY_PROFILE = os.getenv("CELERY_PROFILE", "default")
+CELERY_PREFETCH_MULTIPLIER = int(os.getenv("CELERY_PREFETCH_MULTIPLIER", "8"))
+CELERY_RESULT_EXPIRES_SECONDS = int(os.getenv("CELERY_RESULT_EXPIRES_SECONDS", "3600"))
+SEND_QUEUE = os.getenv("SEND_QUEUE", "sends")
+# Unacked sends are redelivered after this long; kept under the dispatch grace window so a
+# redelivered reminder can still go out
+CELERY_VISIBILITY_TIMEOUT_SECONDS = int(os.getenv("CELERY_VISIBILITY_TIMEOUT_SECONDS", "600"))
+# A send claim blocks other copies of the same reminder while one send (with retries) is in flight
+SEND_CLAIM_SECONDS = int(os.getenv("SEND_CLAIM_SECONDS", "120"))
+
+if CELERY_PROFILE == "throughput":
+    celery_app.conf.update(
+        # Compact binary payloads; json stays accepted so in-flight messages survive a rollout
+        task_serializer='msgpack',
+        result_serializer='msgpack',
+        accept_content=['msgpack', 'json'],
+        # Nothing reads task results; anything that opts back in expires
+        task_ignore_result=True,
+        result_expires=CELERY_RESULT_EXPIRES_SECONDS,
+        # Ack after the send so a lost worker's tasks are redelivered; SentMarkers stop repeats
+        task_acks_late=True,
+        task_reject_on_worker_lost=True,
+        broker_transport_options={"visibility_timeout": CELERY_VISIBILITY_TIMEOUT_SECONDS},
+        worker_prefetch_multiplier=CELERY_PREFETCH_MULTIPLIER,
+        # Sends get their own I/O-bound worker pool, away from pool refills and housekeeping
+        task_routes={
+            'scheduler.send_scheduled_message': {'queue': SEND_QUEUE},
+            'scheduler.send_scheduled_batch': {'queue': SEND_QUEUE},
+        },
+    )
+
+# Dispatcher settings
+DISPATCH_BATCH_SIZE = int(os.getenv("DISPATCH_BATCH_SIZE", "500"))
+DISPATCH_GRACE_MINUTES = int(os.getenv("DISPATCH_GRACE_MINUTES", "15"))
+DISPATCH_SEND_CHUNK = int(os.getenv("DISPATCH_SEND_CHUNK", "50"))
+
+# Outbox relay settings
+OUTBOX_RELAY_BATCH_SIZE = int(os.getenv("OUTBOX_RELAY_BATCH_SIZE", "500"))
+OUTBOX_RELAY_INTERVAL_SECONDS = float(os.getenv("OUTBOX_RELAY_INTERVAL_SECONDS", "5"))
+# Dispatch batches the dispatcher has not published within this long are relayed instead
+OUTBOX_DISPATCH_RELAY_DELAY_SECONDS = float(os.getenv("OUTBOX_DISPATCH_RELAY_DELAY_SECONDS", "30"))
+
+# A missed version bump can serve a stale 304 for at most this long
+SCHEDULE_VERSION_TTL_SECONDS = int(os.getenv("SCHEDULE_VERSION_TTL_SECONDS", "300"))
+
+# Rollup backfill settings
+ROLLUP_BACKFILL_CHUNK_DAYS = int(os.getenv("ROLLUP_BACKFILL_CHUNK_DAYS", "7"))
+
+# Shortest reply streak the streak templates mention
+TEMPLATE_MIN_STREAK = 2
+
+# Reminders are fanned out by the sharded dispatcher processes (dispatcher.py);
+# beat only drives housekeeping
+celery_app.conf.beat_schedule = {
+    'refill-message-pools': {
+        'task': 'scheduler.refill_message_pools',
+        'schedule': crontab(minute='*/5'),
+    },
+    'relay-outbox': {
+        'task': 'scheduler.relay_outbox',
+        'schedule': OUTBOX_RELAY_INTERVAL_SECONDS,
+    },
+    'rebalance-send-load': {
+        'task': 'scheduler.rebalance_send_load',
+        'schedule': crontab(minute='*/15'),
+    },
+    'archive-old-logs': {
+        'task': 'scheduler.archive_old_logs',
+        'schedule': crontab(hour=3, minute=30),
+    },
+}
+
+@worker_process_shutdown.connect
+def flush_message_logs(**kwargs):
+    """Write out any buffered MessageLog rows before the worker process exits"""
+    message_log_buffer.close()
+    metrics.mark_process_dead(os.getpid())
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    """Expose this worker's metrics (all pool children in multiprocess mode) on WORKER_METRICS_PORT"""
+    metrics.start_worker_exporter()
+
+class ScheduleTombstones:
+    """
+    Redis bitmap of cancelled schedule ids
+    - Cancel is a single SETBIT regardless of cluster size
+    - Send tasks check it before generating or sending anything
+    """
+    
+    def __init__(self, client, key: str = "schedule:tombstones"):
+        self.redis = client
+        self.key = key
+    
+    def add(self, schedule_id: int):
+        self.redis.setbit(self.key, schedule_id, 1)
+    
+    def cancelled(self, schedule_ids: List[int]) -> set:
+        """Return the subset of schedule_ids that have been cancelled"""
+        pipe = self.redis.pipeline(transaction=False)
+        for schedule_id in schedule_ids:
+            pipe.getbit(self.key, schedule_id)
+        return {schedule_id for schedule_id, bit in zip(schedule_ids, pipe.execute()) if bit}
+
+tombstones = ScheduleTombstones(redis_client)
+
+class ScheduleVersions:
+    """
+    Per-phone version counters used as ETags for schedule listings
+    - Bumped on every create/cancel for that phone
+    - Seeded from the clock so a Redis reset never repeats an old version
+    - Keys expire ttl_seconds after they are seeded, so a bump lost after a commit
+      (Redis briefly down) stops serving stale 304s once the key is re-seeded
+    """
+    
+    def __init__(self, client, ttl_seconds: int, prefix: str = "schedule_version"):
+        self.redis = client
+        self.ttl_seconds = ttl_seconds
+        self.prefix = prefix
+    
+    def _key(self, phone: str) -> str:
+        return f"{self.prefix}:{phone}"
+    
+    def get(self, phone: str) -> str:
+        key = self._key(phone)
+        version = self.redis.get(key)
+        if version is None:
+            self.redis.set(key, time.time_ns(), nx=True, ex=self.ttl_seconds)
+            version = self.redis.get(key)
+        return version
+    
+    def bump(self, phones: List[str]):
+        pipe = self.redis.pipeline(transaction=False)
+        for phone in set(phones):
+            pipe.set(self._key(phone), time.time_ns(), nx=True, ex=self.ttl_seconds)
+            pipe.incr(self._key(phone))
+        pipe.execute()
+
+schedule_versions = ScheduleVersions(redis_client, ttl_seconds=SCHEDULE_VERSION_TTL_SECONDS)
+
+def _bump_versions(phones: List[str]):
+    try:
+        schedule_versions.bump(phones)
+    except Exception:
+        pass
+
+def _cancelled_ids(schedule_ids: List[int]) -> set:
+    """Tombstone lookup that fails open; the dispatcher already filters on is_active"""
+    try:
+        return tombstones.cancelled(schedule_ids)
+    except Exception:
+        return set()
+
+class SentMarkers:
+    """
+    Short-lived Redis keys that let exactly one copy of a reminder reach Twilio
+    - Keyed by schedule id and due minute
+    - claim() is an atomic SET NX taken right before the send; a redelivered copy running
+      alongside the original loses the claim and skips the item
+    - A failed send releases its claim so a later copy may retry; a successful one turns it
+      into a "sent" marker that outlives the broker's visibility timeout
+    """
+    
+    def __init__(self, client, ttl_seconds: int, claim_seconds: int, prefix: str = "sent"):
+        self.redis = client
+        self.ttl_seconds = ttl_seconds
+        self.claim_seconds = claim_seconds
+        self.prefix = prefix
+    
+    def _key(self, schedule_id: int, due_at: Optional[float]) -> str:
+        return f"{self.prefix}:{schedule_id}:{int(due_at or 0)}"
+    
+    def sent(self, sends: List[tuple]) -> set:
+        """Return the schedule ids among (schedule_id, due_at) pairs that were already sent"""
+        pipe = self.redis.pipeline(transaction=False)
+        for schedule_id, due_at in sends:
+            pipe.get(self._key(schedule_id, due_at))
+        return {schedule_id for (schedule_id, _), state in zip(sends, pipe.execute()) if state == "sent"}
+    
+    def claim(self, schedule_id: int, due_at: Optional[float]) -> bool:
+        return bool(self.redis.set(self._key(schedule_id, due_at), "claimed", nx=True, ex=self.claim_seconds))
+    
+    def release(self, schedule_id: int, due_at: Optional[float]):
+        self.redis.delete(self._key(schedule_id, due_at))
+    
+    def mark(self, sends: List[tuple]):
+        pipe = self.redis.pipeline(transaction=False)
+        for schedule_id, due_at in sends:
+            pipe.set(self._key(schedule_id, due_at), "sent", ex=self.ttl_seconds)
+        pipe.execute()
+
+sent_markers = SentMarkers(
+    redis_client,
+    ttl_seconds=max(CELERY_VISIBILITY_TIMEOUT_SECONDS, DISPATCH_GRACE_MINUTES * 60) * 2,
+    claim_seconds=SEND_CLAIM_SECONDS
+)
+
+def _stale(due_at: Optional[float]) -> bool:
+    """Sends picked up after the grace window are dropped, as the dispatcher would have"""
+    return due_at is not None and due_at < time.time() - DISPATCH_GRACE_MINUTES * 60
+
+def _already_sent(sends: List[tuple]) -> set:
+    """Cheap pre-filter before messages are generated; fails open like the tombstones"""
+    try:
+        return sent_markers.sent(sends)
+    except Exception:
+        return set()
+
+def _claim_send(schedule_id: int, due_at: Optional[float]) -> bool:
+    """Always on: redelivery under late acks and a re-published dispatch batch both repeat sends"""
+    if due_at is None:
+        return True  # Ad-hoc sends have no occurrence to deduplicate
+    try:
+        return sent_markers.claim(schedule_id, due_at)
+    except Exception:
+        return True
+
+def _finish_send(schedule_id: int, due_at: Optional[float], result: dict):
+    """Turn a claim into a sent marker, or release it so a later copy can retry"""
+    if due_at is None or result.get("skipped"):
+        return
+    try:
+        if result["success"]:
+            sent_markers.mark([(schedule_id, due_at)])
+        else:
+            sent_markers.release(schedule_id, due_at)
+    except Exception:
+        pass
+
+def compute_next_fire_at(time_str: str, after: datetime, offset_minutes: int = 0) -> datetime:
+    """Return the first UTC datetime strictly after `after` matching the HH:MM time shifted by offset_minutes"""
+    hour, minute = map(int, time_str.split(':'))
+    # Compare on the unshifted clock so a negative offset never re-fires the occurrence just sent
+    base_after = after - timedelta(minutes=offset_minutes)
+    candidate = base_after.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if candidate <= base_after:
+        candidate += timedelta(days=1)
+    return candidate + timedelta(minutes=offset_minutes)
+
+def advance_after_fire(time_str: str, fired_at: datetime, now: datetime, offset_minutes: int = 0) -> datetime:
+    """
+    Next fire time once the occurrence at fired_at has gone out: the following day's
+    HH:MM plus the current offset, so a changed offset can never re-fire the same day
+    """
+    hour, minute = map(int, time_str.split(':'))
+    # Offsets are a few minutes at most, so the fired occurrence is the base time nearest fired_at
+    base = fired_at.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    fired_base = min(
+        (base + timedelta(days=days) for days in (-1, 0, 1)),
+        key=lambda candidate: abs(candidate - fired_at)
+    )
+    candidate = fired_base + timedelta(days=1, minutes=offset_minutes)
+    # After an outage longer than a day, skip ahead to the next occurrence still to come
+    while candidate <= now:
+        candidate += timedelta(days=1)
+    return candidate
+
+def _level_widths() -> dict:
+    """Current leveling widths per HH:MM; fail open to exact times if Redis is unavailable"""
+    try:
+        return load_leveler.widths()
+    except Exception:
+        return {}
+
+def _leveled_offset(phone: str, time_str: str, widths: dict) -> int:
+    return LoadLeveler.offset_minutes(phone, time_str, widths.get(time_str, 0))
+
+def _request_refill_if_low(message_type: str):
+    """Ask for a background top-up once the pool drops below its low-water mark"""
+    try:
+        if gpt_generator.pool.needs_refill(message_type) and gpt_generator.pool.acquire_refill_lock(message_type):
+            refill_message_pool.delay(message_type)
+    except Exception:
+        pass
+
+def _template_slots(scheduled_time: str = None, name: str = None, tone: str = None,
+                    language: str = None, streak: int = 0) -> dict:
+    """Slot values, tone and language for local templates; unset values are left out"""
+    values = {
+        "time_of_day": gpt_generator.templates.time_of_day(int(scheduled_time.split(':')[0])) if scheduled_time else None,
+        "name": name,
+        "tone": tone,
+        "language": language,
+        # "1 days in a row" reads badly; streak templates start at two days
+        "streak": streak if streak >= TEMPLATE_MIN_STREAK else None
+    }
+    return {key: value for key, value in values.items() if value}
+
+def _streaks(keys: List[tuple]) -> dict:
+    """Current reply streaks for (phone, message_type) pairs; empty if the lookup fails"""
+    if not keys:
+        return {}
+    db = next(get_db())
+    try:
+        return current_streaks(db, keys, datetime.utcnow().date())
+    except Exception:
+        return {}
+    finally:
+        db.close()
+
 @celery_app.task
-def send_scheduled_message(phone: str, message_type: str, schedule_id: int):
+def send_scheduled_message(phone: str, message_type: str, schedule_id: int,
+                           mode: str = "llm", scheduled_time: str = None, due_at: float = None,
+                           name: str = None, tone: str = None, language: str = None):
     """Background task to send scheduled SMS message"""
     
-    # Generate motivational message using GPT
-    message_content = gpt_generator.generate_motivational_message(message_type)
+    # Cancelled reminders never reach the LLM or Twilio
+    if _cancelled_ids([schedule_id]):
+        return {"success": False, "skipped": True, "error": "Schedule cancelled"}
+    if _stale(due_at):
+        return {"success": False, "skipped": True, "error": "Past the grace window"}
+    if _already_sent([(schedule_id, due_at)]):
+        return {"success": True, "skipped": True, "error": "Already sent"}
+    
+    # Pool first; llm mode falls back to a live GPT call, template/hybrid to local templates
+    streak = _streaks([(phone, message_type)]).get((phone, message_type), 0) if mode != "llm" else 0
+    message_content = gpt_generator.get_message(
+        message_type, phone, mode, **_template_slots(scheduled_time, name, tone, language, streak)
+    )
+    if mode != "template":
+        _request_refill_if_low(message_type)
     
     # Send SMS via Twilio
-    result = twilio_service.send_sms(phone, message_content)
+    result = twilio_service.send_sms(phone, message_content, claim=lambda: _claim_send(schedule_id, due_at))
+    _finish_send(schedule_id, due_at, result)
+    if result.get("skipped"):
+        return {"success": True, "skipped": True, "error": "Already sent"}
+    metrics.observe_send_lag(message_type, due_at)
+    
+    # Log the message; the buffer writes it with other sends in one bulk commit
+    message_log_buffer.add({
+        "phone": phone,
+        "message_type": message_type,
+        "message_content": message_content,
+        "status": "sent" if result["success"] else "failed",
+        "message_sid": result.get("message_sid")
+    })
+    
+    return {
+        "success": result["success"],
+        "message": message_content,
+        "twilio_result": result
+    }
+
+def _due_at(item: list) -> Optional[float]:
+    # Batches queued before due_at joined the item have five fields
+    return item[5] if len(item) > 5 else None
+
+def _personalization(item: list) -> tuple:
+    # (name, tone, language); older batches end at due_at
+    return tuple(item[6:9]) + (None,) * (9 - max(len(item), 6))
+
+@celery_app.task
+def send_scheduled_batch(items: list):
+    """
+    Send a dispatcher batch via send_many
+    - Items are [phone, message_type, schedule_id, mode, scheduled_time, due_at, name, tone, language]
+    """
+    
+    # Drop anything cancelled since it was dispatched, queued past the grace window, or
+    # already sent before a redelivery
+    dispatched = len(items)
+    cancelled = _cancelled_ids([item[2] for item in items])
+    items = [item for item in items if item[2] not in cancelled and not _stale(_due_at(item))]
+    already_sent = _already_sent([(item[2], _due_at(item)) for item in items])
+    items = [item for item in items if item[2] not in already_sent]
+    skipped = dispatched - len(items)
+    if not items:
+        return {"success": True, "sent": 0, "failed": 0, "skipped": skipped}
+    
+    # Only template and hybrid reminders can use a streak template
+    streaks = _streaks(sorted({(item[0], item[1]) for item in items if item[3] != "llm"}))
+    prepared = [
+        (item[0], item[1], gpt_generator.get_message(item[1], item[0], item[3], **_template_slots(
+            item[4], *_personalization(item), streaks.get((item[0], item[1]), 0)
+        )))
+        for item in items
+    ]
+    for message_type in {item[1] for item in items if item[3] != "template"}:
+        _request_refill_if_low(message_type)
+    
+    # Each item is claimed right before its send and settled as soon as it lands, so a
+    # redelivered copy running alongside this one cannot send it again
+    results = twilio_service.send_many(
+        [(phone, content) for phone, _, content in prepared],
+        on_result=lambda index, result: _finish_send(items[index][2], _due_at(items[index]), result),
+        claim=lambda index: _claim_send(items[index][2], _due_at(items[index]))
+    )
+    attempted = [
+        (item, content, result) for item, (_, _, content), result in zip(items, prepared, results)
+        if not result.get("skipped")
+    ]
+    for item, _, _ in attempted:
+        metrics.observe_send_lag(item[1], _due_at(item))
+    
+    message_log_buffer.add_many([
+        {
+            "phone": item[0],
+            "message_type": item[1],
+            "message_content": content,
+            "status": "sent" if result["success"] else "failed",
+            "message_sid": result.get("message_sid")
+        }
+        for item, content, result in attempted
+    ])
+    
+    sent = sum(1 for _, _, result in attempted if result["success"])
+    skipped += len(results) - len(attempted)
+    return {"success": True, "sent": sent, "failed": len(attempted) - sent, "skipped": skipped}
+
+@celery_app.task
+def refill_message_pool(message_type: str, minimum: int = 0):
+    """Top up the pre-generated message pool for one message type (to at least `minimum`)"""
+    try:
+        added = gpt_generator.refill_pool(message_type, minimum=minimum)
+        return {"success": True, "message_type": message_type, "added": added}
+    finally:
+        gpt_generator.pool.release_refill_lock(message_type)
+
+@celery_app.task
+def refill_message_pools():
+    """Periodic safety net so pools stay warm ahead of peak minutes"""
+    for message_type in gpt_generator.PROMPTS:
+        if gpt_generator.pool.acquire_refill_lock(message_type):
+            refill_message_pool.delay(message_type)
+
+def _request_pool_capacity(demand: Counter):
+    """
+    Queue a batch refill for any shortfall instead of generating it inline, so the dispatcher
+    never holds its row locks across LLM calls; sends that beat the refill use the fallbacks
+    """
+    for message_type, count in demand.items():
+        try:
+            if gpt_generator.pool.size(message_type) < count and gpt_generator.pool.acquire_refill_lock(message_type):
+                refill_message_pool.delay(message_type, minimum=count)
+        except Exception:
+            pass
+
+def _assign_missing_shards(db: Session) -> int:
+    """Stamp shards on rows written before the column existed; idempotent, so any dispatcher may run it"""
+    rows = db.query(ScheduledMessage).filter(
+        ScheduledMessage.is_active == True,
+        ScheduledMessage.shard == None
+    ).limit(DISPATCH_BATCH_SIZE).all()
+    for schedule in rows:
+        schedule.shard = shard_for(schedule.phone)
+    db.commit()
+    return len(rows)
+
+def _dispatch_scope(shards: Optional[List[int]]) -> list:
+    scope = [ScheduledMessage.is_active == True]
+    if shards is not None:
+        scope.append(ScheduledMessage.shard.in_(shards))
+    return scope
+
+def _publish_dispatched(db: Session, chunks: List[list], event_ids: List[int]):
+    """Publish committed send chunks and drop their outbox rows; on failure relay_outbox sends them"""
+    try:
+        group(send_scheduled_batch.s(chunk) for chunk in chunks).apply_async()
+        db.query(OutboxEvent).filter(OutboxEvent.id.in_(event_ids)).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        # A publish that landed before the failure is deduplicated by the send claims
+        db.rollback()
+
+def dispatch_due(shards: Optional[List[int]] = None, holds: Optional[Callable[[int], bool]] = None) -> dict:
+    """
+    Fan out every schedule in the given shards whose next fire minute has arrived
+    - shards=None covers every shard (single dispatcher)
+    - holds is checked before every batch; shards it rejects (lost leases) are dropped
+    - Due rows are locked with SKIP LOCKED, so an instance that still holds a shard
+      mid-handover cannot send the same rows as its successor
+    """
+    
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    horizon = now + timedelta(minutes=1)
+    grace_cutoff = now - timedelta(minutes=DISPATCH_GRACE_MINUTES)
+    dispatched = 0
+    skipped = 0
+    widths = _level_widths()
     
-    # Log the message
     db = next(get_db())
     try:
-        message_log = MessageLog(
-            phone=phone,
-            message_type=message_type,
-            message_content=message_content,
-            status="sent" if result["success"] else "failed"
-        )
-        db.add(message_log)
+        if shards is None or 0 in shards:
+            _assign_missing_shards(db)
+        scope = _dispatch_scope(shards)
+        
+        # Rows created before next_fire_at existed get their first fire minute here
+        missing = db.query(ScheduledMessage).filter(
+            *scope,
+            ScheduledMessage.next_fire_at == None
+        ).limit(DISPATCH_BATCH_SIZE).all()
+        for schedule in missing:
+            schedule.next_fire_at = compute_next_fire_at(
+                schedule.scheduled_time,
+                now - timedelta(minutes=1),
+                _leveled_offset(schedule.phone, schedule.scheduled_time, widths)
+            )
         db.commit()
         
+        while True:
+            if holds is not None:
+                # A shard whose renewal failed mid-scan is left to its next owner
+                shards = [shard for shard in shards if holds(shard)]
+                if not shards:
+                    break
+                scope = _dispatch_scope(shards)
+            
+            # Range scan over the next_fire_at index: cost is O(due rows)
+            due = db.query(ScheduledMessage).filter(
+                *scope,
+                ScheduledMessage.next_fire_at < horizon
+            ).order_by(ScheduledMessage.next_fire_at).limit(DISPATCH_BATCH_SIZE).with_for_update(
+                skip_locked=True
+            ).all()
+            
+            if not due:
+                break
+            
+            items = []
+            for schedule in due:
+                # Reminders missed by more than the grace window are skipped, not sent late
+                if schedule.next_fire_at >= grace_cutoff:
+                    items.append([
+                        schedule.phone,
+                        schedule.message_type,
+                        schedule.id,
+                        schedule.generation_mode or "llm",
+                        schedule.scheduled_time,
+                        metrics.epoch_seconds(schedule.next_fire_at),
+                        schedule.name,
+                        schedule.tone,
+                        schedule.language
+                    ])
+                else:
+                    skipped += 1
+                # Popular minutes are spread over a window; the offset is stable per phone until
+                # a rebalance changes the width, which only takes effect from the next day
+                schedule.next_fire_at = advance_after_fire(
+                    schedule.scheduled_time,
+                    schedule.next_fire_at,
+                    now,
+                    _leveled_offset(schedule.phone, schedule.scheduled_time, widths)
+                )
+            
+            # Send chunks are written to the outbox in the same transaction that advances the
+            # rows, and published only after it commits
+            chunks = [items[i:i + DISPATCH_SEND_CHUNK] for i in range(0, len(items), DISPATCH_SEND_CHUNK)]
+            events = [_outbox_event("dispatch.batch", {"items": chunk}) for chunk in chunks]
+            db.add_all(events)
+            with metrics.timed(metrics.DB_COMMIT_SECONDS, "dispatch"):
+                db.commit()
+            if chunks:
+                _request_pool_capacity(Counter(item[1] for item in items if item[3] == "llm"))
+                _publish_dispatched(db, chunks, [event.id for event in events])
+            dispatched += len(items)
+            
+            if len(due) < DISPATCH_BATCH_SIZE:
+                break
+        
+        return {"success": True, "dispatched": dispatched, "skipped": skipped}
+    except Exception as e:
+        db.rollback()
+        return {"success": False, "error": str(e), "dispatched": dispatched}
+    finally:
+        db.close()
+
+@celery_app.task
+def dispatch_due_messages():
+    """Dispatch every shard at once; for single-node setups and manual catch-up runs"""
+    return dispatch_due(None)
+
+def _outbox_event(event_type: str, payload: dict) -> OutboxEvent:
+    """Build an outbox row; callers add it in the same transaction as the change it describes"""
+    return OutboxEvent(event_type=event_type, payload=json.dumps(payload))
+
+@celery_app.task
+def relay_outbox():
+    """Drain committed outbox events to the broker in batches"""
+    
+    relayed = 0
+    db = next(get_db())
+    try:
+        while True:
+            # skip_locked lets overlapping relays split the backlog on PostgreSQL
+            # Dispatch batches are normally published by their dispatcher; only stragglers are relayed
+            events = db.query(OutboxEvent).filter(or_(
+                OutboxEvent.event_type != "dispatch.batch",
+                OutboxEvent.created_at < datetime.utcnow() - timedelta(seconds=OUTBOX_DISPATCH_RELAY_DELAY_SECONDS)
+            )).order_by(OutboxEvent.id).limit(
+                OUTBOX_RELAY_BATCH_SIZE
+            ).with_for_update(skip_locked=True).all()
+            
+            if not events:
+                break
+            
+            # One broker message per batch; rows are removed only after the publish succeeds
+            apply_schedule_events.delay([
+                {"type": event.event_type, "payload": json.loads(event.payload)}
+                for event in events
+            ])
+            db.query(OutboxEvent).filter(
+                OutboxEvent.id.in_([event.id for event in events])
+            ).delete(synchronize_session=False)
+            with metrics.timed(metrics.DB_COMMIT_SECONDS, "outbox_relay"):
+                db.commit()
+            relayed += len(events)
+            
+            if len(events) < OUTBOX_RELAY_BATCH_SIZE:
+                break
+        
+        return {"success": True, "relayed": relayed}
+    except Exception as e:
+        db.rollback()
+        return {"success": False, "error": str(e), "relayed": relayed}
+    finally:
+        db.close()
+
+@celery_app.task
+def apply_schedule_events(events: list):
+    """Side effects of schedule changes, moved off the request path by the outbox"""
+    
+    message_types = set()
+    for event in events:
+        payload = event["payload"]
+        if event["type"] == "schedule.created":
+            message_types.update(payload["message_types"])
+        elif event["type"] == "schedule.cancelled":
+            # Re-assert the tombstone in case the inline write in cancel_schedule failed
+            tombstones.add(payload["schedule_id"])
+        elif event["type"] == "dispatch.batch":
+            # A dispatcher died or failed to publish after committing; send claims drop repeats
+            send_scheduled_batch.delay(payload["items"])
+    
+    # New schedules raise demand; make sure their pools are warm
+    for message_type in message_types:
+        _request_refill_if_low(message_type)
+    
+    return {"success": True, "applied": len(events)}
+
+def _minute_counts_query():
+    """Active schedules per requested HH:MM"""
+    return select(
+        ScheduledMessage.scheduled_time,
+        func.count(ScheduledMessage.id)
+    ).where(
+        ScheduledMessage.is_active == True
+    ).group_by(ScheduledMessage.scheduled_time)
+
+def _active_minute_counts(db: Session) -> dict:
+    return {time_str: count for time_str, count in db.execute(_minute_counts_query())}
+
+@celery_app.task
+def rebalance_send_load():
+    """Resize leveling windows from the current schedule distribution"""
+    
+    db = next(get_db())
+    try:
+        widths = load_leveler.refresh(_active_minute_counts(db))
+        return {"success": True, "leveled_minutes": len(widths)}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
+
+async def aload_report(db: AsyncSession) -> dict:
+    """Requested vs projected sends per minute, with the peak of each"""
+    
+    try:
+        counts = {time_str: count for time_str, count in await db.execute(_minute_counts_query())}
+        histogram = load_leveler.projected_histogram(counts)
+        peak_requested = max(histogram, key=lambda row: row["requested"], default=None)
+        peak_projected = max(histogram, key=lambda row: row["projected"], default=None)
+        
         return {
-            "success": result["success"],
-            "message": message_content,
-            "twilio_result": result
+            "success": True,
+            "window_minutes": load_leveler.window_minutes,
+            "capacity_per_minute": load_leveler.capacity_per_minute,
+            "peak_requested": peak_requested,
+            "peak_projected": peak_projected,
+            "minutes": histogram
         }
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@celery_app.task
+def backfill_rollups(start_day: Optional[str] = None, end_day: Optional[str] = None):
+    """
+    Rebuild daily rollups from existing logs, one committed chunk of days at a time
+    - start_day defaults to the first logged message, end_day (exclusive) to today
+    - Today is left to the live writers unless end_day says otherwise
+    - Days already moved to the log archive are never rebuilt: their rows are gone from
+      the database, so rebuilding would wipe their rollups
+    """
+    
+    db = next(get_db())
+    try:
+        if start_day:
+            start = date.fromisoformat(start_day)
+        else:
+            first_sent_at = db.query(func.min(MessageLog.sent_at)).scalar()
+            if first_sent_at is None:
+                return {"success": True, "days": 0, "rows": 0}
+            start = first_sent_at.date()
+        end = date.fromisoformat(end_day) if end_day else datetime.utcnow().date()
+        
+        requested_start = start
+        last_archived = log_archiver.last_archived_day()
+        if last_archived is not None:
+            start = max(start, last_archived + timedelta(days=1))
+        
+        days = 0
+        rows = 0
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min(end, chunk_start + timedelta(days=ROLLUP_BACKFILL_CHUNK_DAYS))
+            rows += rebuild_days(db, chunk_start, chunk_end)
+            db.commit()
+            days += (chunk_end - chunk_start).days
+            chunk_start = chunk_end
+        
+        result = {"success": True, "days": days, "rows": rows}
+        if start > requested_start:
+            result["skipped_archived_until"] = start.isoformat()
+        return result
     except Exception as e:
         db.rollback()
         return {"success": False, "error": str(e)}
@@ -59,50 +774,92 @@ def send_scheduled_message(phone: str, message_type: str, schedule_id: int):
         db.close()
 
 @celery_app.task
-def schedule_daily_message(phone: str, message_type: str, time_str: str, schedule_id: int):
-    """Schedule a message to be sent daily at a specific time"""
+def archive_old_logs():
+    """Move message logs and replies older than the hot window to the compressed archive"""
     
-    # Parse the time string (HH:MM)
+    cutoff = log_archiver.cutoff()
+    archived = {}
+    db = next(get_db())
     try:
-        hour, minute = map(int, time_str.split(':'))
-    except ValueError:
-        return {"success": False, "error": "Invalid time format"}
-    
-    # Schedule the task to run daily at the specified time
-    celery_app.conf.beat_schedule[f'daily_reminder_{schedule_id}'] = {
-        'task': 'scheduler.send_scheduled_message',
-        'schedule': crontab(hour=hour, minute=minute),
-        'args': (phone, message_type, schedule_id)
+        for table in ARCHIVED_TABLES:
+            archived[table] = log_archiver.archive_table(db, table, cutoff)
+        return {"success": True, "cutoff": cutoff.isoformat(), "archived": archived}
+    except Exception as e:
+        db.rollback()
+        return {"success": False, "error": str(e), "archived": archived}
+    finally:
+        db.close()
+
+def _schedule_values(phone: str, message_type: str, time_str: str, mode: str,
+                     now: datetime, widths: dict, name: Optional[str] = None,
+                     tone: Optional[str] = None, language: Optional[str] = None) -> dict:
+    """Column values for a new schedule; the dispatcher picks it up at next_fire_at"""
+    return {
+        "phone": phone,
+        "message_type": message_type,
+        "scheduled_time": time_str,
+        "created_at": now,
+        "is_active": True,
+        "generation_mode": mode,
+        "name": name,
+        "tone": tone,
+        "language": language,
+        "shard": shard_for(phone),
+        "next_fire_at": compute_next_fire_at(time_str, now, _leveled_offset(phone, time_str, widths))
     }
+
+def _bulk_values(rows: List[dict], widths: dict) -> List[dict]:
+    now = datetime.utcnow()
+    return [
+        _schedule_values(
+            row["phone"], row["message_type"], row["time"], row.get("mode", "llm"), now, widths,
+            row.get("name"), row.get("tone"), row.get("language")
+        )
+        for row in rows
+    ]
+
+def _bulk_created_event(rows: List[dict]) -> OutboxEvent:
+    return _outbox_event("schedule.created", {
+        "count": len(rows),
+        "message_types": sorted({row["message_type"] for row in rows})
+    })
+
+def _cancelled(schedule_id: int, phone: str):
+    """Post-commit side effects of a cancellation"""
+    _bump_versions([phone])
     
-    return {"success": True, "message": f"Scheduled daily reminder at {time_str}"}
+    # Constant-cost tombstone so already-dispatched sends are dropped
+    try:
+        tombstones.add(schedule_id)
+    except Exception:
+        pass
 
-def create_schedule(phone: str, message_type: str, time_str: str) -> dict:
+# Sync versions for Celery tasks and scripts; the API uses the async ones below
+
+def create_schedule(phone: str, message_type: str, time_str: str, mode: str = "llm",
+                    name: Optional[str] = None, tone: Optional[str] = None,
+                    language: Optional[str] = None) -> dict:
     """Create a new scheduled message entry"""
     
     db = next(get_db())
     try:
-        # Create database entry
-        schedule = ScheduledMessage(
-            phone=phone,
-            message_type=message_type,
-            scheduled_time=time_str
-        )
+        schedule = ScheduledMessage(**_schedule_values(
+            phone, message_type, time_str, mode, datetime.utcnow(), _level_widths(), name, tone, language
+        ))
         db.add(schedule)
-        db.commit()
-        db.refresh(schedule)
+        db.flush()
+        schedule_id = schedule.id
         
-        # Schedule the Celery task
-        task = schedule_daily_message.delay(phone, message_type, time_str, schedule.id)
-        
-        # Update the schedule with task ID
-        schedule.task_id = task.id
+        db.add(_outbox_event("schedule.created", {
+            "schedule_id": schedule_id,
+            "message_types": [message_type]
+        }))
         db.commit()
+        _bump_versions([phone])
         
         return {
             "success": True,
-            "schedule_id": schedule.id,
-            "task_id": task.id,
+            "schedule_id": schedule_id,
             "message": f"Scheduled {message_type} reminder for {time_str}"
         }
     except Exception as e:
@@ -111,6 +868,26 @@ def create_schedule(phone: str, message_type: str, time_str: str) -> dict:
     finally:
         db.close()
 
+def create_schedules_bulk(rows: List[dict]) -> dict:
+    """Insert many schedules in one multi-row statement; rows carry phone, message_type, time, mode"""
+    
+    if not rows:
+        return {"success": True, "created": 0}
+    
+    db = next(get_db())
+    try:
+        db.execute(insert(ScheduledMessage), _bulk_values(rows, _level_widths()))
+        db.add(_bulk_created_event(rows))
+        db.commit()
+        _bump_versions([row["phone"] for row in rows])
+        
+        return {"success": True, "created": len(rows)}
+    except Exception as e:
+        db.rollback()
+        return {"success": False, "error": str(e)}
+    finally:
+        db.close()
+
 def cancel_schedule(schedule_id: int) -> dict:
     """Cancel a scheduled message"""
     
@@ -120,17 +897,96 @@ def cancel_schedule(schedule_id: int) -> dict:
         if not schedule:
             return {"success": False, "error": "Schedule not found"}
         
-        # Cancel the Celery task
-        if schedule.task_id:
-            celery_app.control.revoke(schedule.task_id, terminate=True)
-        
-        # Deactivate the schedule
+        # Deactivate the schedule and drop it out of the dispatcher index
         schedule.is_active = False
+        schedule.next_fire_at = None
+        
+        phone = schedule.phone
+        db.add(_outbox_event("schedule.cancelled", {"schedule_id": schedule.id}))
         db.commit()
+        _cancelled(schedule_id, phone)
         
         return {"success": True, "message": "Schedule cancelled"}
     except Exception as e:
         db.rollback()
         return {"success": False, "error": str(e)}
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Async versions on the request's AsyncSession
+
+async def acreate_schedule(db: AsyncSession, phone: str, message_type: str, time_str: str,
+                           mode: str = "llm", name: Optional[str] = None, tone: Optional[str] = None,
+                           language: Optional[str] = None) -> dict:
+    """Create a new scheduled message entry"""
+    
+    try:
+        # Redis calls are sync; keep them off the event loop
+        widths = await run_in_threadpool(_level_widths)
+        schedule = ScheduledMessage(**_schedule_values(
+            phone, message_type, time_str, mode, datetime.utcnow(), widths, name, tone, language
+        ))
+        db.add(schedule)
+        await db.flush()
+        schedule_id = schedule.id
+        
+        db.add(_outbox_event("schedule.created", {
+            "schedule_id": schedule_id,
+            "message_types": [message_type]
+        }))
+        with metrics.timed(metrics.DB_COMMIT_SECONDS, "schedule_create"):
+            await db.commit()
+        await run_in_threadpool(_bump_versions, [phone])
+        
+        return {
+            "success": True,
+            "schedule_id": schedule_id,
+            "message": f"Scheduled {message_type} reminder for {time_str}"
+        }
+    except Exception as e:
+        await db.rollback()
+        return {"success": False, "error": str(e)}
+
+async def acreate_schedules_bulk(db: AsyncSession, rows: List[dict]) -> dict:
+    """Insert many schedules in one multi-row statement; rows carry phone, message_type, time, mode"""
+    
+    if not rows:
+        return {"success": True, "created": 0}
+    
+    try:
+        widths = await run_in_threadpool(_level_widths)
+        await db.execute(insert(ScheduledMessage), _bulk_values(rows, widths))
+        db.add(_bulk_created_event(rows))
+        with metrics.timed(metrics.DB_COMMIT_SECONDS, "schedule_bulk_create"):
+            await db.commit()
+        await run_in_threadpool(_bump_versions, [row["phone"] for row in rows])
+        
+        return {"success": True, "created": len(rows)}
+    except Exception as e:
+        await db.rollback()
+        return {"success": False, "error": str(e)}
+
+async def acancel_schedule(db: AsyncSession, schedule_id: int) -> dict:
+    """Cancel a scheduled message"""
+    
+    try:
+        schedule = (await db.execute(
+            select(ScheduledMessage).where(ScheduledMessage.id == schedule_id)
+        )).scalar_one_or_none()
+        if not schedule:
+            return {"success": False, "error": "Schedule not found"}
+        
+        # Deactivate the schedule and drop it out of the dispatcher index
+        schedule.is_active = False
+        schedule.next_fire_at = None
+        
+        phone = schedule.phone
+        db.add(_outbox_event("schedule.cancelled", {"schedule_id": schedule.id}))
+        with metrics.timed(metrics.DB_COMMIT_SECONDS, "schedule_cancel"):
+            await db.commit()
+        await run_in_threadpool(_cancelled, schedule_id, phone)
+        
+        return {"success": True, "message": "Schedule cancelled"}
+    except Exception as e:
+        await db.rollback()
+        return {"success": False, "error": str(e)}
@@ -0,0 +1,225 @@
+from typing import Dict, List, Optional, Set
+import logging
+import os
+import time
+import threading
+import zlib
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Dispatch sharding settings; DISPATCH_SHARDS is baked into ScheduledMessage.shard, so
+# changing it requires recomputing that column
+DISPATCH_SHARDS = int(os.getenv("DISPATCH_SHARDS", "64"))
+DISPATCH_LEASE_SECONDS = float(os.getenv("DISPATCH_LEASE_SECONDS", "30"))
+# Heartbeat and lease renewal run on their own thread at this interval, independent of scans
+DISPATCH_RENEW_SECONDS = float(os.getenv("DISPATCH_RENEW_SECONDS", str(DISPATCH_LEASE_SECONDS / 3)))
+
+def shard_for(phone: str, shards: int = DISPATCH_SHARDS) -> int:
+    """Stable shard of a phone; every schedule for a phone lands on the same dispatcher"""
+    return zlib.crc32(phone.encode("utf-8")) % shards
+
+class RedisLeaseStore:
+    """Shard leases and dispatcher heartbeats in Redis"""
+    
+    # Only the holder may extend or drop a lease
+    RENEW_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+    
+    def __init__(self, client, prefix: str = "dispatch"):
+        self.redis = client
+        self.prefix = prefix
+        self._renew = client.register_script(self.RENEW_SCRIPT)
+        self._release = client.register_script(self.RELEASE_SCRIPT)
+    
+    def _lease_key(self, shard: int) -> str:
+        return f"{self.prefix}:lease:{shard}"
+    
+    def heartbeat(self, node: str, ttl: float):
+        nodes_key = f"{self.prefix}:nodes"
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zadd(nodes_key, {node: now})
+        pipe.zremrangebyscore(nodes_key, "-inf", now - ttl * 10)
+        pipe.execute()
+    
+    def live_nodes(self, ttl: float) -> List[str]:
+        return sorted(self.redis.zrangebyscore(f"{self.prefix}:nodes", time.time() - ttl, "+inf"))
+    
+    def leave(self, node: str):
+        self.redis.zrem(f"{self.prefix}:nodes", node)
+    
+    def acquire(self, shard: int, node: str, ttl: float) -> bool:
+        return bool(self.redis.set(self._lease_key(shard), node, nx=True, px=int(ttl * 1000)))
+    
+    def renew(self, shard: int, node: str, ttl: float) -> bool:
+        return bool(self._renew(keys=[self._lease_key(shard)], args=[node, int(ttl * 1000)]))
+    
+    def release(self, shard: int, node: str):
+        self._release(keys=[self._lease_key(shard)], args=[node])
+
+class MemoryLeaseStore:
+    """In-process stand-in for RedisLeaseStore, for tests and single-process runs"""
+    
+    def __init__(self):
+        self._leases: Dict[int, tuple] = {}  # shard -> (node, expires_at)
+        self._nodes: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def heartbeat(self, node: str, ttl: float):
+        with self._lock:
+            self._nodes[node] = time.monotonic()
+    
+    def live_nodes(self, ttl: float) -> List[str]:
+        cutoff = time.monotonic() - ttl
+        with self._lock:
+            return sorted(node for node, seen in self._nodes.items() if seen > cutoff)
+    
+    def leave(self, node: str):
+        with self._lock:
+            self._nodes.pop(node, None)
+    
+    def _holder(self, shard: int) -> Optional[str]:
+        lease = self._leases.get(shard)
+        if lease and lease[1] > time.monotonic():
+            return lease[0]
+        return None
+    
+    def acquire(self, shard: int, node: str, ttl: float) -> bool:
+        with self._lock:
+            if self._holder(shard) is not None:
+                return False
+            self._leases[shard] = (node, time.monotonic() + ttl)
+            return True
+    
+    def renew(self, shard: int, node: str, ttl: float) -> bool:
+        with self._lock:
+            if self._holder(shard) != node:
+                return False
+            self._leases[shard] = (node, time.monotonic() + ttl)
+            return True
+    
+    def release(self, shard: int, node: str):
+        with self._lock:
+            if self._holder(shard) == node:
+                del self._leases[shard]
+
+class ShardCoordinator:
+    """
+    Decides which dispatch shards this instance owns
+    - Each shard has one lease; only its holder dispatches it
+    - Preferred owners come from rendezvous hashing over live instances, so adding or
+      removing an instance only moves that instance's share of shards
+    - An instance that stops heartbeating loses its leases when they expire and the
+      surviving instances take its shards over
+    - start() renews from a background thread, so a long dispatch scan cannot outlive
+      the leases; a shard counts as held only until its last successful renewal expires
+    """
+    
+    def __init__(self, store, node_id: str, shards: int, lease_seconds: float):
+        self.store = store
+        self.node_id = node_id
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self._leases: Dict[int, float] = {}  # shard -> monotonic time its lease is safe until
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+    
+    @property
+    def owned(self) -> Set[int]:
+        with self._lock:
+            return set(self._leases)
+    
+    def holds(self, shard: int) -> bool:
+        """True while this instance's lease on the shard is known to be live"""
+        with self._lock:
+            return self._leases.get(shard, 0) > time.monotonic()
+    
+    def held(self) -> List[int]:
+        now = time.monotonic()
+        with self._lock:
+            return sorted(shard for shard, until in self._leases.items() if until > now)
+    
+    def _set(self, shard: int, until: Optional[float]):
+        with self._lock:
+            if until is None:
+                self._leases.pop(shard, None)
+            else:
+                self._leases[shard] = until
+    
+    @staticmethod
+    def preferred_owner(shard: int, live_nodes: List[str]) -> Optional[str]:
+        if not live_nodes:
+            return None
+        return max(live_nodes, key=lambda node: zlib.crc32(f"{node}:{shard}".encode("utf-8")))
+    
+    def rebalance(self) -> Set[int]:
+        """Heartbeat, renew held leases, hand off shards preferred elsewhere, claim free preferred ones"""
+        self.store.heartbeat(self.node_id, self.lease_seconds)
+        live = self.store.live_nodes(self.lease_seconds)
+        if self.node_id not in live:
+            live = sorted(live + [self.node_id])
+        
+        # Leases are timed from before each call, so local expiry never trails Redis
+        for shard in self.owned:
+            started = time.monotonic()
+            if self.preferred_owner(shard, live) != self.node_id:
+                self._set(shard, None)
+                self.store.release(shard, self.node_id)
+            elif self.store.renew(shard, self.node_id, self.lease_seconds):
+                self._set(shard, started + self.lease_seconds)
+            else:
+                self._set(shard, None)
+        
+        owned = self.owned
+        for shard in range(self.shards):
+            if shard in owned or self.preferred_owner(shard, live) != self.node_id:
+                continue
+            started = time.monotonic()
+            if self.store.acquire(shard, self.node_id, self.lease_seconds):
+                self._set(shard, started + self.lease_seconds)
+        
+        return self.owned
+    
+    def start(self, renew_seconds: float):
+        """Heartbeat and renew every renew_seconds from a daemon thread"""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, args=(renew_seconds,), name="shard-lease-renewer", daemon=True)
+        self._thread.start()
+    
+    def _run(self, renew_seconds: float):
+        while not self._stopping.is_set():
+            try:
+                self.rebalance()
+            except Exception as e:
+                # Without the store we cannot prove ownership, so hold nothing
+                logger.warning("Shard rebalance failed: %s", e)
+                with self._lock:
+                    self._leases = {}
+            self._stopping.wait(renew_seconds)
+    
+    def stop(self):
+        """Stop renewing and hand every shard over immediately"""
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.release_all()
+    
+    def release_all(self):
+        for shard in self.owned:
+            self._set(shard, None)
+            self.store.release(shard, self.node_id)
+        self.store.leave(self.node_id)
@@ -0,0 +1,88 @@
+from datetime import datetime, date
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, DailyRollup, MessageLog
+from rollups import apply_message_logs
+from delivery_status import DeliveryStatusBuffer
+
+SENT_AT = datetime(2026, 3, 7, 8, 0)
+
+def _buffer(tmp_path, sids):
+    engine = create_engine(f"sqlite:///{tmp_path / 'status.db'}")
+    Base.metadata.create_all(engine)
+    session_factory = sessionmaker(bind=engine)
+    
+    rows = [
+        {"phone": "+15550000001", "message_type": "meal", "sent_at": SENT_AT, "status": status, "message_sid": sid}
+        for sid, status in sids.items()
+    ]
+    db = session_factory()
+    db.add_all(MessageLog(message_content="hi", **row) for row in rows)
+    apply_message_logs(db, rows)
+    db.commit()
+    db.close()
+    
+    # Long interval: tests flush explicitly
+    buffer = DeliveryStatusBuffer(session_factory, flush_sids=1000, flush_interval_ms=60000,
+                                  max_pending=100, retry_seconds=0)
+    return buffer, session_factory
+
+def _statuses(session_factory):
+    db = session_factory()
+    try:
+        return dict(db.query(MessageLog.message_sid, MessageLog.status))
+    finally:
+        db.close()
+
+def test_merge_keeps_highest_rank():
+    buffer = DeliveryStatusBuffer(sessionmaker(), flush_sids=1000, flush_interval_ms=60000,
+                                  max_pending=100, retry_seconds=0)
+    buffer._merge("SM1", "read", 2.0)
+    buffer._merge("SM1", "delivered", 1.0)
+    buffer._merge("SM2", "delivered", 1.0)
+    buffer._merge("SM2", "read", 2.0)
+    
+    # Lower ranks never win; the earliest first_seen is kept for retries
+    assert buffer._pending == {"SM1": ("read", 2.0), "SM2": ("read", 1.0)}
+
+def test_callbacks_at_or_below_sent_are_dropped(tmp_path):
+    buffer, _ = _buffer(tmp_path, {})
+    try:
+        for status in ("accepted", "queued", "sending", "sent", "bogus", None):
+            assert not buffer.add("SM1", status)
+        assert buffer._pending == {}
+    finally:
+        buffer.close()
+
+def test_out_of_order_callbacks_never_move_backwards(tmp_path):
+    buffer, session_factory = _buffer(tmp_path, {"SM1": "sent", "SM2": "sent", "SM3": "read"})
+    try:
+        buffer.add("SM1", "read")
+        buffer.add("SM1", "delivered")
+        buffer.add("SM2", "delivered")
+        buffer.flush()
+        buffer.add("SM2", "failed")  # Equal rank in a later flush does not replace the row
+        buffer.add("SM3", "delivered")
+        buffer.flush()
+    finally:
+        buffer.close()
+    
+    assert _statuses(session_factory) == {"SM1": "read", "SM2": "delivered", "SM3": "read"}
+
+def test_failure_callbacks_move_rollup_counts(tmp_path):
+    buffer, session_factory = _buffer(tmp_path, {"SM1": "sent", "SM2": "sent", "SM3": "sent"})
+    try:
+        buffer.add("SM1", "undelivered")
+        buffer.add("SM2", "failed")
+        buffer.add("SM3", "delivered")
+        buffer.flush()
+        # A repeated failure report matches no row and counts nothing twice
+        buffer.add("SM1", "failed")
+        buffer.flush()
+    finally:
+        buffer.close()
+    
+    db = session_factory()
+    rollup = db.query(DailyRollup).one()
+    db.close()
+    assert (rollup.day, rollup.sent, rollup.failed) == (date(2026, 3, 7), 1, 2)
@@ -0,0 +1,61 @@
+import os
+import json
+from types import SimpleNamespace
+
+# gpt_utils builds its clients at import; nothing here reaches OpenAI or Twilio
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACtest")
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test")
+os.environ.setdefault("TWILIO_PHONE_NUMBER", "+15550000000")
+
+import pytest
+from gpt_utils import ReplyCache, gpt_generator
+
+def _cache():
+    return ReplyCache(max_keys=10, ttl_seconds=60, variants=2, use_intents=True)
+
+@pytest.mark.parametrize("text", ["👍", "ok 👍", "Done!", "thanks 🙌🏽", "💪💪", "OK"])
+def test_ack_texts_are_cacheable(text):
+    assert _cache().key_for(text) is not None
+
+@pytest.mark.parametrize("text", ["😭", "ok 😭", "🤕", "done 💔", "👍😢"])
+def test_distress_emoji_is_never_an_ack(text):
+    assert _cache().key_for(text) is None
+
+@pytest.mark.parametrize("text", ["?", "ok?", "👍?", "done??"])
+def test_questions_are_never_cached(text):
+    assert _cache().key_for(text) is None
+
+def test_intent_keys():
+    cache = _cache()
+    
+    assert cache.key_for("👍") == "intent:ack"
+    assert cache.key_for("Thank you!") == "intent:thanks"
+    assert cache.key_for("all done") == "intent:done"
+    assert cache.key_for("...") is None
+    assert cache.key_for("I ran 5k but my knee hurts") is None
+
+def _complete_with(content):
+    def complete(call_type, **kwargs):
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    return complete
+
+@pytest.mark.parametrize("payload, expected", [
+    ({"messages": ["Time to move!", "Eat your greens today"]}, ["Time to move!", "Eat your greens today"]),
+    (["Time to move!"], ["Time to move!"]),
+    ({"messages": "Time to move!"}, []),
+    ({"messages": None}, []),
+    ({"other": ["Time to move!"]}, []),
+    ("Time to move!", []),
+    ({"messages": ["Time to move!", 42, None, {"text": "x"}]}, ["Time to move!"]),
+])
+def test_request_messages_payload_shapes(monkeypatch, payload, expected):
+    monkeypatch.setattr(gpt_generator, "_complete", _complete_with(json.dumps(payload)))
+    
+    assert gpt_generator._request_motivational_messages("workout", 2) == expected
+
+def test_generated_messages_drop_short_and_duplicate_entries(monkeypatch):
+    candidates = ["Go!", "Move", "x" * 12, "Time to move!", "time to move!", "Eat your greens today", "y" * 161]
+    monkeypatch.setattr(gpt_generator, "_complete", _complete_with(json.dumps({"messages": candidates})))
+    
+    assert gpt_generator.generate_motivational_messages("workout", 5) == ["Time to move!", "Eat your greens today"]
@@ -0,0 +1,78 @@
+from datetime import datetime, date
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from models import Base, DailyRollup, MessageLog, UserReply
+from rollups import apply_message_logs, rebuild_days, current_streaks
+
+LOGS = [
+    {"phone": "+15550000001", "message_type": "meal", "sent_at": datetime(2026, 3, 7, 8, 0), "status": "sent"},
+    {"phone": "+15550000001", "message_type": "meal", "sent_at": datetime(2026, 3, 7, 12, 30), "status": "failed"},
+    {"phone": "+15550000001", "message_type": "workout", "sent_at": datetime(2026, 3, 7, 18, 0), "status": "delivered"},
+    {"phone": "+15550000001", "message_type": "meal", "sent_at": datetime(2026, 3, 8, 8, 0), "status": "undelivered"},
+    {"phone": "+15550000002", "message_type": "meal", "sent_at": datetime(2026, 3, 7, 23, 59), "status": "sent"},
+    {"phone": "+15550000002", "message_type": "meal", "sent_at": datetime(2026, 3, 8, 0, 1), "status": None},
+]
+
+def _session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'rollups.db'}")
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+def _log(db, rows):
+    db.add_all(MessageLog(message_content="hi", **row) for row in rows)
+
+def _rollups(db):
+    return {
+        (row.phone, row.day, row.message_type): (row.sent, row.failed, row.last_sent_at)
+        for row in db.query(DailyRollup)
+    }
+
+def test_live_tally_matches_backfill(tmp_path):
+    db = _session(tmp_path)
+    _log(db, LOGS)
+    # Two flushes of the log buffer, split mid-day
+    apply_message_logs(db, LOGS[:2])
+    apply_message_logs(db, LOGS[2:])
+    db.commit()
+    live = _rollups(db)
+    
+    rebuild_days(db, date(2026, 3, 7), date(2026, 3, 9))
+    db.commit()
+    
+    assert _rollups(db) == live
+    assert live[("+15550000001", date(2026, 3, 7), "meal")] == (1, 1, datetime(2026, 3, 7, 12, 30))
+    assert live[("+15550000002", date(2026, 3, 8), "meal")] == (1, 0, datetime(2026, 3, 8, 0, 1))
+
+def test_backfill_replaces_rather_than_adds(tmp_path):
+    db = _session(tmp_path)
+    _log(db, LOGS)
+    apply_message_logs(db, LOGS)
+    db.commit()
+    live = _rollups(db)
+    
+    for _ in range(2):
+        rebuild_days(db, date(2026, 3, 7), date(2026, 3, 9))
+        db.commit()
+    
+    assert _rollups(db) == live
+
+def test_backfilled_streak_is_current(tmp_path):
+    db = _session(tmp_path)
+    phone = "+15550000001"
+    _log(db, [
+        {"phone": phone, "message_type": "workout", "sent_at": datetime(2026, 3, day, 7, 0), "status": "sent"}
+        for day in (6, 7, 8)
+    ])
+    db.add_all(
+        UserReply(phone=phone, incoming_message="done", bot_response="Nice!", received_at=datetime(2026, 3, day, 7, 5))
+        for day in (6, 7, 8)
+    )
+    db.commit()
+    
+    # Ascending chunks, as backfill_rollups runs them
+    rebuild_days(db, date(2026, 3, 6), date(2026, 3, 8))
+    rebuild_days(db, date(2026, 3, 8), date(2026, 3, 9))
+    db.commit()
+    
+    assert current_streaks(db, [(phone, "workout")], date(2026, 3, 9)) == {(phone, "workout"): 3}
+    assert current_streaks(db, [(phone, "workout")], date(2026, 3, 10)) == {}
@@ -0,0 +1,130 @@
+import os
+from datetime import datetime, timedelta
+
+# scheduler builds its clients at import; nothing here reaches OpenAI, Twilio or Redis
+os.environ.setdefault("OPENAI_API_KEY", "test")
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACtest")
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test")
+os.environ.setdefault("TWILIO_PHONE_NUMBER", "+15550000000")
+
+import scheduler
+from scheduler import SentMarkers, compute_next_fire_at, advance_after_fire
+
+class FakeRedis:
+    """Just enough of redis-py for SentMarkers; expiry is not modelled"""
+    
+    def __init__(self):
+        self.values = {}
+    
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value
+        return True
+    
+    def get(self, key):
+        return self.values.get(key)
+    
+    def delete(self, key):
+        self.values.pop(key, None)
+    
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+    
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name, args, kwargs))
+    
+    def execute(self):
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.calls]
+
+DUE_AT = 1_800_000_000.0
+
+def test_next_fire_crosses_midnight():
+    assert compute_next_fire_at("00:05", datetime(2026, 3, 7, 23, 58)) == datetime(2026, 3, 8, 0, 5)
+    assert compute_next_fire_at("23:55", datetime(2026, 3, 7, 23, 58)) == datetime(2026, 3, 8, 23, 55)
+
+def test_negative_offset_fires_the_evening_before_without_repeating():
+    # 00:05 shifted by -10 fires at 23:55; one minute later the next one is a day away
+    assert compute_next_fire_at("00:05", datetime(2026, 3, 7, 23, 50), -10) == datetime(2026, 3, 7, 23, 55)
+    assert compute_next_fire_at("00:05", datetime(2026, 3, 7, 23, 56), -10) == datetime(2026, 3, 8, 23, 55)
+
+def test_fire_times_stay_on_utc_across_dst_changes():
+    # Schedules are UTC, so US and EU clock changes must not move or skip an occurrence
+    for start in (datetime(2026, 3, 7, 8), datetime(2026, 3, 28, 8), datetime(2026, 10, 24, 8), datetime(2026, 10, 31, 8)):
+        fired_at = compute_next_fire_at("07:30", start)
+        for _ in range(3):
+            next_fire = advance_after_fire("07:30", fired_at, fired_at)
+            assert next_fire - fired_at == timedelta(days=1)
+            assert (next_fire.hour, next_fire.minute) == (7, 30)
+            fired_at = next_fire
+
+def test_advance_after_fire_across_midnight_with_offset_change():
+    fired_at = datetime(2026, 3, 7, 23, 55)  # 00:05 on the 8th, shifted by -10
+    
+    assert advance_after_fire("00:05", fired_at, fired_at, -10) == datetime(2026, 3, 8, 23, 55)
+    # A wider window never brings the same day's occurrence back
+    assert advance_after_fire("00:05", fired_at, fired_at, 5) == datetime(2026, 3, 9, 0, 10)
+
+def test_advance_after_outage_skips_to_next_occurrence():
+    fired_at = datetime(2026, 3, 1, 7, 30)
+    
+    assert advance_after_fire("07:30", fired_at, datetime(2026, 3, 5, 12)) == datetime(2026, 3, 6, 7, 30)
+
+def test_only_one_copy_claims_a_send():
+    markers = SentMarkers(FakeRedis(), ttl_seconds=600, claim_seconds=60)
+    
+    assert markers.claim(1, DUE_AT)
+    assert not markers.claim(1, DUE_AT)
+    # Another occurrence or schedule is independent
+    assert markers.claim(1, DUE_AT + 86400)
+    assert markers.claim(2, DUE_AT)
+
+def test_released_claim_can_be_retried():
+    markers = SentMarkers(FakeRedis(), ttl_seconds=600, claim_seconds=60)
+    markers.claim(1, DUE_AT)
+    
+    markers.release(1, DUE_AT)
+    
+    assert markers.sent([(1, DUE_AT)]) == set()
+    assert markers.claim(1, DUE_AT)
+
+def test_marked_send_blocks_later_copies():
+    markers = SentMarkers(FakeRedis(), ttl_seconds=600, claim_seconds=60)
+    markers.claim(1, DUE_AT)
+    markers.claim(2, DUE_AT)
+    
+    markers.mark([(1, DUE_AT)])
+    
+    # A claim in flight is not "sent" yet, but still blocks a second claim
+    assert markers.sent([(1, DUE_AT), (2, DUE_AT)]) == {1}
+    assert not markers.claim(1, DUE_AT)
+
+def test_finish_send_marks_success_and_releases_failure(monkeypatch):
+    markers = SentMarkers(FakeRedis(), ttl_seconds=600, claim_seconds=60)
+    monkeypatch.setattr(scheduler, "sent_markers", markers)
+    
+    assert scheduler._claim_send(1, DUE_AT) and scheduler._claim_send(2, DUE_AT)
+    scheduler._finish_send(1, DUE_AT, {"success": True})
+    scheduler._finish_send(2, DUE_AT, {"success": False, "error": "503"})
+    
+    assert markers.sent([(1, DUE_AT), (2, DUE_AT)]) == {1}
+    assert not scheduler._claim_send(1, DUE_AT)
+    assert scheduler._claim_send(2, DUE_AT)
+
+def test_skipped_send_keeps_the_other_copys_claim(monkeypatch):
+    markers = SentMarkers(FakeRedis(), ttl_seconds=600, claim_seconds=60)
+    monkeypatch.setattr(scheduler, "sent_markers", markers)
+    scheduler._claim_send(1, DUE_AT)
+    
+    scheduler._finish_send(1, DUE_AT, {"success": False, "skipped": True})
+    
+    assert not scheduler._claim_send(1, DUE_AT)
+
+def test_ad_hoc_sends_are_never_deduplicated():
+    assert scheduler._claim_send(1, None)
+    assert scheduler._claim_send(1, None)
@@ -0,0 +1,100 @@
+import time
+from sharding import MemoryLeaseStore, ShardCoordinator
+
+SHARDS = 64
+LEASE_SECONDS = 0.2
+
+def _cluster(store, names):
+    return {name: ShardCoordinator(store, name, SHARDS, LEASE_SECONDS) for name in names}
+
+def _rebalance(coordinators, rounds=2):
+    # A second round lets released shards be claimed by their new preferred owner
+    for _ in range(rounds):
+        for coordinator in coordinators.values():
+            coordinator.rebalance()
+    return {name: set(coordinator.held()) for name, coordinator in coordinators.items()}
+
+def _assert_partition(held):
+    owners = [shard for shards in held.values() for shard in shards]
+    assert sorted(owners) == list(range(SHARDS))
+
+def test_shards_are_split_without_overlap():
+    held = _rebalance(_cluster(MemoryLeaseStore(), ["a", "b", "c"]))
+    
+    _assert_partition(held)
+    assert all(held.values())
+
+def test_survivors_take_over_after_node_dies():
+    store = MemoryLeaseStore()
+    coordinators = _cluster(store, ["a", "b", "c"])
+    before = _rebalance(coordinators)
+    
+    # "c" dies without releasing: its leases and heartbeat simply expire
+    del coordinators["c"]
+    time.sleep(LEASE_SECONDS * 1.5)
+    after = _rebalance(coordinators)
+    
+    _assert_partition(after)
+    assert before["c"] <= after["a"] | after["b"]
+    # Survivors keep what they had; only the dead node's shards move
+    assert before["a"] <= after["a"] and before["b"] <= after["b"]
+
+def test_dead_node_shards_wait_for_lease_expiry():
+    store = MemoryLeaseStore()
+    coordinators = _cluster(store, ["a", "b"])
+    before = _rebalance(coordinators)
+    
+    del coordinators["b"]
+    after = _rebalance(coordinators)
+    
+    # "b" still counts as live and holds its leases, so "a" cannot claim them yet
+    assert after["a"] == before["a"]
+
+def test_adding_node_moves_only_its_share():
+    store = MemoryLeaseStore()
+    coordinators = _cluster(store, ["a", "b", "c"])
+    before = _rebalance(coordinators)
+    
+    coordinators.update(_cluster(store, ["d"]))
+    after = _rebalance(coordinators)
+    
+    _assert_partition(after)
+    assert after["d"]
+    for name in ["a", "b", "c"]:
+        assert after[name] <= before[name]
+    # Every shard that changed hands went to the new node
+    moved = {shard for name in ["a", "b", "c"] for shard in before[name] - after[name]}
+    assert moved == after["d"]
+
+def test_release_all_hands_shards_over_immediately():
+    store = MemoryLeaseStore()
+    coordinators = _cluster(store, ["a", "b"])
+    _rebalance(coordinators)
+    
+    coordinators.pop("b").release_all()
+    after = _rebalance(coordinators)
+    
+    assert after["a"] == set(range(SHARDS))
+
+def test_failed_renewal_drops_shard():
+    store = MemoryLeaseStore()
+    coordinator = ShardCoordinator(store, "a", SHARDS, LEASE_SECONDS)
+    coordinator.rebalance()
+    
+    # Another holder took the lease over behind our back
+    store.release(0, "a")
+    assert store.acquire(0, "b", LEASE_SECONDS)
+    coordinator.rebalance()
+    
+    assert not coordinator.holds(0)
+    assert 0 not in coordinator.held()
+
+def test_background_renewal_keeps_leases_alive():
+    coordinator = ShardCoordinator(MemoryLeaseStore(), "a", SHARDS, LEASE_SECONDS)
+    coordinator.start(LEASE_SECONDS / 4)
+    try:
+        time.sleep(LEASE_SECONDS * 3)
+        assert coordinator.held() == list(range(SHARDS))
+    finally:
+        coordinator.stop()
+    assert coordinator.held() == []
@@ -1,53 +1,254 @@
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
+from twilio.base.exceptions import TwilioRestException
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ConnectionError as RequestsConnectionError, ConnectTimeout
+from urllib3.exceptions import NewConnectionError
+from concurrent.futures import ThreadPoolExecutor
 import os
+import time
+import random
+import re
+import threading
+import functools
+import logging
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Callable, Optional, List, Tuple, Dict
+from redis_utils import redis_client
+import metrics
+
+logger = logging.getLogger(__name__)
 
 # Force reload environment variables
 load_dotenv(override=True)
 
+# Send engine settings
+TWILIO_SEND_RATE = float(os.getenv("TWILIO_SEND_RATE", "1"))  # messages/sec per sender
+TWILIO_SEND_BURST = int(os.getenv("TWILIO_SEND_BURST", "1"))
+TWILIO_MAX_CONCURRENT_SENDS = int(os.getenv("TWILIO_MAX_CONCURRENT_SENDS", "8"))
+TWILIO_MAX_RETRIES = int(os.getenv("TWILIO_MAX_RETRIES", "4"))
+TWILIO_RETRY_BASE_DELAY = float(os.getenv("TWILIO_RETRY_BASE_DELAY", "0.5"))
+TWILIO_RETRY_MAX_DELAY = float(os.getenv("TWILIO_RETRY_MAX_DELAY", "8"))
+TWILIO_HTTP_TIMEOUT = float(os.getenv("TWILIO_HTTP_TIMEOUT", "10"))
+TWILIO_API_BASE_URL = os.getenv("TWILIO_API_BASE_URL")  # e.g. a local stand-in for benchmarks
+# Public URL of POST /webhook/twilio-status; unset leaves callbacks to the Messaging Service config
+TWILIO_STATUS_CALLBACK_URL = os.getenv("TWILIO_STATUS_CALLBACK_URL")
+
+# messages.create is not idempotent: only retry responses that say the message was not
+# accepted. A 500/502/504 may follow an accepted message, and retrying it double-sends.
+RETRYABLE_STATUSES = {429, 503}
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available"""
+    
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = max(1, capacity)
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RedisRateLimiter:
+    """
+    GCRA rate limit shared by every process sending from the same number
+    - One Redis key per sender holds the theoretical arrival time of the next send
+    - acquire() reserves the next slot atomically and sleeps until it comes up
+    - Falls back to an in-process TokenBucket while Redis is unreachable
+    """
+    
+    # Times come from Redis so every process shares one clock; all values in microseconds
+    RESERVE_SCRIPT = """
+    local now_parts = redis.call('time')
+    local now = tonumber(now_parts[1]) * 1000000 + tonumber(now_parts[2])
+    local interval = tonumber(ARGV[1])
+    local tolerance = tonumber(ARGV[2])
+    local tat = tonumber(redis.call('get', KEYS[1]) or now)
+    if tat < now then
+        tat = now
+    end
+    local next_tat = tat + interval
+    redis.call('set', KEYS[1], next_tat, 'px', math.ceil((next_tat - now) / 1000) + 1000)
+    return math.max(0, next_tat - tolerance - now)
+    """
+    
+    def __init__(self, client, key: str, rate: float, burst: int):
+        self.key = key
+        self.interval_us = int(1000000 / rate)
+        self.tolerance_us = self.interval_us * max(1, burst)
+        self._reserve = client.register_script(self.RESERVE_SCRIPT)
+        self.local = TokenBucket(rate, burst)
+    
+    def acquire(self):
+        try:
+            wait_us = self._reserve(keys=[self.key], args=[self.interval_us, self.tolerance_us])
+        except Exception as e:
+            logger.warning(f"Shared rate limit unavailable, pacing {self.key} per process: {str(e)}")
+            self.local.acquire()
+            return
+        if wait_us > 0:
+            time.sleep(wait_us / 1000000)
+
+def _never_sent(error: Exception) -> bool:
+    """True for connection failures raised before the request reached Twilio"""
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(error, RequestsConnectionError) and isinstance(reason, NewConnectionError)
+
+class BaseUrlHttpClient(TwilioHttpClient):
+    """Sends every API request to base_url instead of the Twilio host"""
+    
+    def __init__(self, base_url: str, **kwargs):
+        super().__init__(**kwargs)
+        self.base_url = base_url.rstrip("/")
+    
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, re.sub(r"^https://[^/]+", self.base_url, url), *args, **kwargs)
+
 class TwilioService:
     def __init__(self):
         # Get environment variables
         self.account_sid = os.getenv("TWILIO_ACCOUNT_SID")
         self.auth_token = os.getenv("TWILIO_AUTH_TOKEN")
         self.phone_number = os.getenv("TWILIO_PHONE_NUMBER")
-        
-        # Debug logging
-        print("\n=== Twilio Configuration ===")
-        print(f"Account SID: {self.account_sid}")
-        print(f"Auth Token: {self.auth_token}")
-        print(f"Phone Number: {self.phone_number}")
-        print("==========================\n")
+        self.messaging_service_sid = os.getenv("TWILIO_MESSAGING_SERVICE_SID")
         
         if not all([self.account_sid, self.auth_token, self.phone_number]):
             raise ValueError("Missing required Twilio environment variables")
-            
-        self.client = Client(self.account_sid, self.auth_token)
+        
+        # Keep-alive HTTP pool sized for the concurrent senders
+        if TWILIO_API_BASE_URL:
+            http_client = BaseUrlHttpClient(TWILIO_API_BASE_URL, pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+        else:
+            http_client = TwilioHttpClient(pool_connections=True, timeout=TWILIO_HTTP_TIMEOUT)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TWILIO_MAX_CONCURRENT_SENDS)
+        http_client.session.mount("https://", adapter)
+        http_client.session.mount("http://", adapter)
+        
+        self.client = Client(self.account_sid, self.auth_token, http_client=http_client)
+        self.executor = ThreadPoolExecutor(
+            max_workers=TWILIO_MAX_CONCURRENT_SENDS,
+            thread_name_prefix="twilio-send"
+        )
+        self.buckets: Dict[str, RedisRateLimiter] = {}
+        self.buckets_lock = threading.Lock()
     
-    def send_sms(self, to_phone: str, message: str) -> dict:
-        """Send SMS message via Twilio"""
-        try:
-            print(f"Attempting to send SMS to {to_phone} with message: {message}")
-            print(f"Using Twilio credentials - Account SID: {self.account_sid[:6]}..., Auth Token: {self.auth_token[:6]}..., Phone: {self.phone_number}")
-            
-            message = self.client.messages.create(
-                body=message,
-                from_=self.phone_number,
-                to=to_phone
+    @property
+    def sender_key(self) -> str:
+        """Rate limits apply per messaging service when one is configured, else per number"""
+        return self.messaging_service_sid or self.phone_number
+    
+    def _bucket(self, sender: str) -> RedisRateLimiter:
+        """One limit per sender across the API and every worker, shared through Redis"""
+        with self.buckets_lock:
+            if sender not in self.buckets:
+                self.buckets[sender] = RedisRateLimiter(
+                    redis_client, f"twilio:rate:{sender}", TWILIO_SEND_RATE, TWILIO_SEND_BURST
+                )
+            return self.buckets[sender]
+    
+    def _create_message(self, to_phone: str, body: str):
+        options = {"status_callback": TWILIO_STATUS_CALLBACK_URL} if TWILIO_STATUS_CALLBACK_URL else {}
+        if self.messaging_service_sid:
+            return self.client.messages.create(
+                body=body,
+                messaging_service_sid=self.messaging_service_sid,
+                to=to_phone,
+                **options
             )
+        return self.client.messages.create(
+            body=body,
+            from_=self.phone_number,
+            to=to_phone,
+            **options
+        )
+    
+    def _send(self, to_phone: str, body: str, claim: Optional[Callable[[], bool]] = None) -> dict:
+        """
+        Rate-limited send, timed end to end
+        - claim() runs right before the send; False skips it (another task owns it)
+        """
+        if claim is not None and not claim():
+            return {"success": False, "skipped": True, "error": "Claimed by another send"}
+        started = time.perf_counter()
+        result = self._send_with_retries(to_phone, body)
+        metrics.TWILIO_SEND_SECONDS.labels("ok" if result["success"] else "error").observe(
+            time.perf_counter() - started
+        )
+        return result
+    
+    def _send_with_retries(self, to_phone: str, body: str) -> dict:
+        """Jittered exponential backoff on 429/503 and on connections that never reached Twilio"""
+        bucket = self._bucket(self.sender_key)
+        attempt = 0
+        
+        while True:
+            bucket.acquire()
+            try:
+                message = self._create_message(to_phone, body)
+                return {
+                    "success": True,
+                    "message_sid": message.sid,
+                    "status": message.status
+                }
+            except TwilioRestException as e:
+                if e.status not in RETRYABLE_STATUSES or attempt >= TWILIO_MAX_RETRIES:
+                    return {"success": False, "error": str(e), "status_code": e.status}
+                metrics.TWILIO_RETRIES.labels(str(e.status)).inc()
+            except Exception as e:
+                if not _never_sent(e) or attempt >= TWILIO_MAX_RETRIES:
+                    return {"success": False, "error": str(e)}
+                metrics.TWILIO_RETRIES.labels("connect").inc()
             
-            return {
-                "success": True,
-                "message_sid": message.sid,
-                "status": message.status
-            }
-        except Exception as e:
-            print(f"Error sending SMS: {str(e)}")
-            return {
-                "success": False,
-                "error": str(e)
-            }
+            # Full jitter keeps a burst of retries from hitting Twilio in lockstep
+            delay = min(TWILIO_RETRY_MAX_DELAY, TWILIO_RETRY_BASE_DELAY * (2 ** attempt))
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+    
+    def send_sms(self, to_phone: str, message: str, claim: Optional[Callable[[], bool]] = None) -> dict:
+        """Send SMS message via Twilio"""
+        result = self._send(to_phone, message, claim)
+        if not result["success"] and not result.get("skipped"):
+            logger.error(f"Error sending SMS to {to_phone}: {result['error']}")
+        return result
+    
+    def send_many(self, messages: List[Tuple[str, str]],
+                  on_result: Optional[Callable[[int, dict], None]] = None,
+                  claim: Optional[Callable[[int], bool]] = None) -> List[dict]:
+        """
+        Send a batch of (phone, body) pairs through the bounded sender pool
+        - Drains at the sender's token-bucket rate
+        - claim(index) runs on the sender thread right before each send; False skips it
+        - on_result(index, result) runs on the sender thread as each send completes
+        - Results are returned in input order
+        """
+        futures = [
+            self.executor.submit(self._send, phone, body, functools.partial(claim, index) if claim else None)
+            for index, (phone, body) in enumerate(messages)
+        ]
+        if on_result is not None:
+            for index, future in enumerate(futures):
+                future.add_done_callback(functools.partial(self._report, on_result, index))
+        return [future.result() for future in futures]
+    
+    @staticmethod
+    def _report(on_result: Callable[[int, dict], None], index: int, future):
+        if future.exception() is None:
+            on_result(index, future.result())
     
     
     def validate_phone_number(self, phone: str) -> bool:
@@ -1,50 +1,278 @@
-from fastapi import APIRouter, Form, HTTPException, Depends
-from sqlalchemy.orm import Session
-from models import get_db, UserReply
+from fastapi import APIRouter, Form, HTTPException, Response
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import update
+from models import AsyncSessionLocal, UserReply
 from gpt_utils import gpt_generator
+from rollups import arecord_reply
+from delivery_status import delivery_status_buffer
 from twilio_utils import twilio_service
+from redis_utils import redis_client
 from twilio.twiml.messaging_response import MessagingResponse
+from datetime import datetime
+from typing import List, Optional, Tuple
+import asyncio
+import json
+import logging
+import os
+import time
+import metrics
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Twilio gives up on a webhook after 15s; answer well inside that
+WEBHOOK_REPLY_BUDGET_SECONDS = float(os.getenv("WEBHOOK_REPLY_BUDGET_SECONDS", "10"))
+
+# Burst coalescing: texts from one phone within this many quiet seconds get a single reply
+INBOUND_COALESCE_SECONDS = float(os.getenv("INBOUND_COALESCE_SECONDS", "4"))  # 0 disables
+INBOUND_COALESCE_MAX_WAIT_SECONDS = float(os.getenv("INBOUND_COALESCE_MAX_WAIT_SECONDS", "12"))
+# How long shutdown waits for pending bursts and late replies to be sent
+INBOUND_DRAIN_SECONDS = float(os.getenv("INBOUND_DRAIN_SECONDS", "15"))
+
+FALLBACK_REPLY = "Thanks for your message! I'm here to support your health journey. 💪"
+
+# Replies that overran the budget and are still being delivered via the REST API
+_late_replies = set()
+
+# Coalesced bursts waiting for their phone to go quiet
+_pending_bursts = set()
+
+# Set on shutdown: waiting bursts stop waiting for quiet and answer right away
+_draining = asyncio.Event()
+
+class InboundCoalescer:
+    """
+    Queues a phone's inbound texts in Redis so a burst can be answered once
+    - Shared across API processes: a burst split over several of them still merges
+    - The first message of a burst makes its process the leader for that phone
+    - The leader waits until the phone has been quiet for window_seconds (at most
+      max_wait_seconds in total), then takes every queued message
+    - Each queued entry carries the id of the UserReply row already stored for it
+    - Calls are sync Redis; async callers run them via run_in_threadpool
+    """
+    
+    def __init__(self, client, window_seconds: float, max_wait_seconds: float, prefix: str = "inbound"):
+        self.redis = client
+        self.window_seconds = window_seconds
+        self.max_wait_seconds = max(max_wait_seconds, window_seconds)
+        self.prefix = prefix
+        # Queued texts outlive a leader that died mid-burst; the next text picks them up
+        self.ttl_seconds = int(self.max_wait_seconds + WEBHOOK_REPLY_BUDGET_SECONDS) + 60
+    
+    @property
+    def enabled(self) -> bool:
+        return self.window_seconds > 0
+    
+    def _keys(self, phone: str) -> Tuple[str, str, str]:
+        return (
+            f"{self.prefix}:messages:{phone}",
+            f"{self.prefix}:last:{phone}",
+            f"{self.prefix}:leader:{phone}"
+        )
+    
+    def add(self, phone: str, body: str, reply_id: int) -> bool:
+        """Queue a text; True if the caller should lead (wait for and answer) the burst"""
+        messages, last, leader = self._keys(phone)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        pipe.rpush(messages, json.dumps({"body": body, "reply_id": reply_id}))
+        pipe.expire(messages, self.ttl_seconds)
+        pipe.set(last, now, ex=self.ttl_seconds)
+        pipe.set(leader, 1, nx=True, px=int((self.max_wait_seconds + WEBHOOK_REPLY_BUDGET_SECONDS) * 1000))
+        return bool(pipe.execute()[-1])
+    
+    def quiet_seconds(self, phone: str) -> float:
+        last = self.redis.get(self._keys(phone)[1])
+        return time.time() - float(last) if last else float("inf")
+    
+    def take(self, phone: str) -> List[dict]:
+        """Release leadership, then atomically drain the queue"""
+        messages, _, leader = self._keys(phone)
+        # A text arriving after the release leads a new burst; if this drain already
+        # took it, that leader finds an empty queue and does nothing
+        self.redis.delete(leader)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.lrange(messages, 0, -1)
+        pipe.delete(messages)
+        return [json.loads(entry) for entry in pipe.execute()[0]]
+
+inbound_coalescer = InboundCoalescer(
+    redis_client,
+    window_seconds=INBOUND_COALESCE_SECONDS,
+    max_wait_seconds=INBOUND_COALESCE_MAX_WAIT_SECONDS
+)
+
+def _twiml(message: str = None) -> Response:
+    twiml_response = MessagingResponse()
+    if message:
+        twiml_response.message(message)
+    return Response(content=str(twiml_response), media_type="application/xml")
+
+async def _store_incoming(phone: str, incoming_message: str, received_at: datetime) -> int:
+    """Store an inbound text before it is answered, so a failed reply cannot lose it"""
+    async with AsyncSessionLocal() as db:
+        reply = UserReply(
+            phone=phone,
+            incoming_message=incoming_message,
+            bot_response="",
+            received_at=received_at
+        )
+        db.add(reply)
+        await arecord_reply(db, phone, received_at)
+        with metrics.timed(metrics.DB_COMMIT_SECONDS, "user_reply"):
+            await db.commit()
+        return reply.id
+
+async def _log_reply(phone: str, incoming_message: str, bot_response: str, reply_id: Optional[int] = None):
+    """
+    Store a text and its reply without blocking the event loop
+    - With reply_id, the text is already stored and only the reply is filled in
+    """
+    async with AsyncSessionLocal() as db:
+        if reply_id is None:
+            received_at = datetime.utcnow()
+            db.add(UserReply(
+                phone=phone,
+                incoming_message=incoming_message,
+                bot_response=bot_response,
+                received_at=received_at
+            ))
+            await arecord_reply(db, phone, received_at)
+        else:
+            await db.execute(
+                update(UserReply).where(UserReply.id == reply_id).values(bot_response=bot_response)
+            )
+        with metrics.timed(metrics.DB_COMMIT_SECONDS, "user_reply"):
+            await db.commit()
+    gpt_generator.record_exchange(phone, incoming_message, bot_response)
+
+async def _reply_to_burst(phone: str):
+    """
+    Leader side of a burst: wait for the phone to go quiet, then answer everything at once
+    - Every text was stored on arrival; the shared reply goes on the burst's last row
+    """
+    started = time.monotonic()
+    try:
+        while True:
+            quiet = await run_in_threadpool(inbound_coalescer.quiet_seconds, phone)
+            remaining = min(
+                inbound_coalescer.window_seconds - quiet,
+                inbound_coalescer.max_wait_seconds - (time.monotonic() - started)
+            )
+            if remaining <= 0 or _draining.is_set():
+                break
+            try:
+                await asyncio.wait_for(_draining.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+        
+        entries = await run_in_threadpool(inbound_coalescer.take, phone)
+        if not entries:
+            return
+        
+        incoming_message = "\n".join(entry["body"] for entry in entries)
+        bot_response = await gpt_generator.agenerate_reply_to_user(incoming_message, phone)
+        result = await run_in_threadpool(twilio_service.send_sms, phone, bot_response)
+        if not result["success"]:
+            # The texts stay stored with an empty bot_response
+            return
+        await _log_reply(phone, incoming_message, bot_response, reply_id=entries[-1].get("reply_id"))
+    except Exception as e:
+        logger.error(f"Error replying to message burst from {phone}: {str(e)}")
+
+async def _deliver_late_reply(phone: str, user_message: str, reply_task: asyncio.Task,
+                              reply_id: Optional[int] = None):
+    """Finish a reply that missed the webhook budget and send it out-of-band"""
+    try:
+        bot_response = await reply_task
+        result = await run_in_threadpool(twilio_service.send_sms, phone, bot_response)
+        if not result["success"]:
+            # Keep the text without claiming a reply went out
+            if reply_id is None:
+                await _store_incoming(phone, user_message, datetime.utcnow())
+            return
+        await _log_reply(phone, user_message, bot_response, reply_id)
+    except Exception as e:
+        logger.error(f"Error delivering late reply to {phone}: {str(e)}")
+
+async def drain_pending_replies(timeout: float):
+    """On shutdown: answer waiting bursts now and let in-flight late replies finish"""
+    _draining.set()
+    pending = _pending_bursts | _late_replies
+    if not pending:
+        return
+    done, not_done = await asyncio.wait(pending, timeout=timeout)
+    if not_done:
+        logger.error(f"Shutting down with {len(not_done)} inbound replies still unsent")
+
 @router.post("/twilio-reply")
 async def handle_twilio_webhook(
     From: str = Form(...),
-    Body: str = Form(...),
-    db: Session = Depends(get_db)
+    Body: str = Form(...)
 ):
     """Handle incoming SMS messages from Twilio webhook"""
     
+    started = time.perf_counter()
     try:
         # Clean up the phone number
         user_phone = From
         user_message = Body.strip()
         
-        # Generate AI response using GPT
-        bot_response = gpt_generator.generate_reply_to_user(user_message)
+        # Bursts are answered once via the REST API; Twilio gets an empty TwiML ack now
+        reply_id = None
+        if inbound_coalescer.enabled:
+            # Stored before queueing, so the text survives a leader that fails to reply
+            reply_id = await _store_incoming(user_phone, user_message, datetime.utcnow())
+            try:
+                if await run_in_threadpool(inbound_coalescer.add, user_phone, user_message, reply_id):
+                    burst = asyncio.ensure_future(_reply_to_burst(user_phone))
+                    _pending_bursts.add(burst)
+                    burst.add_done_callback(_pending_bursts.discard)
+                metrics.WEBHOOK_SECONDS.labels("coalesced").observe(time.perf_counter() - started)
+                return _twiml()
+            except Exception as e:
+                # Without Redis, fall back to answering each text on its own
+                logger.error(f"Error coalescing message from {user_phone}: {str(e)}")
+        
+        # Generate AI response using GPT, bounded by the webhook latency budget
+        reply_task = asyncio.ensure_future(gpt_generator.agenerate_reply_to_user(user_message, user_phone))
+        try:
+            bot_response = await asyncio.wait_for(
+                asyncio.shield(reply_task),
+                timeout=WEBHOOK_REPLY_BUDGET_SECONDS
+            )
+        except asyncio.TimeoutError:
+            # Answer now with the canned reply; the real one follows via the REST API
+            late = asyncio.ensure_future(_deliver_late_reply(user_phone, user_message, reply_task, reply_id))
+            _late_replies.add(late)
+            late.add_done_callback(_late_replies.discard)
+            metrics.WEBHOOK_SECONDS.labels("deferred").observe(time.perf_counter() - started)
+            return _twiml(FALLBACK_REPLY)
         
         # Log the conversation
-        reply_log = UserReply(
-            phone=user_phone,
-            incoming_message=user_message,
-            bot_response=bot_response
-        )
-        db.add(reply_log)
-        db.commit()
+        await _log_reply(user_phone, user_message, bot_response, reply_id)
         
         # Create Twilio response
-        twiml_response = MessagingResponse()
-        twiml_response.message(bot_response)
-        
-        return twiml_response
-        
+        metrics.WEBHOOK_SECONDS.labels("reply").observe(time.perf_counter() - started)
+        return _twiml(bot_response)
+    
     except Exception as e:
         # Log error and send generic response
-        twiml_response = MessagingResponse()
-        twiml_response.message("Thanks for your message! I'm here to support your health journey. 💪")
-        return twiml_response
+        logger.error(f"Error handling Twilio webhook: {str(e)}")
+        metrics.WEBHOOK_SECONDS.labels("error").observe(time.perf_counter() - started)
+        return _twiml(FALLBACK_REPLY)
+
+@router.post("/twilio-status")
+async def handle_twilio_status(
+    MessageSid: str = Form(...),
+    MessageStatus: str = Form(...)
+):
+    """Twilio delivery status callback; buffered and applied to MessageLog in bulk"""
+    delivery_status_buffer.add(MessageSid, MessageStatus)
+    return Response(status_code=204)
 
 @router.get("/webhook-test")
 async def test_webhook():
     """Test endpoint to verify webhook is working"""
-    return {"message": "Twilio webhook is working!", "status": "active"}
\ No newline at end of file
+    return {"message": "Twilio webhook is working!", "status": "active"}